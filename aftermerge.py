@@ -27,8 +27,30 @@ along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
 
 from argparse import ArgumentParser
 from argparse import FileType
+from collections import deque
+from functools import lru_cache
+from itertools import chain
+import multiprocessing
 import sys
+import json
+import os
+import resource
+import struct
+import tempfile
+import time
+import backgroundIO
+import bamFile
+import bamIndex
+import batchConsensus
+import intervalIndex
+import mateBuffer
+import progressReport
+import runProfile
+import samChunks
+import sampleManifest
+import readSample
 import samRead
+import sortedOutput
    
 
 def mergeSequences(seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2):
@@ -36,6 +58,7 @@ def mergeSequences(seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2):
     function returns (sequence, quality) the merged sequence and quality
     when bases in the merge match, base quality is the max
     when they do not match, base is base with highest quality, quality is the average
+    the sequences are merged in one pass from left to right (linear time, no recursion)
     '''
     seq1 = str(seq1)
     seq2 = str(seq2)
@@ -45,77 +68,1248 @@ def mergeSequences(seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2):
     mcigar2 = str(mcigar2)
     start1 = int(start1)
     start2 = int(start2)
-    newseq = ""
-    newqual = ""
-    newmcigar = ""
-    if (seq1 == ""):
-        #no seq1 any more
-        return (seq2, qual2, mcigar2)
-    if (seq2 == ""):
-        #no seq2 any more
-        return (seq1, qual1, mcigar1)
-    if (start2 < start1):
-        #seq2 is before seq1
-        (newseq, newqual, newmcigar) = mergeSequences(seq1, seq2[1:], qual1, qual2[1:], mcigar1, mcigar2[1:], start1, start2+1)
-        newseq = seq2[0] + newseq
-        newqual = qual2[0] + newqual
-        newmcigar = mcigar2[0] + newmcigar
-    elif (start2 > start1):
-        #seq1 is before seq2
-        (newseq, newqual, newmcigar) = mergeSequences(seq1[1:], seq2, qual1[1:], qual2, mcigar1[1:], mcigar2, start1+1, start2)
-        newseq = seq1[0] + newseq
-        newqual = qual1[0] + newqual
-        newmcigar = mcigar1[0] + newmcigar
-    else:
-        #same pos
-        if (mcigar1[0] == mcigar2[0]):
-            #same cigar, no problem
-            (newseq, newqual, newmcigar) = mergeSequences(seq1[1:], seq2[1:], qual1[1:], qual2[1:], mcigar1[1:], mcigar2[1:], start1+1, start2+1)
-            if (seq1[0] == seq2[0]):
-                #same base, so take highest quality
-                newseq = seq1[0] + newseq
-                qual = max(qual1[0], qual2[0])
-                newqual = qual + newqual
-                newmcigar = mcigar1[0] + newmcigar
+    if (isSameCigarOverlap(seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2)):
+        #fast path: same start and same cigar (ex. both all M), so every base is merged with the same cigar
+        return _mergeSameCigar(seq1, seq2, qual1, qual2, mcigar1)
+    newseq = []
+    newqual = []
+    newmcigar = []
+    i1 = 0
+    i2 = 0
+    while (True):
+        if (i1 >= len(seq1)):
+            #no seq1 any more
+            newseq.append(seq2[i2:])
+            newqual.append(qual2[i2:])
+            newmcigar.append(mcigar2[i2:])
+            break
+        if (i2 >= len(seq2)):
+            #no seq2 any more
+            newseq.append(seq1[i1:])
+            newqual.append(qual1[i1:])
+            newmcigar.append(mcigar1[i1:])
+            break
+        if (start2 < start1):
+            #seq2 is before seq1
+            newseq.append(seq2[i2])
+            newqual.append(qual2[i2])
+            newmcigar.append(mcigar2[i2])
+            i2 = i2 + 1
+            start2 = start2 + 1
+        elif (start2 > start1):
+            #seq1 is before seq2
+            newseq.append(seq1[i1])
+            newqual.append(qual1[i1])
+            newmcigar.append(mcigar1[i1])
+            i1 = i1 + 1
+            start1 = start1 + 1
+        else:
+            #same pos
+            c1 = mcigar1[i1]
+            c2 = mcigar2[i2]
+            if (c1 == c2):
+                #same cigar, no problem
+                if (seq1[i1] == seq2[i2]):
+                    #same base, so take highest quality
+                    newseq.append(seq1[i1])
+                    newqual.append(max(qual1[i1], qual2[i2]))
+                else:
+                    #not same base, so take base with highest quality, give lowest quality
+                    base = seq1[i1]
+                    if (qual1[i1] < qual2[i2]):
+                        base = seq2[i2]
+                    newseq.append(base)
+                    newqual.append(min(qual1[i1], qual2[i2]))
+                newmcigar.append(c1)
+            elif (c1.isupper() and c2.isupper()):
+                #not same cigar, but both match or mismatch
+                m = c1
+                if (qual1[i1] < qual2[i2]):
+                    m = c2
+                newseq.append(seq1[i1])
+                newqual.append(chr(int((ord(qual1[i1]) + ord(qual2[i2])) / 2)))
+                newmcigar.append(m)
+            elif (c1 == "s"):
+                #seq1 is softclipped, the rest comes from seq2
+                newseq.append(seq2[i2:])
+                newqual.append(qual2[i2:])
+                newmcigar.append(mcigar2[i2:])
+                break
+            elif (c2 == "s"):
+                #seq2 is softclipped, the rest comes from seq1
+                newseq.append(seq1[i1:])
+                newqual.append(qual1[i1:])
+                newmcigar.append(mcigar1[i1:])
+                break
             else:
-                #not same base, so take base with highest quality, give lowest quality
-                base = seq1[0]
-                if (qual1[0] < qual2[0]):
-                    base = seq2[0]
-                qual = min(qual1[0], qual2[0])
-                newseq = base + newseq
-                newqual = qual + newqual
-                newmcigar = mcigar1[0] + newmcigar
+                #One is insertion or deletion
+                print("unable to resolve: {}\t{}".format(c1, c2))
+                break
+            i1 = i1 + 1
+            i2 = i2 + 1
+            start1 = start1 + 1
+            start2 = start2 + 1
+    return ("".join(newseq), "".join(newqual), "".join(newmcigar))
+
+
+def isSameCigarOverlap(seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2):
+    '''
+    function returns True if both overlaps have the same start and the same cigar (ex. both all M),
+    so every base is merged with the base on the same position
+    '''
+    return (start1 == start2 and mcigar1 == mcigar2 and len(seq1) == len(seq2) == len(qual1) == len(qual2) == len(mcigar1))
+
+
+def _mergeSameCigar(seq1, seq2, qual1, qual2, mcigar):
+    '''
+    function returns (sequence, quality, cigar) for two overlaps with the same start and the same cigar
+    '''
+    if (seq1 == seq2):
+        #no mismatches at all, only the quality has to be merged
+        return (seq1, "".join(map(max, qual1, qual2)), mcigar)
+    newseq = []
+    newqual = []
+    for (b1, b2, q1, q2) in zip(seq1, seq2, qual1, qual2):
+        if (b1 == b2):
+            #same base, so take highest quality
+            newseq.append(b1)
+            newqual.append(max(q1, q2))
         else:
-            #not same cigar
-            c1 = str(mcigar1[0])
-            c2 = str(mcigar2[0])
-            if (c1.isupper() and c2.isupper()):
-                #both match or mismatch
-                (newseq, newqual, newmcigar) = mergeSequences(seq1[1:], seq2[1:], qual1[1:], qual2[1:], mcigar1[1:], mcigar2[1:], start1+1, start2+1)
-                base = seq1[0]
-                m = mcigar1[0]
-                if (qual1[0] < qual2[0]):
-                    base = seq2[0]
-                    m = mcigar2[0]
-                qual = chr(int((ord(qual1[0]) + ord(qual2[0])) / 2))
-                newseq = seq1[0] + newseq
-                newqual = qual + newqual
-                newmcigar = m + newmcigar
+            #not same base, so take base with highest quality, give lowest quality
+            if (q1 < q2):
+                newseq.append(b2)
             else:
-                #one is insert, deletion or clipped
-                if (c1 == "s"):
-                    #seq1 is softclipped
-                    (newseq, newqual, newmcigar) = mergeSequences("", seq2, "", qual2, "", mcigar2, start1+1, start2+1)
-                elif (c2 == "s"):
-                    #seq2 is softclipped
-                    (newseq, newqual, newmcigar) = mergeSequences(seq1, "", qual1, "", mcigar1, "", start1+1, start2+1)
+                newseq.append(b1)
+            newqual.append(min(q1, q2))
+    return ("".join(newseq), "".join(newqual), mcigar)
+
+
+def _mergeOverlap(seq1, seq2, qual1, qual2, mcigar1, mcigar2, offset):
+    '''
+    function returns mergeSequences of an overlap of which the second read starts offset bases after the first
+    (the merged overlap only depends on the start of the reads relative to each other)
+    '''
+    return mergeSequences(seq1, seq2, qual1, qual2, mcigar1, mcigar2, 0, offset)
+
+
+#merged overlaps kept for reuse (ex. the many pairs with the same overlap of an amplicon library), None: not kept
+MERGE_CACHE_SIZE = 0
+cachedMerge = None
+
+
+def setMergeCacheSize(size):
+    '''
+    set the number of merged overlaps kept by cachedMerge (0: no caching), the cache is emptied
+    '''
+    global cachedMerge
+    cachedMerge = None
+    if (size > 0):
+        cachedMerge = lru_cache(maxsize=size)(_mergeOverlap)
+
+
+def mergeCacheSize():
+    '''
+    function returns the number of merged overlaps kept by cachedMerge
+    '''
+    if (cachedMerge is None):
+        return 0
+    return cachedMerge.cache_info().maxsize
+
+
+def mergeCacheCounts():
+    '''
+    function returns (hits, misses, evictions) of cachedMerge, since its size was set
+    every miss adds an overlap, so the overlaps not in the cache any more are evicted
+    '''
+    if (cachedMerge is None):
+        return (0, 0, 0)
+    info = cachedMerge.cache_info()
+    return (info.hits, info.misses, info.misses - info.currsize)
+
+
+def mergeOverlap(arguments):
+    '''
+    function returns mergeSequences(*arguments) (sequence, quality, cigar), from cachedMerge when it is on
+    '''
+    if (cachedMerge is None):
+        return mergeSequences(*arguments)
+    (seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2) = arguments
+    return cachedMerge(seq1, seq2, qual1, qual2, mcigar1, mcigar2, start2 - start1)
+
+
+def cacheCounts():
+    '''
+    function returns the counts of the caches of this process: the (hits, misses) of the cigar cache and the (hits, misses, evictions) of the merge cache
+    '''
+    return samRead.cigarCacheCounts() + mergeCacheCounts()
+
+
+def cacheCountsSince(before):
+    '''
+    function returns the counts of the caches of this process since before (given by cacheCounts)
+    '''
+    return tuple(now - then for (now, then) in zip(cacheCounts(), before))
+
+
+#the keys in mergeStatistics.counts of the counts of cacheCounts
+CACHE_COUNTS = ("cigar_cache_hits", "cigar_cache_misses", "merge_cache_hits", "merge_cache_misses", "merge_cache_evictions")
+
+
+def initCaches(cigarcachesize, mergecachesize):
+    '''
+    set the sizes of the caches of a worker process (the caches of the main process are not shared)
+    '''
+    samRead.setCigarCacheSize(cigarcachesize)
+    setMergeCacheSize(mergecachesize)
+
+
+#status of a processed pair, returned by mergePair
+PAIR_NOT_OVERLAPPING = 0
+PAIR_MERGED = 1
+PAIR_FAILED = 2
+PAIR_BLACKLISTED = 3
+
+
+def overlapToMerge(samread, materead, profile=None, blacklist=None):
+    '''
+    function returns (result, overlap) for a pair of mate reads, all but the merging of the overlap itself
+    result is (outline, errorline, status) when the pair is done: not overlapping, blacklisted or failed to merge (overlap is then None)
+    otherwise result is None and overlap is (samread, materead, start, start2, length, cigarstart, matecigarstart, arguments),
+    with arguments the arguments of mergeSequences for the overlapping parts of both reads
+    '''
+    if (profile is not None):
+        profile.switch("overlap_check")
+    #start checking if overlapping
+    if (not samread.isoverlapping(materead)):
+        #no overlap, so do not fix
+        return ((samread.simpleline + "\n" + materead.simpleline, None, PAIR_NOT_OVERLAPPING), None)
+    if (blacklist is not None):
+        (overlapstart, overlapend) = samread.overlapOnReference(materead)
+        if (blacklist.overlaps(samread.rname, overlapstart, overlapend)):
+            #overlap in a blacklisted region, so do not fix
+            return ((samread.simpleline + "\n" + materead.simpleline, None, PAIR_BLACKLISTED), None)
+    #overlapping, so fix
+    #check which read is the first on the reference
+    if (samread.pos > materead.pos):
+        change = samread
+        samread = materead
+        materead = change
+    #check if the cigar string of the overlap is the same,
+    #and get the start of the overlap on the sequence, reference, cigar, matecigar, and length of the overlap
+    (sameoverlapcigar, start, cigarstart, matecigarstart, length, refstart) = samread.overlapHasSameCigar(materead)
+    if (profile is not None):
+        profile.addOverlap(length)
+    if (not sameoverlapcigar):
+        #different cigar, so overlap is probably an error => add line in error file
+        errorline = "{}\t{}\t{}\t{}".format(samread.rname, refstart, refstart+length, samread.qname)
+        if (profile is not None):
+            #the cigar start is on the read first on the reference (on the same position: the mate)
+            (firstread, secondread) = (materead, samread)
+            if (samread.pos < materead.pos):
+                (firstread, secondread) = (samread, materead)
+            profile.addFailure(runProfile.failureCause(firstread.cigarRuns(), cigarstart, secondread.cigarRuns(), matecigarstart, length))
+        return ((samread.line + "\n" + materead.line, errorline, PAIR_FAILED), None)
+    if (profile is not None):
+        profile.switch("merging")
+    #same cigar
+    #get the overlapping sequence, quality and cigar for the first read
+    seq1 = samread.seq[start:start+length]
+    qual1 = samread.qual[start:start+length]
+    samruns = samread.cigarRuns()
+    mcigar1 = samRead.expandRuns(samRead.cigarWindow(samruns, cigarstart, cigarstart+length))
+    #get the overlapping sequence, quality and cigar for the second read
+    start2 = materead.startOfSeqOnRef()
+    seq2 = materead.seq[start2:start2+length]
+    qual2 = materead.qual[start2:start2+length]
+    materuns = materead.cigarRuns()
+    mcigar2 = samRead.expandRuns(samRead.cigarWindow(materuns, matecigarstart, matecigarstart+length))
+    return (None, (samread, materead, start, start2, length, cigarstart, matecigarstart, (seq1, seq2, qual1, qual2, mcigar1, mcigar2, refstart, materead.pos)))
+
+
+def mergedPair(overlap, merged):
+    '''
+    function returns (outline, errorline, status) of a merged pair
+    overlap is given by overlapToMerge, merged is (sequence, quality, cigar) of the merged overlap, as given by mergeSequences
+    '''
+    (samread, materead, start, start2, length, cigarstart, matecigarstart, arguments) = overlap
+    (newseq, newqual, newmcigar) = merged
+    samruns = samread.cigarRuns()
+    materuns = materead.cigarRuns()
+
+    #correct the new sequence, by adding the non overlapping parts
+    newseq = "{}{}{}".format(samread.seq[0:start], newseq, materead.seq[start2+length:])
+    newqual = "{}{}{}".format(samread.qual[0:start], newqual, materead.qual[start2+length:])
+    #the cigar is build from the runs of the non overlapping parts and the merged overlap
+    newruns = samRead.cigarWindow(samruns, 0, cigarstart) + samRead.runsFromLongcigar(newmcigar) + samRead.cigarWindow(materuns, matecigarstart+length, None)
+    #set flag on 0: forward mapped
+    flag = 0
+    #mapping quality is the mean of both mappings
+    mapq = int((samread.mapq + materead.mapq)/2)
+    cigar = samRead.cigarFromRuns(newruns)
+    outline = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}".format(samread.qname, flag, samread.rname, samread.pos, mapq, cigar, "*", "0", "0", newseq, newqual)
+    return (outline, None, PAIR_MERGED)
+
+
+def mergePair(samread, materead, profile=None, blacklist=None):
+    '''
+    function returns (outline, errorline, status) for a pair of mate reads
+    samread is the mate read last seen in the input, materead the one seen before
+    outline are the sam line(s) to write, errorline the bed line for the error file (or None)
+    profile is the runProfile to add the time, overlap length and failure cause to (None: no profiling)
+    blacklist is an intervalIndex of regions not to merge in: pairs overlapping in them are written as not overlapping
+    '''
+    (result, overlap) = overlapToMerge(samread, materead, profile, blacklist)
+    if (result is not None):
+        return result
+    #get the new sequence for the overlap
+    return mergedPair(overlap, mergeOverlap(overlap[-1]))
+
+
+def processBatch(batch, profile=None, blacklist=None, consensus="scalar", statsonly=False):
+    '''
+    function returns a list of (outline, errorline, status), one for each item in the batch
+    an item is either a line (str or bytes) which is written as is, or a tuple (samread, materead) which has to be merged
+    consensus numpy merges the overlaps with the same start and cigar of the whole batch at once (see processBatchVectorized)
+    statsonly only gives the status and the error line of the pairs (see countBatch)
+    '''
+    if (statsonly):
+        return countBatch(batch, profile, blacklist)
+    if (consensus == "numpy"):
+        return processBatchVectorized(batch, profile, blacklist)
+    results = []
+    for item in batch:
+        if (isinstance(item, tuple)):
+            results.append(mergePair(item[0], item[1], profile, blacklist))
+        else:
+            results.append((item, None, None))
+    return results
+
+
+def processBatchVectorized(batch, profile=None, blacklist=None):
+    '''
+    function returns the results of processBatch, with the overlaps with the same start and the same cigar merged at once by NumPy
+    the other overlaps are merged by mergeOverlap (from the merge cache when it is on), the results are the same as those of processBatch
+    '''
+    results = []
+    #overlaps to merge at once: (index in the results, overlap)
+    sameoverlaps = []
+    for item in batch:
+        if (not isinstance(item, tuple)):
+            results.append((item, None, None))
+            continue
+        (result, overlap) = overlapToMerge(item[0], item[1], profile, blacklist)
+        if (result is not None):
+            results.append(result)
+        elif (isSameCigarOverlap(*overlap[-1])):
+            sameoverlaps.append((len(results), overlap))
+            results.append(None)
+        else:
+            results.append(mergedPair(overlap, mergeOverlap(overlap[-1])))
+    if (profile is not None):
+        profile.switch("merging")
+    merged = batchConsensus.mergeSameCigarBatch([overlap[-1][0:4] for (i, overlap) in sameoverlaps])
+    for (n, (i, overlap)) in enumerate(sameoverlaps):
+        if (merged is None):
+            #not in one byte characters, so one by one
+            results[i] = mergedPair(overlap, mergeOverlap(overlap[-1]))
+        else:
+            #the cigar of the merged overlap is the cigar of both
+            results[i] = mergedPair(overlap, merged[n] + (overlap[-1][4],))
+    return results
+
+
+def countBatch(batch, profile=None, blacklist=None):
+    '''
+    function returns the results of processBatch without output lines (outline None), for the statistics only
+    a pair that can be merged is only checked, its overlap is not merged
+    '''
+    results = []
+    for item in batch:
+        if (not isinstance(item, tuple)):
+            results.append((None, None, None))
+            continue
+        (result, overlap) = overlapToMerge(item[0], item[1], profile, blacklist)
+        if (result is None):
+            results.append((None, None, PAIR_MERGED))
+        else:
+            results.append((None, result[1], result[2]))
+    return results
+
+
+#the blacklist, consensus and statsonly of a worker process, given once when the pool starts,
+#and the counts of its caches (see cacheCounts) when last reported
+workerBlacklist = None
+workerConsensus = "scalar"
+workerStatsOnly = False
+workerCacheCounts = (0, 0, 0, 0, 0)
+
+
+def initWorker(blacklist, consensus="scalar", cigarcachesize=samRead.CIGAR_CACHE_SIZE, statsonly=False, mergecachesize=MERGE_CACHE_SIZE):
+    global workerBlacklist, workerConsensus, workerStatsOnly, workerCacheCounts
+    workerBlacklist = blacklist
+    workerConsensus = consensus
+    workerStatsOnly = statsonly
+    initCaches(cigarcachesize, mergecachesize)
+    workerCacheCounts = cacheCounts()
+
+
+def processBatchInWorker(batch, profiling=False):
+    '''
+    function returns (results, profile, cachecounts): the results of processBatch, the runProfile of the work (None without profiling)
+    and the counts of the caches of the worker since its previous batch (see cacheCounts)
+    this is the unit of work for the worker processes
+    '''
+    global workerCacheCounts
+    profile = None
+    if (profiling):
+        profile = runProfile.runProfile()
+    results = processBatch(batch, profile, workerBlacklist, workerConsensus, workerStatsOnly)
+    if (profile is not None):
+        profile.stop()
+    cachecounts = cacheCountsSince(workerCacheCounts)
+    workerCacheCounts = cacheCounts()
+    return (results, profile, cachecounts)
+
+
+def profiledLines(infile, profile):
+    '''
+    generator over the lines of the input, the time of reading is added to the parsing stage of the profile
+    '''
+    lines = iter(infile)
+    while (True):
+        profile.switch("parsing")
+        line = next(lines, None)
+        if (line is None):
+            return
+        yield line
+
+
+def inputOrderFromHeader(line):
+    '''
+    function returns the input order (name or coordinate) given by the SO field of a @HD header line, None if not given
+    '''
+    for field in line.rstrip().split("\t")[1:]:
+        if (field == "SO:coordinate"):
+            return "coordinate"
+        if (field == "SO:queryname"):
+            return "name"
+    return None
+
+
+def readItems(infile, counts, verbose=False, previousSamReads=None, inputorder="auto", profile=None, leftovers=None, passed=None):
+    '''
+    generator over the input, yields in input order the lines to write and the pairs to merge
+    mates are paired here (by a mateBuffer.matePairing), reads waiting for their mate are kept in previousSamReads (a mateBuffer)
+    counts is a dict with the read counters, updated while reading
+    inputorder is name (mates are mostly next to each other), coordinate, unsorted or auto (from the @HD header line)
+    for input in name order the last read is kept aside, and only put in previousSamReads if the next read is not its mate
+    profile is the runProfile to add the time of parsing and pairing to (None: no profiling)
+    the lines of infile can be bytes (binary input), the header and the lines written as is then stay bytes,
+    only the reads that can be merged are decoded
+    leftovers is a list receiving the sam lines of the reads of which the mate was never seen, instead of yielding them (None: yielded)
+    the reads can also be given as samReads (ex. by the streaming api), these are not parsed again
+    a read of which the mate cannot overlap (from its rnext and pnext, see mateBuffer.predictMate) is written at once, without waiting for its mate,
+    for input in coordinate order waiting for a mate is given up when the input is past the position of the mate
+    passed is a set receiving the names of the reads written at once of which the mate was not seen, and does not know it cannot overlap
+    '''
+    if (profile is not None):
+        infile = profiledLines(infile, profile)
+    if (previousSamReads is None):
+        previousSamReads = mateBuffer.mateBuffer()
+    #made at the first read, when the input order is known
+    pairing = None
+    processed_lines=0
+    #type of the lines, set on the first line
+    binary = None
+    for line in infile:
+        processed_lines=processed_lines+1
+        if (verbose and processed_lines%100000==0):
+            eprint("Processed {} lines".format(processed_lines))
+        samread = None
+        if (isinstance(line, samRead.samRead)):
+            #already parsed
+            samread = line
+            line = samread.line
+        line = line.rstrip()
+        if (binary is None):
+            binary = isinstance(line, bytes)
+            (headerstart, tab) = ("@", "\t")
+            if (binary):
+                (headerstart, tab) = (b"@", b"\t")
+        if (line[:1] == headerstart):
+            #header
+            if (inputorder == "auto"):
+                header = line
+                if (binary):
+                    header = line.decode("ascii")
+                if (header.startswith("@HD")):
+                    inputorder = inputOrderFromHeader(header) or "auto"
+            yield line
+            continue
+        if (pairing is None):
+            #first read, so the header is read: input from the mapper without sort order is in name order
+            #(counts can already have the reads of an earlier input, ex. a mergeStatistics used for several inputs)
+            if (inputorder == "auto"):
+                inputorder = "name"
+            pairing = mateBuffer.matePairing(previousSamReads, counts, inputorder, passed)
+            counts["input_order"] = inputorder
+        counts["total_reads"] = counts["total_reads"] + 1
+        #is read, only the flag is needed to classify it
+        flag = int(line.split(tab, 2)[1])
+        #counting for the statistics
+        if (flag & samRead.FLAG_UNMAPPED == 0):
+            counts["mapped_reads"] = counts["mapped_reads"] + 1
+        else:
+            counts["unmapped_reads"] = counts["unmapped_reads"] + 1
+        if (not samRead.isMergeCandidate(flag)):
+            #not a paired read, pair not mapped or read is secondary: written without parsing
+            yield samRead.simpleLine(line, tab)
+        else:
+            #read can be overlapping
+            rawline = line
+            if (samread is None):
+                if (binary):
+                    line = line.decode("ascii")
+                samread = samRead.samRead(line)
+            if (profile is not None):
+                profile.switch("pairing")
+            for waiting in pairing.giveUp(samread.rname, samread.pos):
+                #the mate is not where it should be
+                if (leftovers is not None):
+                    leftovers.append(waiting.line)
                 else:
-                    #One is insertion or deletion
-                    print("unable to resolve: {}\t{}".format(c1, c2))
-    return (newseq, newqual, newmcigar)
+                    yield waiting.simpleline
+            (decision, materead) = pairing.pair(samread, samread.qname)
+            if (decision == mateBuffer.PAIRING_MATE):
+                #mate seen, so start processing
+                yield (samread, materead)
+            elif (decision == mateBuffer.PAIRING_WRITE):
+                #the mate cannot overlap
+                yield samRead.simpleLine(rawline, tab)
+    if (profile is not None):
+        profile.switch("pairing")
+    if (pairing is not None):
+        pairing.finish()
+    #reads of which the mate was never seen, and mates of which one was spilled to disk
+    for leftOver in previousSamReads.leftovers():
+        if (isinstance(leftOver, tuple)):
+            yield leftOver
+        elif (leftovers is not None):
+            leftovers.append(leftOver.line)
+        else:
+            yield leftOver.simpleline
+
+
+def batches(items, batchsize):
+    '''
+    generator grouping the items in lists of batchsize items
+    '''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if (len(batch) >= batchsize):
+            yield batch
+            batch = []
+    if (len(batch) > 0):
+        yield batch
+
+
+def processInPool(items, threads, batchsize, profile=None, blacklist=None, consensus="scalar", statistics=None, statsonly=False):
+    '''
+    generator yielding the results of processBatch in input order, computed by a pool of worker processes
+    only a limited number of batches is in flight, so memory stays bounded
+    with a profile, the profiles of the workers are added to it, and the time waiting for the workers is measured
+    the counts of the caches of the workers are added to statistics (a mergeStatistics, None: not kept)
+    the workers keep as many parsed cigars and merged overlaps as this process
+    statsonly is given to processBatch
+    '''
+    pool = multiprocessing.Pool(threads, initWorker, (blacklist, consensus, samRead.cigarCacheSize(), statsonly, mergeCacheSize()))
+    def result(asyncresult):
+        if (profile is not None):
+            profile.switch("waiting")
+        (results, workerprofile, cachecounts) = asyncresult.get()
+        if (profile is not None):
+            profile.merge(workerprofile)
+        if (statistics is not None):
+            statistics.addCacheCounts(cachecounts)
+        return results
+    try:
+        inflight = deque()
+        for batch in batches(items, batchsize):
+            inflight.append(pool.apply_async(processBatchInWorker, (batch, profile is not None)))
+            if (len(inflight) >= threads * 2):
+                yield result(inflight.popleft())
+        while (len(inflight) > 0):
+            yield result(inflight.popleft())
+    finally:
+        pool.terminate()
+
+
+class failedMerge:
+    '''
+    a pair of which the overlap could not be merged, as written in the error file:
+    the region of the overlap on the reference (start and end as in the error file) and the name of the reads
+    '''
+
+    __slots__ = ("reference", "start", "end", "qname")
+
+    def __init__(self, reference, start, end, qname):
+        self.reference = reference
+        self.start = start
+        self.end = end
+        self.qname = qname
+
+    @classmethod
+    def fromErrorline(cls, errorline):
+        '''
+        function returns the failedMerge of a line of the error file
+        '''
+        (reference, start, end, qname) = errorline.split("\t")
+        return cls(reference, int(start), int(end), qname)
+
+    def __repr__(self):
+        return "failedMerge({!r}, {}, {}, {!r})".format(self.reference, self.start, self.end, self.qname)
+
+    def __eq__(self, other):
+        return (isinstance(other, failedMerge) and (self.reference, self.start, self.end, self.qname) == (other.reference, other.start, other.end, other.qname))
+
+
+class mergeStatistics:
+    '''
+    the statistics of merging, updated while merging
+    counts has the read counters of readItems (total_reads, mapped_reads, unmapped_reads, out_of_order, passed_through, gave_up, input_order)
+    and the counts of the caches (CACHE_COUNTS: the hits and misses of the cigar caches, and the hits, misses and evictions of the merge caches)
+    with collectfailures, failures is the list of the failedMerges, otherwise None
+    buffer has the reads waiting for their mate while merging (a mateBuffer, or a dict by name in the chunked mode, None when not merging),
+    for the progress report
+    '''
+
+    def __init__(self, collectfailures=False):
+        self.counts = {"total_reads": 0, "mapped_reads": 0, "unmapped_reads": 0, "out_of_order": 0, "passed_through": 0, "gave_up": 0}
+        self.merged = 0
+        self.failed = 0
+        self.blacklisted = 0
+        self.failures = None
+        if (collectfailures):
+            self.failures = []
+        self.peakwaiting = 0
+        self.peakmemory = 0
+        self.spilled = 0
+        self.buffer = None
+
+    def addResults(self, batchresults):
+        '''
+        count the merged, failed and blacklisted pairs of the results of processBatch
+        '''
+        for (outline, errorline, status) in batchresults:
+            if (status == PAIR_MERGED):
+                self.merged = self.merged + 1
+            elif (status == PAIR_FAILED):
+                self.failed = self.failed + 1
+                if (self.failures is not None):
+                    self.failures.append(failedMerge.fromErrorline(errorline))
+            elif (status == PAIR_BLACKLISTED):
+                self.blacklisted = self.blacklisted + 1
+
+    def addBuffer(self, previousSamReads):
+        '''
+        add the peaks and the spilled reads of a mateBuffer
+        '''
+        self.peakwaiting = max(self.peakwaiting, previousSamReads.peak)
+        self.peakmemory = max(self.peakmemory, previousSamReads.peakmemory)
+        self.spilled = self.spilled + previousSamReads.spilled
+
+    def addCacheCounts(self, cachecounts):
+        '''
+        add the counts of the caches, as given by cacheCounts
+        '''
+        for (key, count) in zip(CACHE_COUNTS, cachecounts):
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def merge(self, other):
+        '''
+        add the statistics of another part of the input (ex. a region merged by a worker)
+        the peaks are the highest of both, as the parts have their own buffers
+        '''
+        for (key, count) in other.counts.items():
+            if (isinstance(count, int)):
+                self.counts[key] = self.counts.get(key, 0) + count
+        self.merged = self.merged + other.merged
+        self.failed = self.failed + other.failed
+        self.blacklisted = self.blacklisted + other.blacklisted
+        if (self.failures is not None and other.failures is not None):
+            self.failures.extend(other.failures)
+        self.peakwaiting = max(self.peakwaiting, other.peakwaiting)
+        self.peakmemory = max(self.peakmemory, other.peakmemory)
+        self.spilled = self.spilled + other.spilled
+
+    def cigarHitRate(self):
+        '''
+        function returns the fraction of the cigars found in the cigar caches
+        '''
+        hits = self.counts.get("cigar_cache_hits", 0)
+        misses = self.counts.get("cigar_cache_misses", 0)
+        if (hits + misses == 0):
+            return 0.0
+        return hits / (hits + misses)
+
+    def mergeHitRate(self):
+        '''
+        function returns the fraction of the overlaps found in the merge caches
+        '''
+        hits = self.counts.get("merge_cache_hits", 0)
+        misses = self.counts.get("merge_cache_misses", 0)
+        if (hits + misses == 0):
+            return 0.0
+        return hits / (hits + misses)
+
+    def toDict(self):
+        '''
+        function returns the statistics as dict, for the json report
+        '''
+        return {
+            "total_reads": self.counts["total_reads"],
+            "mapped_reads": self.counts["mapped_reads"],
+            "unmapped_reads": self.counts["unmapped_reads"],
+            "merged_pairs": self.merged,
+            "failed_merges": self.failed,
+            "blacklisted_pairs": self.blacklisted,
+            "input_order": self.counts.get("input_order"),
+            "reads_not_next_to_mate": self.counts.get("out_of_order", 0),
+            "reads_passed_without_mate": self.counts.get("passed_through", 0),
+            "reads_given_up_waiting_for_mate": self.counts.get("gave_up", 0),
+            "peak_reads_waiting_for_mate": self.peakwaiting,
+            "peak_memory_waiting_for_mate": self.peakmemory,
+            "reads_spilled_to_disk": self.spilled,
+            "cigar_cache": {"size": samRead.cigarCacheSize(), "hits": self.counts.get("cigar_cache_hits", 0), "misses": self.counts.get("cigar_cache_misses", 0),
+                            "hit_rate": round(self.cigarHitRate(), 6)},
+            "merge_cache": {"size": mergeCacheSize(), "hits": self.counts.get("merge_cache_hits", 0), "misses": self.counts.get("merge_cache_misses", 0),
+                            "evictions": self.counts.get("merge_cache_evictions", 0), "hit_rate": round(self.mergeHitRate(), 6)},
+        }
+
+
+def mergeBatches(records, statistics=None, threads=1, batchsize=1000, inputorder="auto", blacklist=None, consensus="scalar",
+                 maxbuffermemory=None, tmpdir=None, profile=None, verbose=False, statsonly=False):
+    '''
+    generator over the results of merging the records, per batch: lists of (outline, errorline, status) as given by processBatch
+    records are sam lines (str or bytes, with or without newline, header lines included) or samReads, in the input order
+    statistics is the mergeStatistics updated while merging (None: not kept)
+    threads above 1 merges the batches in a pool of worker processes, the results stay in input order
+    statsonly gives no output lines, only the statistics (see countBatch)
+    the other arguments are those of readItems, processBatch and mateBuffer
+    '''
+    if (statistics is None):
+        statistics = mergeStatistics()
+    previousSamReads = mateBuffer.mateBuffer(maxbuffermemory, tmpdir)
+    statistics.buffer = previousSamReads
+    cachecounts = cacheCounts()
+    items = readItems(records, statistics.counts, verbose, previousSamReads, inputorder, profile)
+    if (threads == 1):
+        #everything in this process
+        results = (processBatch(batch, profile, blacklist, consensus, statsonly) for batch in batches(items, batchsize))
+    else:
+        #the reading and pairing is done here, merging by the workers
+        results = processInPool(items, threads, batchsize, profile, blacklist, consensus, statistics, statsonly)
+    for batchresults in results:
+        statistics.addResults(batchresults)
+        yield batchresults
+    statistics.buffer = None
+    statistics.addBuffer(previousSamReads)
+    statistics.addCacheCounts(cacheCountsSince(cachecounts))
+
+
+def mergeRecords(records, statistics=None, **settings):
+    '''
+    generator merging the pairs of records, yields the output sam lines (without newline) in input order
+    records are sam lines (str or bytes, with or without newline, header lines included) or samReads
+    a merged pair gives one line, other reads are given as is
+    the lines are of the type of the first record: bytes for lines in bytes (the merged reads and the reads of pairs are then encoded), str otherwise
+    statistics is the mergeStatistics updated while merging, for the failed merges: mergeStatistics(collectfailures=True)
+    settings are the other arguments of mergeBatches (threads, batchsize, inputorder, blacklist, ...)
+    '''
+    records = iter(records)
+    first = next(records, None)
+    if (first is None):
+        return
+    binary = isinstance(first, bytes)
+    newline = "\n"
+    if (binary):
+        newline = b"\n"
+    for batchresults in mergeBatches(chain([first], records), statistics, **settings):
+        for (outline, errorline, status) in batchresults:
+            if (status is None):
+                if (binary and isinstance(outline, str)):
+                    #a read parsed to pair it
+                    outline = outline.encode("ascii")
+                yield outline
+            else:
+                #the lines of a pair are in str (the reads are parsed), joined by a newline
+                if (binary):
+                    outline = outline.encode("ascii")
+                for line in outline.split(newline):
+                    yield line
+
+
+def writeResults(batchresults, outfile, errorfile=None, binary=False):
+    '''
+    write the results of processBatch, the bed lines of the failed merges are written to errorfile (if not None)
+    outfile None only writes the error lines (ex. for --stats-only)
+    the pairs are counted by mergeStatistics.addResults, not here
+    '''
+    outlines = []
+    for (outline, errorline, status) in batchresults:
+        if (status == PAIR_FAILED and errorfile is not None):
+            errorfile.write(errorline + "\n")
+        outlines.append(outline)
+    if (outfile is not None):
+        writeBatch(outfile, outlines, binary)
+
+
+def processShard(shard):
+    '''
+    function returns a dict with the results of merging the reads of one region of an indexed BAM file
+    this is the unit of work for the worker processes of the sharded mode
+    shard is a dict with the input file, the region (refid, start, end, offset) and the settings
+    the output and the error lines are written to temporary files, the names are in the result
+    reads of which the mate is not in the region are not written, their sam lines are returned as leftovers
+    (except the reads which cannot overlap their mate: their names are returned as passed, for the mates which cannot know it)
+    the mergeStatistics of the region are in the result, the counts of the caches separately (cachecounts, see cacheCounts)
+    '''
+    reader = bamFile.bamReader(open(shard["input"], "rb"), 0)
+    (refid, start, end, offset) = shard["region"]
+    cachecounts = cacheCounts()
+    profile = None
+    if (shard["profile"]):
+        profile = runProfile.runProfile()
+    statistics = mergeStatistics(shard["failures"])
+    previousSamReads = mateBuffer.mateBuffer(shard["maxbuffermemory"], shard["tmpdir"])
+    leftovers = []
+    passed = set()
+    items = readItems(reader.fetch(offset, refid, start, end), statistics.counts, False, previousSamReads, "coordinate", profile, leftovers, passed)
+    (handle, outputname) = tempfile.mkstemp(prefix="aftermerge.", suffix=".shard.sam", dir=shard["tmpdir"])
+    output = os.fdopen(handle, "w")
+    errorname = None
+    error = None
+    if (shard["errors"]):
+        (handle, errorname) = tempfile.mkstemp(prefix="aftermerge.", suffix=".shard.bed", dir=shard["tmpdir"])
+        error = os.fdopen(handle, "w")
+    for batch in batches(items, shard["batchsize"]):
+        batchresults = processBatch(batch, profile, shard["blacklist"], shard["consensus"])
+        if (profile is not None):
+            profile.switch("output")
+        statistics.addResults(batchresults)
+        writeResults(batchresults, output, error)
+    output.close()
+    if (error is not None):
+        error.close()
+    reader.close()
+    if (profile is not None):
+        profile.stop()
+    statistics.addBuffer(previousSamReads)
+    return {"region": shard["region"], "cachecounts": cacheCountsSince(cachecounts), "output": outputname, "errors": errorname,
+            "statistics": statistics, "leftovers": leftovers, "passed": passed, "profile": profile}
+
+
+def copyShardFile(name, outfile, binary=False):
+    '''
+    append a temporary file of a shard to outfile, and remove it
+    '''
+    mode = "r"
+    if (binary):
+        mode = "rb"
+    with open(name, mode) as shardfile:
+        while (True):
+            data = shardfile.read(1024 * 1024)
+            if (len(data) == 0):
+                break
+            outfile.write(data)
+    os.remove(name)
+
+
+def processShards(path, regions, threads, outfile, errorfile, statistics, settings, profile=None, verbose=False, references=()):
+    '''
+    function returns the statistics per region (list of dicts), merging the regions of an indexed BAM file (from bamIndex.shardRegions) in parallel
+    the output of the regions is written in reference order, so in the order of the regions
+    a pair with the mates in different regions is merged when the region of its second mate is done, and written after it
+    reads of which the mate is in no region are written at the end
+    statistics is the mergeStatistics of the whole file, the statistics of the regions are added to it
+    settings has the batchsize, maxbuffermemory, tmpdir, blacklist and consensus of the workers, and binary (outfile takes bytes)
+    '''
+    shards = [{"input": path, "region": region, "errors": errorfile is not None, "profile": profile is not None, "failures": statistics.failures is not None,
+               "batchsize": settings["batchsize"], "maxbuffermemory": settings["maxbuffermemory"], "tmpdir": settings["tmpdir"],
+               "blacklist": settings["blacklist"], "consensus": settings["consensus"]}
+              for region in regions]
+    cachecounts = cacheCounts()
+    pool = None
+    if (threads > 1):
+        pool = multiprocessing.Pool(threads, initCaches, (samRead.cigarCacheSize(), mergeCacheSize()))
+        shardresults = pool.imap(processShard, shards)
+    else:
+        shardresults = map(processShard, shards)
+    #reads of which the mate is in another region, paired as in readItems (in region order, so without giving up on a mate)
+    previousSamReads = mateBuffer.mateBuffer(settings["maxbuffermemory"], settings["tmpdir"])
+    pairing = mateBuffer.matePairing(previousSamReads, statistics.counts)
+    statistics.buffer = previousSamReads
+    statistics.counts["input_order"] = "coordinate"
+    results = []
+    try:
+        while (True):
+            if (profile is not None):
+                profile.switch("waiting")
+            shardresult = next(shardresults, None)
+            if (shardresult is None):
+                break
+            if (profile is not None):
+                profile.merge(shardresult["profile"])
+                profile.switch("output")
+            copyShardFile(shardresult["output"], outfile, settings["binary"])
+            if (shardresult["errors"] is not None):
+                copyShardFile(shardresult["errors"], errorfile)
+            if (pool is not None):
+                #without pool the regions are merged in this process, and the caches are those of this process
+                statistics.addCacheCounts(shardresult["cachecounts"])
+            #pair the reads of which the mate was not in the region
+            if (profile is not None):
+                profile.switch("pairing")
+            pairs = []
+            for line in shardresult["leftovers"]:
+                samread = samRead.samRead(line)
+                (decision, materead) = pairing.pair(samread, samread.qname)
+                if (decision == mateBuffer.PAIRING_MATE):
+                    pairs.append((samread, materead))
+                elif (decision == mateBuffer.PAIRING_WRITE):
+                    #the mate is written already, as it cannot overlap
+                    pairs.append(samread.simpleline)
+            #names of the reads written by their region of which the mate is in another region, and cannot overlap
+            pairing.passed.update(shardresult["passed"])
+            pairsresults = processBatch(pairs, profile, settings["blacklist"], settings["consensus"])
+            writeResults(pairsresults, outfile, errorfile, settings["binary"])
+            regionstatistics = shardresult["statistics"]
+            regionstatistics.addResults(pairsresults)
+            statistics.merge(regionstatistics)
+            (refid, start, end, offset) = shardresult["region"]
+            results.append({"reference": references[refid][0] if refid >= 0 else "*", "start": start, "end": end,
+                            "total_reads": regionstatistics.counts["total_reads"], "merged_pairs": regionstatistics.merged,
+                            "failed_merges": regionstatistics.failed, "blacklisted_pairs": regionstatistics.blacklisted,
+                            "peak_reads_waiting_for_mate": regionstatistics.peakwaiting,
+                            "peak_memory_waiting_for_mate": regionstatistics.peakmemory, "reads_spilled_to_disk": regionstatistics.spilled})
+            if (verbose):
+                region = "reads without position"
+                if (refid >= 0):
+                    region = "{}:{}-{}".format(results[-1]["reference"], start + 1, end or "end")
+                eprint("Region {}: {} reads, {} merged pairs, {} failed merges".format(region, results[-1]["total_reads"],
+                       results[-1]["merged_pairs"], results[-1]["failed_merges"]))
+        #reads of which the mate is in no region, and mates of which one was spilled to disk
+        items = [leftOver if isinstance(leftOver, tuple) else leftOver.simpleline for leftOver in previousSamReads.leftovers()]
+        for batch in batches(items, settings["batchsize"]):
+            batchresults = processBatch(batch, profile, settings["blacklist"], settings["consensus"])
+            statistics.addResults(batchresults)
+            writeResults(batchresults, outfile, errorfile, settings["binary"])
+    finally:
+        if (pool is not None):
+            pool.terminate()
+    statistics.buffer = None
+    statistics.addBuffer(previousSamReads)
+    statistics.addCacheCounts(cacheCountsSince(cachecounts))
+    return results
+
+
+def sampleError(exception):
+    '''
+    function returns the error message of a failed sample on one line (for the table), with the type of the exception
+    '''
+    return " ".join("{}: {}".format(type(exception).__name__, exception).split())
+
+
+def processSample(sample):
+    '''
+    function returns a dict with the results of merging one sample of a manifest
+    this is the unit of work for the worker processes of the batch mode, a sample is merged as a single run without workers
+    sample is a dict with the input, output and error file, its index in the manifest and the settings
+    the result has the index, the mergeStatistics of the sample, the seconds it took, and the error message if it failed (None: merged)
+    the output and error file of a failed sample are removed (a truncated output is not mistaken for a merged sample)
+    '''
+    settings = sample["settings"]
+    starttime = time.perf_counter()
+    statistics = mergeStatistics()
+    (infile, outfile, errorfile) = (None, None, None)
+    #the files made by this sample, removed if it fails
+    created = []
+    error = None
+    try:
+        (infile, inputisbam) = bamFile.openInput(sample["input"], settings["bgzfthreads"], settings["binary"], settings["readbuffer"])
+        outputformat = settings["outputformat"]
+        if (outputformat is None):
+            outputformat = "sam"
+            if (bamFile.isBam(sample["output"])):
+                outputformat = "bam"
+        outfile = bamFile.openOutput(sample["output"], outputformat, settings["bgzfthreads"], settings["binary"], settings["writebuffer"])
+        created.append(sample["output"])
+        if (settings["reorderwindow"] is not None):
+            outfile = sortedOutput.reorderWriter(outfile, settings["reorderwindow"], settings["inputorder"])
+        if (sample["error"] is not None):
+            errorfile = open(sample["error"], "w")
+            created.append(sample["error"])
+        for batchresults in mergeBatches(infile, statistics, 1, settings["batchsize"], settings["inputorder"], settings["blacklist"], settings["consensus"],
+                                         settings["maxbuffermemory"], settings["tmpdir"]):
+            writeResults(batchresults, outfile, errorfile, settings["binary"])
+    except Exception as e:
+        #whatever goes wrong (ex. a malformed sam line), only this sample fails
+        error = sampleError(e)
+    finally:
+        for openfile in (infile, outfile, errorfile):
+            if (openfile is not None):
+                try:
+                    openfile.close()
+                except Exception as e:
+                    error = error or sampleError(e)
+        if (error is not None):
+            for path in created:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    return {"index": sample["index"], "statistics": statistics, "seconds": time.perf_counter() - starttime, "error": error}
+
+
+def processSamples(samples, threads, statistics, settings, verbose=False):
+    '''
+    function returns the results of processSample for the samples of a manifest (from sampleManifest.readManifest), in the order of the manifest
+    the samples are merged in one pool of threads worker processes, one sample per worker at a time, the largest input first
+    (so a large sample does not start last), with one thread the samples are merged in this process
+    statistics is the mergeStatistics of all samples, the statistics of the merged samples (without error) are added to it
+    settings has the settings of processSample
+    '''
+    tasks = [dict(sample, index=index, settings=settings) for (index, sample) in enumerate(samples)]
+    tasks.sort(key=lambda task: -os.path.getsize(task["input"]))
+    pool = None
+    if (threads > 1):
+        pool = multiprocessing.Pool(threads, initCaches, (samRead.cigarCacheSize(), mergeCacheSize()))
+        sampleresults = pool.imap_unordered(processSample, tasks)
+    else:
+        sampleresults = map(processSample, tasks)
+    results = [None] * len(tasks)
+    try:
+        for (number, result) in enumerate(sampleresults, 1):
+            results[result["index"]] = result
+            #the cigar caches are counted in the statistics of the samples (by mergeBatches)
+            #a failed sample has no output, so its reads are not in the total
+            if (result["error"] is None):
+                statistics.merge(result["statistics"])
+            if (verbose):
+                status = "done"
+                if (result["error"] is not None):
+                    status = "failed: {}".format(result["error"])
+                eprint("Sample {} of {} {}: {}".format(number, len(tasks), status, samples[result["index"]]["input"]))
+    finally:
+        if (pool is not None):
+            pool.terminate()
+    return results
+
+
+#the memory mapped input of a worker process of the chunked mode
+workerMap = None
+
+
+def initChunkWorker(path, blacklist, consensus="scalar", cigarcachesize=None, mergecachesize=None):
+    '''
+    set the memory mapped input, blacklist and consensus of a worker process of the chunked mode
+    cigarcachesize and mergecachesize None keep the caches as they are (when the chunks are parsed by the main process)
+    '''
+    global workerMap, workerBlacklist, workerConsensus, workerCacheCounts
+    workerMap = samChunks.mapFile(path)
+    workerBlacklist = blacklist
+    workerConsensus = consensus
+    if (cigarcachesize is not None):
+        initCaches(cigarcachesize, mergecachesize)
+    workerCacheCounts = cacheCounts()
+
+
+def processChunk(chunk, profiling=False):
+    '''
+    function returns (items, counts, profile, cachecounts) for a chunk (start, end) of the memory mapped sam file
+    this is the unit of work for the worker processes of the chunked mode
+    the reads are classified and the mates in the chunk are paired and merged, as in readItems
+    items has per line of the chunk: the line to write (bytes) for a header line or a read that cannot be merged,
+    and for a read that can be merged (qname, start, end, matestart, result, matewhere, rname, pos, pnext): the offsets of the read in the file,
+    the offset of the read in the chunk it is paired with (-1: none), the result of merging them (as from processBatch, None: not paired),
+    where the mate is (from mateBuffer.predictMate) and the positions of the read and its mate
+    whether these pairs are right is checked by processChunks, which pairs the reads of all chunks
+    '''
+    global workerCacheCounts
+    profile = None
+    if (profiling):
+        profile = runProfile.runProfile()
+        profile.switch("parsing")
+    (start, end) = chunk
+    counts = {"total_reads": 0, "mapped_reads": 0, "unmapped_reads": 0}
+    items = []
+    #per read name: (start, samread) of the read waiting for its mate
+    waiting = {}
+    pairs = []
+    pairindexes = []
+    lines = workerMap[start:end].split(b"\n")
+    if (lines[-1] == b""):
+        #the chunk ends with a newline
+        lines.pop()
+    offset = start
+    for line in lines:
+        linestart = offset
+        offset = offset + len(line) + 1
+        line = line.rstrip()
+        if (line[:1] == b"@"):
+            items.append(line)
+            continue
+        counts["total_reads"] = counts["total_reads"] + 1
+        flag = int(line.split(b"\t", 2)[1])
+        if (flag & samRead.FLAG_UNMAPPED == 0):
+            counts["mapped_reads"] = counts["mapped_reads"] + 1
+        else:
+            counts["unmapped_reads"] = counts["unmapped_reads"] + 1
+        if (not samRead.isMergeCandidate(flag)):
+            items.append(samRead.simpleLine(line, b"\t"))
+            continue
+        qname = line[:line.find(b"\t")]
+        samread = samRead.samRead(line.decode("ascii"))
+        matewhere = mateBuffer.predictMate(samread)
+        mate = waiting.pop(qname, None)
+        if (mate is None):
+            if (matewhere != mateBuffer.MATE_ELSEWHERE and matewhere != mateBuffer.MATE_AFTER):
+                waiting[qname] = (linestart, samread)
+            items.append((qname, linestart, offset, -1, None, matewhere, samread.rname, samread.pos, int(samread.pnext)))
+        else:
+            pairs.append((samread, mate[1]))
+            pairindexes.append(len(items))
+            items.append((qname, linestart, offset, mate[0], None, matewhere, samread.rname, samread.pos, int(samread.pnext)))
+    for (index, result) in zip(pairindexes, processBatch(pairs, profile, workerBlacklist, workerConsensus)):
+        items[index] = items[index][:4] + (result,) + items[index][5:]
+    if (profile is not None):
+        profile.stop()
+    cachecounts = cacheCountsSince(workerCacheCounts)
+    workerCacheCounts = cacheCounts()
+    return (items, counts, profile, cachecounts)
+
+
+def processChunks(path, threads, outfile, errorfile, statistics, settings, profile=None, verbose=False):
+    '''
+    merge a sam file on disk, memory mapped and split in chunks which are parsed by the workers (from samChunks.chunkRanges)
+    the output and the statistics are the same as those of merging the file in one process:
+    the reads of all chunks are paired here again by name in input order, only using the read names and offsets,
+    and a pair that is not the pair made by the worker (ex. the mates are in different chunks) is read from the file and merged here
+    the reads waiting for their mate are kept as offsets in the file, so they are never spilled to disk
+    settings has the chunksize (in bytes), inputorder, batchsize, blacklist and consensus, outfile takes bytes
+    '''
+    data = samChunks.mapFile(path)
+    (headerlines, recordsoffset) = samChunks.headerLines(data)
+    writeBatch(outfile, headerlines, True)
+    inputorder = settings["inputorder"]
+    for line in headerlines:
+        if (inputorder == "auto" and line.startswith(b"@HD")):
+            inputorder = inputOrderFromHeader(line.decode("ascii")) or "auto"
+    if (inputorder == "auto"):
+        #input from the mapper without sort order is in name order
+        inputorder = "name"
+    ranges = samChunks.chunkRanges(data, recordsoffset, settings["chunksize"])
+    if (len(ranges) > 0):
+        statistics.counts["input_order"] = inputorder
+    cachecounts = cacheCounts()
+    pool = None
+    if (threads > 1):
+        pool = multiprocessing.Pool(threads, initChunkWorker, (path, settings["blacklist"], settings["consensus"], samRead.cigarCacheSize(), mergeCacheSize()))
+    else:
+        initChunkWorker(path, settings["blacklist"], settings["consensus"])
+    def chunkResults():
+        if (pool is None):
+            for chunk in ranges:
+                if (profile is not None):
+                    #the time of the chunk is in its own profile
+                    profile.stop()
+                yield processChunk(chunk, profile is not None)
+            return
+        def result(asyncresult):
+            if (profile is not None):
+                profile.switch("waiting")
+            return asyncresult.get()
+        #only a limited number of chunks in flight, as in processInPool
+        inflight = deque()
+        for chunk in ranges:
+            inflight.append(pool.apply_async(processChunk, (chunk, profile is not None)))
+            if (len(inflight) >= threads * 2):
+                yield result(inflight.popleft())
+        while (len(inflight) > 0):
+            yield result(inflight.popleft())
+    #the reads waiting for their mate by name, as (qname, start, end), paired as in readItems
+    buffer = mateBuffer.nameBuffer()
+    statistics.buffer = buffer
+    pairing = mateBuffer.matePairing(buffer, statistics.counts, inputorder)
+    try:
+        for (number, (items, counts, chunkprofile, chunkcachecounts)) in enumerate(chunkResults(), 1):
+            if (profile is not None):
+                profile.merge(chunkprofile)
+                profile.switch("pairing")
+            if (pool is not None):
+                #without pool the chunks are parsed in this process, and the caches are those of this process
+                statistics.addCacheCounts(chunkcachecounts)
+            for (key, count) in counts.items():
+                statistics.counts[key] = statistics.counts[key] + count
+            batchresults = []
+            #pairs not made by the worker: (index in batchresults, read, mate)
+            otherpairs = []
+            for item in items:
+                if (isinstance(item, bytes)):
+                    batchresults.append((item, None, None))
+                    continue
+                (qname, start, end, matestart, result, matewhere, rname, pos, pnext) = item
+                for (name, waitingstart, waitingend) in pairing.giveUp(rname, pos):
+                    batchresults.append((samRead.simpleLine(data[waitingstart:waitingend].rstrip(), b"\t"), None, None))
+                (decision, mate) = pairing.pair((qname, start, end), qname, matewhere, pnext)
+                if (decision == mateBuffer.PAIRING_WRITE):
+                    batchresults.append((samRead.simpleLine(data[start:end].rstrip(), b"\t"), None, None))
+                    continue
+                if (decision == mateBuffer.PAIRING_WAIT):
+                    continue
+                if (mate[1] == matestart):
+                    batchresults.append(result)
+                else:
+                    otherpairs.append((len(batchresults), (start, end), mate[1:]))
+                    batchresults.append(None)
+            if (len(otherpairs) > 0):
+                pairs = [(samRead.samRead(data[start:end].rstrip().decode("ascii")), samRead.samRead(data[matestart:mateend].rstrip().decode("ascii")))
+                         for (index, (start, end), (matestart, mateend)) in otherpairs]
+                for ((index, read, mate), result) in zip(otherpairs, processBatch(pairs, profile, settings["blacklist"], settings["consensus"])):
+                    batchresults[index] = result
+            statistics.addResults(batchresults)
+            if (profile is not None):
+                profile.switch("output")
+            writeResults(batchresults, outfile, errorfile, True)
+            if (verbose):
+                eprint("Chunk {} of {}: {} reads, {} reads waiting for mate".format(number, len(ranges), counts["total_reads"], len(buffer)))
+    finally:
+        if (pool is not None):
+            pool.terminate()
+    pairing.finish()
+    #reads of which the mate was never seen, in input order
+    leftovers = [(samRead.simpleLine(data[start:end].rstrip(), b"\t"), None, None) for (qname, start, end) in buffer.leftovers()]
+    statistics.buffer = None
+    statistics.addBuffer(buffer)
+    for batch in batches(leftovers, settings["batchsize"]):
+        writeResults(batch, outfile, errorfile, True)
+    data.close()
+    statistics.addCacheCounts(cacheCountsSince(cachecounts))
+
+
+def writeBatch(outfile, outlines, binary=False):
+    '''
+    write the lines of a batch with a single write
+    binary is True when outfile takes bytes, the lines in str are then encoded
+    '''
+    if (len(outlines) == 0):
+        return
+    if (binary):
+        outfile.write(b"\n".join([outline if isinstance(outline, bytes) else outline.encode("ascii") for outline in outlines]) + b"\n")
+    else:
+        outfile.write("\n".join(outlines) + "\n")
 
-    
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -125,149 +1319,381 @@ if __name__ == '__main__':
     parser = ArgumentParser(description='aftermerge v1.0 merging reads based on the mapping information')
     parser.add_argument('-v', '--verbose', action="store_true")
     parser.add_argument('-error', help="The error file", type=FileType('w'), dest="errorfile", default=None)
-    parser.add_argument('infile', nargs='?', type=FileType('r'), default=sys.stdin)
-    parser.add_argument('outfile', nargs='?', type=FileType('w'), default=sys.stdout)
+    parser.add_argument('-blacklist', help="Bed file with regions in which no pairs are merged (ex. the mis-assemblies of the reference found in the error file)", default=None)
+    parser.add_argument('-t', '--threads', help="Number of worker processes merging the pairs (default 1: no workers)", type=int, default=1)
+    parser.add_argument('--batch-size', help="Number of records send to a worker at once (default 1000)", type=int, default=1000, dest="batchsize")
+    parser.add_argument('-O', '--output-format', help="Format of the output: sam, bam or ubam (uncompressed BAM) (default: bam if the output file ends on .bam, otherwise sam)", choices=["sam", "bam", "ubam"], default=None, dest="outputformat")
+    parser.add_argument('--bgzf-threads', help="Number of threads compressing or decompressing BAM blocks (default 1, 0: no extra threads)", type=int, default=1, dest="bgzfthreads")
+    parser.add_argument('--max-buffer-memory', help="Maximum memory (in MB) of the reads waiting for their mate, older reads are spilled to disk (default: no maximum)", type=float, default=None, dest="maxbuffermemory")
+    parser.add_argument('--tmpdir', help="Directory for the reads spilled to disk (default: the system temporary directory)", default=None)
+    parser.add_argument('--input-order', help="Order of the input: name (mates next to each other, as from the mapper), coordinate, unsorted or auto (from the @HD header: name, unless sorted on coordinate) (default auto)",
+                        choices=["auto", "name", "coordinate", "unsorted"], default="auto", dest="inputorder")
+    parser.add_argument('--stats-json', help="Write the statistics and a profile of the run (time per stage, overlap lengths, causes of failed merges) as json to this file", default=None, dest="statsjson")
+    parser.add_argument('--binary-io', help="Read and write sam as bytes: the lines that are written as is are not decoded", action="store_true", dest="binaryio")
+    parser.add_argument('--read-buffer', help="Size (in kB) of the input buffer (default 1024)", type=int, default=1024, dest="readbuffer")
+    parser.add_argument('--write-buffer', help="Size (in kB) of the output buffer (default 1024)", type=int, default=1024, dest="writebuffer")
+    parser.add_argument('--consensus', help="Merging of the overlaps: scalar (one by one) or numpy (the overlaps with the same start and cigar of a batch at once, needs NumPy) (default scalar)",
+                        choices=["scalar", "numpy"], default="scalar")
+    parser.add_argument('--cigar-cache-size', help="Number of parsed cigar strings kept for reuse, per process (default {}, 0: no cache)".format(samRead.CIGAR_CACHE_SIZE),
+                        type=int, default=samRead.CIGAR_CACHE_SIZE, dest="cigarcachesize")
+    parser.add_argument('--merge-cache-size', help="Number of merged overlaps (by sequences, qualities, cigars and relative start) kept for reuse, per process, for libraries with many identical pairs (ex. amplicons) (default {}: no cache)".format(MERGE_CACHE_SIZE),
+                        type=int, default=MERGE_CACHE_SIZE, dest="mergecachesize")
+    parser.add_argument('--background-io', help="Read the input and write the output in background threads, the main thread only pairs and merges", action="store_true", dest="backgroundio")
+    parser.add_argument('--io-queue-size', help="Number of chunks of lines in the queues of the background threads (default 8)", type=int, default=8, dest="ioqueuesize")
+    parser.add_argument('--progress', help="Report the progress (reads/s, MB/s, merged and failed pairs, reads waiting for their mate, memory, time left) every this many seconds", type=float, default=None)
+    parser.add_argument('--metrics-file', help="Write the numbers of the progress report to this file in the textfile format of Prometheus (every --progress seconds, default 10)", default=None, dest="metricsfile")
+    parser.add_argument('--mmap', help="Memory map a sam file on disk and parse it in chunks by the workers (the output is the same as without)", action="store_true")
+    parser.add_argument('--chunk-size', help="Size (in MB) of the chunks of --mmap (default 16)", type=float, default=16, dest="chunksize")
+    parser.add_argument('--stats-only', help="Only give the statistics: the pairs are checked but not merged, and no output is written", action="store_true", dest="statsonly")
+    parser.add_argument('--sample-fraction', help="With --stats-only, only use this fraction of the reads (sampled by read name, so both mates are used or not), the rates are given with a 95%% confidence interval",
+                        type=float, default=None, dest="samplefraction")
+    parser.add_argument('--sort-output', help="Write the output in coordinate order, for an input sorted on coordinate: the records are held till the input is --reorder-window bases past them (@HD gets SO:coordinate)",
+                        action="store_true", dest="sortoutput")
+    parser.add_argument('--reorder-window', help="Number of bases the input can be past a record before it is written with --sort-output (default 10000)", type=int, default=10000, dest="reorderwindow")
+    parser.add_argument('--sharded', help="Merge the regions of an indexed BAM file sorted on coordinate in parallel (one region per worker at a time)", action="store_true")
+    parser.add_argument('--index', help="The index of the BAM file for --sharded (default: the .bai next to the input)", default=None)
+    parser.add_argument('--shards', help="Number of regions to split the genome in with --sharded (default 4 per thread)", type=int, default=None)
+    parser.add_argument('--manifest', help="Merge the samples of this file (one per line: the input, output and optional error file, separated by tabs) on one pool of --threads workers, one sample per worker at a time, instead of infile and outfile",
+                        default=None)
+    parser.add_argument('--batch-report', help="With --manifest, write the table with the statistics of each sample and the total to this file", default=None, dest="batchreport")
+    parser.add_argument('infile', nargs='?', help="The input sam or BAM file (BAM is detected on the content), - is stdin", default="-")
+    parser.add_argument('outfile', nargs='?', help="The output file, - is stdout", default="-")
     #parser.parse_args(['input.txt', 'output.txt']) 
-    #Namespace(infile=<_io.TextIOWrapper name='input.txt' encoding='UTF-8'>, outfile=<_io.TextIOWrapper name='output.txt' encoding='UTF-8'>)
+    #Namespace(infile='input.txt', outfile='output.txt')
     #parser.parse_args([]) 
-    #Namespace(infile=<_io.TextIOWrapper name='<stdin>' encoding='UTF-8'>, outfile=<_io.TextIOWrapper name='<stdout>' encoding='UTF-8'>)
+    #Namespace(infile='-', outfile='-')
     
     #parse the arguments, and set the default output directory 
     args = parser.parse_args()
+    if (args.threads < 1):
+        parser.error("--threads should be at least 1")
+    if (args.batchsize < 1):
+        parser.error("--batch-size should be at least 1")
+    if (args.bgzfthreads < 0):
+        parser.error("--bgzf-threads should be at least 0")
+    if (args.readbuffer < 1 or args.writebuffer < 1):
+        parser.error("--read-buffer and --write-buffer should be at least 1")
+    if (args.progress is not None and args.progress <= 0):
+        parser.error("--progress should be positive")
+    if (args.chunksize <= 0):
+        parser.error("--chunk-size should be positive")
+    if (args.mmap and args.sharded):
+        parser.error("--mmap and --sharded cannot be combined")
+    if (args.mmap and args.manifest is not None):
+        parser.error("--manifest cannot be combined with --mmap")
+    if (args.mmap and not samChunks.canMap(args.infile)):
+        parser.error("--mmap needs a sam file on disk as input")
+    if (args.mmap):
+        #the lines are read from the memory map as bytes
+        args.binaryio = True
+    if (args.samplefraction is not None and not args.statsonly):
+        parser.error("--sample-fraction needs --stats-only")
+    if (args.samplefraction is not None and not 0 < args.samplefraction <= 1):
+        parser.error("--sample-fraction should be above 0 and at most 1")
+    if (args.statsonly and (args.sharded or args.mmap)):
+        parser.error("--stats-only cannot be combined with --sharded or --mmap")
+    if (args.reorderwindow < 0):
+        parser.error("--reorder-window should be at least 0")
+    if (args.sortoutput and args.inputorder not in ("auto", "coordinate")):
+        parser.error("--sort-output needs an input sorted on coordinate")
+    if (args.sortoutput and args.statsonly):
+        parser.error("--sort-output cannot be combined with --stats-only")
+    if (args.ioqueuesize < 1):
+        parser.error("--io-queue-size should be at least 1")
+    if (args.maxbuffermemory is not None and args.maxbuffermemory <= 0):
+        parser.error("--max-buffer-memory should be positive")
+    if (args.consensus == "numpy" and not batchConsensus.available()):
+        eprint("NumPy is not installed, the overlaps are merged one by one")
+        args.consensus = "scalar"
+    if (args.cigarcachesize < 0):
+        parser.error("--cigar-cache-size should be at least 0")
+    samRead.setCigarCacheSize(args.cigarcachesize)
+    if (args.mergecachesize < 0):
+        parser.error("--merge-cache-size should be at least 0")
+    setMergeCacheSize(args.mergecachesize)
+    if (args.shards is None):
+        args.shards = 4 * args.threads
+    if (args.shards < 1):
+        parser.error("--shards should be at least 1")
+    if (args.batchreport is not None and args.manifest is None):
+        parser.error("--batch-report needs --manifest")
+    if (args.manifest is not None):
+        #batch mode: each sample is merged as a single run by a worker
+        if (args.infile != "-" or args.outfile != "-" or args.errorfile is not None):
+            parser.error("--manifest gives the input, output and error files, they cannot be given as arguments")
+        for (option, used) in (("--sharded", args.sharded), ("--background-io", args.backgroundio), ("--progress", args.progress is not None),
+                               ("--metrics-file", args.metricsfile is not None), ("--stats-only", args.statsonly), ("--sample-fraction", args.samplefraction is not None)):
+            if (used):
+                parser.error("--manifest cannot be combined with {}".format(option))
+        try:
+            samples = sampleManifest.readManifest(args.manifest)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if (len(samples) == 0):
+            parser.error("no samples in {}".format(args.manifest))
+        for sample in samples:
+            if (not os.path.isfile(sample["input"])):
+                parser.error("input file {} of {} not found".format(sample["input"], args.manifest))
+        blacklist = None
+        if (args.blacklist is not None):
+            try:
+                blacklist = intervalIndex.readBed(args.blacklist)
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+        if args.verbose:
+            eprint("Manifest: {} ({} samples)".format(args.manifest, len(samples)))
+            eprint("Threads: {}".format(args.threads))
+        maxbuffermemory = None
+        if (args.maxbuffermemory is not None):
+            maxbuffermemory = int(args.maxbuffermemory * 1024 * 1024)
+        reorderwindow = None
+        if (args.sortoutput):
+            reorderwindow = args.reorderwindow
+        settings = {"batchsize": args.batchsize, "inputorder": args.inputorder, "blacklist": blacklist, "consensus": args.consensus,
+                    "maxbuffermemory": maxbuffermemory, "tmpdir": args.tmpdir, "binary": args.binaryio, "outputformat": args.outputformat,
+                    "bgzfthreads": args.bgzfthreads, "readbuffer": args.readbuffer * 1024, "writebuffer": args.writebuffer * 1024, "reorderwindow": reorderwindow}
+        starttime = time.perf_counter()
+        statistics = mergeStatistics()
+        sampleresults = processSamples(samples, args.threads, statistics, settings, args.verbose)
+        walltime = time.perf_counter() - starttime
+        rows = []
+        for (sample, result) in zip(samples, sampleresults):
+            status = "ok"
+            if (result["error"] is not None):
+                status = "failed: {}".format(result["error"])
+                eprint("Sample {} failed: {}".format(sample["input"], result["error"]))
+            rows.append(sampleManifest.tableRow(sample["input"], result["statistics"], result["seconds"], status))
+        failed = sum(1 for result in sampleresults if result["error"] is not None)
+        status = "ok"
+        if (failed > 0):
+            status = "{} failed".format(failed)
+        rows.append(sampleManifest.tableRow("total", statistics, walltime, status))
+        table = sampleManifest.formatTable(rows, blacklist is not None)
+        eprint("Statistics:")
+        eprint(table, end="")
+        if (args.batchreport is not None):
+            with open(args.batchreport, "w") as report:
+                report.write(table)
+        if (args.statsjson is not None):
+            report = {"manifest": args.manifest, "threads": args.threads, "wall_seconds": round(walltime, 6), "samples": [], "total": statistics.toDict()}
+            for (sample, result) in zip(samples, sampleresults):
+                report["samples"].append(dict(sample, seconds=round(result["seconds"], 6), error=result["error"], statistics=result["statistics"].toDict()))
+            with open(args.statsjson, "w") as jsonfile:
+                json.dump(report, jsonfile, indent=2)
+                jsonfile.write("\n")
+        sys.exit(int(failed > 0))
+    if (args.outputformat is None):
+        args.outputformat = "sam"
+        if (bamFile.isBam(args.outfile)):
+            args.outputformat = "bam"
     #if verbose, print the parameters
     if args.verbose:
         eprint("Verbose: {}".format(args.verbose))
         eprint("Input: {}".format(args.infile))
-        eprint("Output: {}".format(args.outfile))
+        eprint("Output: {} ({})".format(args.outfile, args.outputformat))
         eprint("Error file: {}".format(args.errorfile))
+        eprint("Threads: {}".format(args.threads))
         
-    #infile = open(args.infile.name)
-    infile = args.infile
-    outfile = args.outfile
-    if (args.errorfile is not None):
-        errorfile = args.errorfile
-    #outfile = open(args.outfile.name, 'w')
-    unmapped_reads = 0
-    mapped_reads = 0
-    merged_pairs = 0
-    total_reads = 0
-    previousLines = {}
-    previousSamReads = {}
-    different=0
-    processed_lines=0
-    for line in infile:
-        processed_lines=processed_lines+1
-        if (args.verbose and processed_lines%100000==0):
-            eprint("Processed {} lines".format(processed_lines))
-        line = line.rstrip()
-        outline = None
-        if (line.startswith("@")):
-            #header
-            outline = line
+    reporter = None
+    wrapraw = None
+    if (args.progress is not None or args.metricsfile is not None):
+        #made before the input is opened, as the input is read through it to count the bytes
+        output = None
+        if (args.progress is not None):
+            output = sys.stderr
+        reporter = progressReport.progressReporter(args.progress or 10, progressReport.inputSize(args.infile), args.metricsfile, args.infile, output)
+        wrapraw = reporter.countInput
+    try:
+        (infile, inputisbam) = bamFile.openInput(args.infile, args.bgzfthreads, args.binaryio, args.readbuffer * 1024, wrapraw)
+        outfile = None
+        if (not args.statsonly):
+            outfile = bamFile.openOutput(args.outfile, args.outputformat, args.bgzfthreads, args.binaryio, args.writebuffer * 1024)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.verbose:
+        eprint("Input is BAM: {}".format(inputisbam))
+    errorfile = args.errorfile
+    blacklist = None
+    if (args.blacklist is not None):
+        try:
+            blacklist = intervalIndex.readBed(args.blacklist)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if args.verbose:
+            eprint("Blacklist: {} ({} regions)".format(args.blacklist, len(blacklist)))
+    if (args.mmap and inputisbam):
+        parser.error("--mmap needs a sam file as input, not BAM")
+    regions = None
+    if (args.sharded):
+        #sharded: the reads of the regions are read by the workers, using the index
+        if (not inputisbam or args.infile == "-"):
+            parser.error("--sharded needs a BAM file as input")
+        headerlines = infile.headerLines()
+        if (not any(line.startswith("@HD") and inputOrderFromHeader(line) == "coordinate" for line in headerlines)):
+            parser.error("--sharded needs a BAM file sorted on coordinate (@HD SO:coordinate)")
+        if (args.index is None):
+            args.index = bamIndex.findIndex(args.infile)
+            if (args.index is None):
+                parser.error("no index found for {}, make one with samtools index".format(args.infile))
+        try:
+            index = bamIndex.bamIndex(args.index)
+        except (OSError, ValueError, struct.error) as e:
+            parser.error("cannot read the index {}: {}".format(args.index, e))
+        if (len(index.begin) != len(infile.references)):
+            parser.error("the index {} is not an index of {}".format(args.index, args.infile))
+        regions = bamIndex.shardRegions(index, args.shards, infile.recordsOffset)
+        if args.verbose:
+            eprint("Index: {} ({} regions)".format(args.index, len(regions)))
+    reorder = None
+    if (args.sortoutput):
+        if (inputisbam and args.inputorder == "auto" and not sortedOutput.headerIsSorted(infile.headerLines())):
+            parser.error("--sort-output needs an input sorted on coordinate (SO:coordinate in the @HD header line, or --input-order coordinate)")
+        reorder = sortedOutput.reorderWriter(outfile, args.reorderwindow, args.inputorder)
+        outfile = reorder
+    if (args.backgroundio):
+        #the input of the sharded and the chunked mode is read by the workers
+        #(with --sort-output the records are put in order by the thread writing the output)
+        if (regions is None and not args.mmap):
+            infile = backgroundIO.backgroundReader(infile, args.ioqueuesize, args.batchsize, args.readbuffer * 1024)
+        if (outfile is not None):
+            outfile = backgroundIO.backgroundWriter(outfile, args.ioqueuesize)
+    starttime = time.perf_counter()
+    profile = None
+    if (args.statsjson is not None):
+        profile = runProfile.runProfile()
+    statistics = mergeStatistics()
+    if (reporter is not None):
+        reporter.start(statistics, regions is None and not args.mmap)
+    maxbuffermemory = None
+    if (args.maxbuffermemory is not None):
+        maxbuffermemory = int(args.maxbuffermemory * 1024 * 1024)
+    shardresults = None
+    try:
+        if (regions is not None):
+            #the regions are read and merged by the workers, their output is written here in reference order
+            writeBatch(outfile, headerlines, args.binaryio)
+            settings = {"batchsize": args.batchsize, "maxbuffermemory": maxbuffermemory, "tmpdir": args.tmpdir, "binary": args.binaryio, "blacklist": blacklist,
+                        "consensus": args.consensus}
+            shardresults = processShards(args.infile, regions, args.threads, outfile, errorfile, statistics, settings, profile, args.verbose, infile.references)
+        elif (args.mmap):
+            #the chunks are parsed by the workers, the reads are paired over the chunks here
+            settings = {"chunksize": int(args.chunksize * 1024 * 1024), "inputorder": args.inputorder, "batchsize": args.batchsize,
+                        "blacklist": blacklist, "consensus": args.consensus}
+            processChunks(args.infile, args.threads, outfile, errorfile, statistics, settings, profile, args.verbose)
         else:
-            total_reads = total_reads + 1
-            #is read
-            samread = samRead.samRead(line)
-            #counting for the statistics
-            if (samread.ismapped()):
-                mapped_reads = mapped_reads + 1
-            else:
-                unmapped_reads = unmapped_reads + 1
-            if (not samread.ispair()):
-                #not a paired read
-                outline = samread.simpleline
-            else:
-                #paired read
-                if (not samread.pairmapped()):
-                    #pair not mapped
-                    outline = samread.simpleline
-                elif (samread.isSecondaryAlignment()):
-                    #read is secondary
-                    outline = samread.simpleline
-                else:
-                    #read can be overlapping
-                    if (not samread.qname in previousSamReads):
-                        #mate of this read not seen yet
-                        previousSamReads[samread.qname] = samread
-                    else:
-                        #mate seen, so start processing
-                        materead = previousSamReads[samread.qname]
-                        materead.__class__ = samRead.samRead
-                        #remove from dict, to spare memory
-                        del previousSamReads[samread.qname]
-                        #start checking if overlapping
-                        if (not samread.isoverlapping(materead)):
-                            #no overlap, so do not fix
-                            outline = samread.simpleline + "\n" + materead.simpleline
-                        else:
-                            #overlapping, so fix
-                            #check which read is the first on the reference
-                            if (samread.pos > materead.pos):
-                                change = samread
-                                samread = materead
-                                materead = change
-                            #check if the cigar string of the overlap is the same,
-                            #and get the start of the overlap on the sequence, reference, cigar, matecigar, and length of the overlap
-                            (sameoverlapcigar, start, cigarstart, matecigarstart, length, refstart) = samread.overlapHasSameCigar(materead)
-                            if (sameoverlapcigar):
-                                #same cigar
-                                merged_pairs = merged_pairs + 1
-                                #get the overlapping sequence, quality and cigar for the first read
-                                seq1 = samread.seq[start:start+length]
-                                qual1 = samread.qual[start:start+length]
-                                mcigar1 = samread.longcigar()[cigarstart:cigarstart+length]
-                                #get the overlapping sequence, quality and cigar for the second read
-                                start2 = materead.startOfSeqOnRef()
-                                seq2 = materead.seq[start2:start2+length]
-                                qual2 = materead.qual[start2:start2+length]
-                                mcigar2 = materead.longcigar()[matecigarstart:matecigarstart+length]
-
-                                #get the new sequence for the overlap
-                                (newseq, newqual, newmcigar) = mergeSequences(seq1, seq2, qual1, qual2, mcigar1, mcigar2, refstart, materead.pos)
-                                
-                                #correct the new sequence, by adding the non overlapping parts
-                                newseq = "{}{}{}".format(samread.seq[0:start], newseq, materead.seq[start2+length:])
-                                newqual = "{}{}{}".format(samread.qual[0:start], newqual, materead.qual[start2+length:])
-                                newmcigar = "{}{}{}".format(samread.longcigar()[0:cigarstart], newmcigar, materead.longcigar()[matecigarstart+length:])
-                                #set flag on 0: forward mapped
-                                flag = 0
-                                #mapping quality is the mean of both mappings
-                                mapq = int((samread.mapq + materead.mapq)/2)
-                                cigar = samread.shortcigar(newmcigar)
-                                outline = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}".format(samread.qname, flag, samread.rname, samread.pos, mapq, cigar, "*", "0", "0", newseq, newqual)
-                                
-                            else:
-                                #different cigar, so overlap is probably an error => add line in error file
-                                errorline = "{}\t{}\t{}\t{}".format(samread.rname, refstart, refstart+length, samread.qname)
-                                if (args.errorfile is not None):
-                                    errorfile.write(errorline + "\n")
-                                different=different+1
-                                outline = samread.line + "\n" + materead.line
-        
-        if (outline is not None):
-            outfile.write(outline + "\n")
-            
-    for leftOverReadName in previousSamReads:
-        leftOverRead = previousSamReads[leftOverReadName]
-        leftOverRead.__class__ = samRead.samRead
-        outfile.write(leftOverRead.simpleline + "\n")
-            
-    infile.close()
-    outfile.close()
+            #the results are written in input order
+            lines = infile
+            if (args.samplefraction is not None):
+                lines = readSample.sampledLines(infile, args.samplefraction)
+            results = mergeBatches(lines, statistics, args.threads, args.batchsize, args.inputorder, blacklist, args.consensus,
+                                   maxbuffermemory, args.tmpdir, profile, args.verbose, args.statsonly)
+            for batchresults in results:
+                if (profile is not None):
+                    profile.switch("output")
+                writeResults(batchresults, outfile, errorfile, args.binaryio)
+
+        if (reporter is not None):
+            reporter.stop()
+        infile.close()
+        if (outfile is not None):
+            outfile.close()
+    except ValueError as e:
+        #an input of which the header does not say it is sorted on coordinate is only known at its first record
+        if (reorder is None or not reorder.refused):
+            raise
+        parser.error("--sort-output: {} (give --input-order coordinate if it is sorted)".format(e))
     if (args.errorfile is not None):
         errorfile.close()
+    if (profile is not None):
+        profile.stop()
     
-        
+    total_reads = statistics.counts["total_reads"]
+    unmapped_reads = statistics.counts["unmapped_reads"]
+    mapped_reads = statistics.counts["mapped_reads"]
+    merged_pairs = statistics.merged
+    different = statistics.failed
+    blacklisted_pairs = statistics.blacklisted
+    #the percentages are of the reads, 0 for an input without reads (ex. only a header)
+    reads = max(total_reads, 1)
     #print the statistics to the error output
     eprint("Statistics:")
-    eprint("{}\t{} ({}%)".format("Total reads", total_reads, (total_reads/total_reads)*100))
-    eprint("{}\t{} ({}%)".format("Unmapped reads", unmapped_reads, (unmapped_reads/total_reads)*100))
-    eprint("{}\t{} ({}%)".format("Mapped reads", mapped_reads, (mapped_reads/total_reads)*100))
-    eprint("{}\t{} ({}%)".format("Merged pairs", merged_pairs, ((merged_pairs*2)/total_reads)*100))
-    eprint("{}\t{} ({}%)".format("Failed merges pairs", different, ((different*2)/total_reads)*100))
-    
-     
-    
-    
-    
-    
+    eprint("{}\t{} ({}%)".format("Total reads", total_reads, (total_reads/reads)*100))
+    eprint("{}\t{} ({}%)".format("Unmapped reads", unmapped_reads, (unmapped_reads/reads)*100))
+    eprint("{}\t{} ({}%)".format("Mapped reads", mapped_reads, (mapped_reads/reads)*100))
+    eprint("{}\t{} ({}%)".format("Merged pairs", merged_pairs, ((merged_pairs*2)/reads)*100))
+    eprint("{}\t{} ({}%)".format("Failed merges pairs", different, ((different*2)/reads)*100))
+    if (blacklist is not None):
+        eprint("{}\t{} ({}%)".format("Blacklisted pairs", blacklisted_pairs, ((blacklisted_pairs*2)/reads)*100))
+    if args.verbose:
+        eprint("Input order: {}".format(statistics.counts.get("input_order", args.inputorder)))
+    if (statistics.counts.get("input_order") == "name"):
+        eprint("{}\t{}".format("Reads not next to their mate", statistics.counts["out_of_order"]))
+    eprint("{}\t{}".format("Reads written without waiting for their mate", statistics.counts["passed_through"]))
+    if (statistics.counts["gave_up"] > 0):
+        eprint("{}\t{}".format("Reads of which the mate was not at its position", statistics.counts["gave_up"]))
+    eprint("{}\t{}".format("Peak reads waiting for mate", statistics.peakwaiting))
+    if (maxbuffermemory is not None):
+        eprint("{}\t{} MB".format("Peak memory of reads waiting for mate", round(statistics.peakmemory / (1024 * 1024), 1)))
+        eprint("{}\t{}".format("Reads spilled to disk", statistics.spilled))
+    eprint("{}\t{}% ({} hits, {} misses)".format("Cigar cache hit rate", round(statistics.cigarHitRate() * 100, 1),
+           statistics.counts.get("cigar_cache_hits", 0), statistics.counts.get("cigar_cache_misses", 0)))
+    if (mergeCacheSize() > 0):
+        eprint("{}\t{}% ({} hits, {} misses, {} evictions)".format("Merge cache hit rate", round(statistics.mergeHitRate() * 100, 1),
+               statistics.counts.get("merge_cache_hits", 0), statistics.counts.get("merge_cache_misses", 0), statistics.counts.get("merge_cache_evictions", 0)))
+    if (reorder is not None):
+        eprint("{}\t{}".format("Peak records in the reorder window", reorder.peak))
+        eprint("{}\t{}".format("Records written out of order", reorder.late))
+        if (reorder.late > 0):
+            eprint("The output is not completely sorted: {} records came after the reorder window (mates further apart than the window, or an input not sorted on coordinate)".format(reorder.late))
+    intervals = {}
+    if (args.samplefraction is not None):
+        #the sampled unit is a pair, so the rates of the pairs are fractions of the pairs (half the reads)
+        eprint("{}\t{} ({} reads)".format("Sample fraction", args.samplefraction, total_reads))
+        pairs = total_reads / 2
+        for (name, key, count) in (("Merged pairs", "merged_pairs", merged_pairs), ("Failed merges pairs", "failed_merges", different),
+                                   ("Blacklisted pairs", "blacklisted_pairs", blacklisted_pairs)):
+            if (key == "blacklisted_pairs" and blacklist is None):
+                continue
+            (low, high) = readSample.wilsonInterval(count, pairs)
+            intervals[key] = [round(low * 100, 4), round(high * 100, 4)]
+            eprint("{} 95% CI\t{}% - {}%".format(name, round(low * 100, 2), round(high * 100, 2)))
+    ioqueues = {}
+    if (args.backgroundio):
+        #an input queue that is mostly empty: waiting for the input, an output queue that is mostly full: waiting for the output
+        if (isinstance(infile, backgroundIO.backgroundReader)):
+            ioqueues["input"] = infile.occupancy
+        if (outfile is not None):
+            ioqueues["output"] = outfile.occupancy
+    for (name, occupancy) in ioqueues.items():
+        waiting = "empty"
+        if (name == "output"):
+            waiting = "full"
+        eprint("{} queue\t{} of {} chunks on average ({} times {})".format(name.capitalize(), round(occupancy.average(), 1),
+               occupancy.queuesize, occupancy.waits, waiting))
+
+    if (profile is not None):
+        walltime = time.perf_counter() - starttime
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report = {
+            "input": args.infile,
+            "output": args.outfile,
+            "threads": args.threads,
+            "wall_seconds": round(walltime, 6),
+            "cpu_seconds": round(time.process_time() + children.ru_utime + children.ru_stime, 6),
+            "reads_per_second": round(total_reads / walltime, 1),
+        }
+        report.update(statistics.toDict())
+        if (args.statsonly):
+            report["stats_only"] = True
+        if (reorder is not None):
+            report["reorder_window"] = {"bases": args.reorderwindow, "peak_records": reorder.peak, "records_out_of_order": reorder.late}
+        if (args.samplefraction is not None):
+            report["sample_fraction"] = args.samplefraction
+            report["confidence_intervals_95_percent"] = intervals
+        if (len(ioqueues) > 0):
+            report["io_queues"] = {name: occupancy.toDict() for (name, occupancy) in ioqueues.items()}
+        if (shardresults is not None):
+            report["regions"] = shardresults
+        report.update(profile.toDict())
+        with open(args.statsjson, "w") as statsfile:
+            json.dump(report, statsfile, indent=2)
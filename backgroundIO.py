@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Reading of the input and writing of the output in background threads, so the main thread only pairs and merges.
+The threads and the main thread exchange chunks of lines through bounded queues: when the mapper before aftermerge
+or the program after it stalls, the main thread keeps working on what is in the queue.
+How full the queues were shows which side is the bottleneck: an input queue that is mostly empty means the main thread
+waits for the input, an output queue that is mostly full means it waits for the output.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import queue
+import threading
+
+
+#marks the end of the chunks in a queue
+_END = None
+
+
+class queueOccupancy:
+    '''
+    the occupancy of a queue, measured by the main thread every time it takes a chunk from it or puts one in it
+    '''
+
+    def __init__(self, queuesize):
+        self.queuesize = queuesize
+        self.chunks = 0
+        self.occupied = 0
+        #number of times the main thread had to wait: input queue empty, output queue full
+        self.waits = 0
+
+    def measure(self, tasks, wait):
+        self.chunks = self.chunks + 1
+        self.occupied = self.occupied + tasks
+        if (wait):
+            self.waits = self.waits + 1
+
+    def average(self):
+        '''
+        function returns the average number of chunks in the queue
+        '''
+        if (self.chunks == 0):
+            return 0.0
+        return self.occupied / self.chunks
+
+    def toDict(self):
+        '''
+        function returns the occupancy as dict, for the json report
+        '''
+        return {"queue_size": self.queuesize, "chunks": self.chunks, "average_occupancy": round(self.average(), 3), "main_thread_waits": self.waits}
+
+
+class backgroundReader:
+    '''
+    iterable over the lines of infile, read by a background thread in chunks
+    files with readlines (sam) are read with readlines(chunkbytes), otherwise (BAM) chunklines lines are taken per chunk
+    at most queuesize chunks are read ahead, occupancy is the queueOccupancy of the queue (waits: queue was empty)
+    '''
+
+    def __init__(self, infile, queuesize=8, chunklines=1000, chunkbytes=1024 * 1024):
+        self._infile = infile
+        self._queue = queue.Queue(queuesize)
+        self._chunklines = chunklines
+        self._chunkbytes = chunkbytes
+        self._error = None
+        self._closed = False
+        self.occupancy = queueOccupancy(queuesize)
+        #daemon: the thread does not keep the program alive when the input is not read to the end (ex. after an error)
+        self._thread = threading.Thread(target=self._read, name="aftermerge-reader", daemon=True)
+        self._thread.start()
+
+    def _chunks(self):
+        readlines = getattr(self._infile, "readlines", None)
+        if (readlines is not None):
+            while (True):
+                chunk = readlines(self._chunkbytes)
+                if (len(chunk) == 0):
+                    return
+                yield chunk
+        chunk = []
+        for line in self._infile:
+            chunk.append(line)
+            if (len(chunk) >= self._chunklines):
+                yield chunk
+                chunk = []
+        if (len(chunk) > 0):
+            yield chunk
+
+    def _read(self):
+        try:
+            for chunk in self._chunks():
+                if (self._closed):
+                    return
+                self._queue.put(chunk)
+        except Exception as e:
+            #given to the main thread at the end of the chunks
+            self._error = e
+        finally:
+            self._queue.put(_END)
+
+    def __iter__(self):
+        while (True):
+            tasks = self._queue.qsize()
+            self.occupancy.measure(tasks, tasks == 0)
+            chunk = self._queue.get()
+            if (chunk is _END):
+                break
+            for line in chunk:
+                yield line
+        if (self._error is not None):
+            raise self._error
+
+    def headerLines(self):
+        return self._infile.headerLines()
+
+    def close(self):
+        '''
+        stop the thread and close infile
+        '''
+        self._closed = True
+        #make room, so the thread is not blocked on a full queue
+        while (True):
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._infile.close()
+
+
+class backgroundWriter:
+    '''
+    file like object of which the writes are done to outfile by a background thread
+    at most queuesize writes wait in the queue, occupancy is the queueOccupancy of the queue (waits: queue was full)
+    an error of writing is raised by the next write or by close
+    '''
+
+    def __init__(self, outfile, queuesize=8):
+        self._outfile = outfile
+        self._queue = queue.Queue(queuesize)
+        self._error = None
+        self.occupancy = queueOccupancy(queuesize)
+        self._thread = threading.Thread(target=self._write, name="aftermerge-writer", daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while (True):
+            data = self._queue.get()
+            if (data is _END):
+                return
+            if (self._error is None):
+                try:
+                    self._outfile.write(data)
+                except Exception as e:
+                    #the rest of the data is taken from the queue, so the main thread is not blocked
+                    self._error = e
+
+    def write(self, data):
+        if (self._error is not None):
+            raise self._error
+        tasks = self._queue.qsize()
+        self.occupancy.measure(tasks, tasks >= self.occupancy.queuesize)
+        self._queue.put(data)
+
+    def close(self):
+        '''
+        write what is left in the queue, stop the thread and close outfile
+        '''
+        self._queue.put(_END)
+        self._thread.join()
+        if (self._error is not None):
+            raise self._error
+        self._outfile.close()
@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Reading and writing of BAM files. The BGZF blocks are compressed and decompressed on a pool of threads,
+the records are converted from and to sam lines, so the rest of aftermerge only sees sam lines.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+import struct
+import sys
+import zlib
+
+
+BAM_MAGIC = b"BAM\x01"
+GZIP_MAGIC = b"\x1f\x8b"
+#the empty block at the end of every BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+#maximum number of uncompressed bytes in one block (as htslib, so the compressed block fits in 64kb)
+BGZF_BLOCK_SIZE = 0xff00
+
+CIGAR_OPERATIONS = "MIDNSHP=X"
+#operations using bases on the reference
+REFERENCE_OPERATIONS = "MDN=X"
+SEQ_NIBBLES = "=ACMGRSVTWYHKDBN"
+#translation from a hex coded nibble to a base, and back
+_HEX_TO_BASE = str.maketrans("0123456789abcdef", SEQ_NIBBLES)
+_BASE_TO_HEX = str.maketrans(SEQ_NIBBLES + SEQ_NIBBLES.lower(), "0123456789abcdef" * 2)
+_PHRED_TO_ASCII = bytes((q + 33) & 0xff for q in range(256))
+_ASCII_TO_PHRED = bytes((q - 33) & 0xff for q in range(256))
+_AUX_INTEGER_TYPES = {"c": "<b", "C": "<B", "s": "<h", "S": "<H", "i": "<i", "I": "<I"}
+_AUX_ARRAY_TYPES = {"c": "b", "C": "B", "s": "h", "S": "H", "i": "i", "I": "I", "f": "f"}
+_RECORD_CORE = struct.Struct("<iiBBHHHiiii")
+_RECORD_POSITION = struct.Struct("<ii")
+
+
+def isBam(path):
+    '''
+    function returns True if the file name says it is a BAM file
+    '''
+    return str(path).lower().endswith(".bam")
+
+
+def openInput(path, threads=1, binary=False, buffersize=io.DEFAULT_BUFFER_SIZE, wrapraw=None):
+    '''
+    function returns (input, isbam) for a file name (- is stdin)
+    a BAM file is detected on its content, input is then a bamReader, otherwise a text file
+    both can be iterated over the sam lines
+    binary gives a sam file as a binary file, iterating over the lines as bytes
+    buffersize is the size of the read buffer, in bytes
+    wrapraw is a function returning the unbuffered file to read from for the unbuffered input file (ex. counting the bytes read), None: read as is
+    '''
+    if (path == "-"):
+        raw = io.FileIO(sys.stdin.fileno(), "rb", closefd=False)
+    else:
+        raw = io.FileIO(path, "rb")
+    if (wrapraw is not None):
+        raw = wrapraw(raw)
+    raw = io.BufferedReader(raw, buffersize)
+    if (raw.peek(2)[:2] == GZIP_MAGIC):
+        return (bamReader(raw, threads), True)
+    if (binary):
+        return (raw, False)
+    return (io.TextIOWrapper(raw), False)
+
+
+def openOutput(path, outputformat="sam", threads=1, binary=False, buffersize=io.DEFAULT_BUFFER_SIZE):
+    '''
+    function returns a writable file for the sam lines, for a file name (- is stdout)
+    outputformat is sam, bam or ubam (uncompressed BAM: BGZF blocks without compression, for piping into a sorter)
+    binary gives a file taking bytes (a bamWriter takes both str and bytes)
+    buffersize is the size of the write buffer, in bytes
+    '''
+    if (outputformat == "sam"):
+        if (binary and path == "-"):
+            return io.open(sys.stdout.fileno(), "wb", buffering=buffersize, closefd=False)
+        if (binary):
+            return open(path, "wb", buffering=buffersize)
+        if (path == "-"):
+            return sys.stdout
+        return open(path, "w", buffering=buffersize)
+    if (path == "-"):
+        raw = sys.stdout.buffer
+    else:
+        raw = open(path, "wb", buffering=buffersize)
+    level = 6
+    if (outputformat == "ubam"):
+        level = 0
+    return bamWriter(raw, level, threads)
+
+
+def _decompressBlock(cdata, crc, isize):
+    '''
+    function returns the uncompressed data of a BGZF block
+    '''
+    data = zlib.decompress(cdata, -15)
+    if (len(data) != isize or zlib.crc32(data) != crc):
+        raise ValueError("corrupt BGZF block")
+    return data
+
+
+def _compressBlock(data, level):
+    '''
+    function returns a complete BGZF block for the data
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class bgzfReader:
+    '''
+    reads the uncompressed data of a BGZF file, blocks are decompressed ahead on a pool of threads
+    '''
+
+    def __init__(self, raw, threads=1):
+        '''
+        raw is the binary input, threads the number of decompression threads (0: decompress when needed)
+        '''
+        self._raw = raw
+        self._threads = threads
+        self._executor = None
+        if (threads > 0):
+            self._executor = ThreadPoolExecutor(threads)
+        #offset in the compressed file of the next block to read, and of the current block
+        self._rawoffset = 0
+        self._blockoffset = 0
+        self._blocks = self._decompressedBlocks()
+        self._data = b""
+        self._offset = 0
+
+    def _readRawBlock(self):
+        '''
+        function returns (cdata, crc, isize) of the next block, None at the end of the file
+        '''
+        header = self._raw.read(12)
+        if (len(header) == 0):
+            return None
+        blocksize = len(header)
+        if (len(header) < 12 or header[0:4] != b"\x1f\x8b\x08\x04"):
+            raise ValueError("not a BGZF file")
+        (xlen,) = struct.unpack("<H", header[10:12])
+        extra = self._raw.read(xlen)
+        bsize = None
+        i = 0
+        while (i + 4 <= len(extra)):
+            (slen,) = struct.unpack("<H", extra[i+2:i+4])
+            if (extra[i:i+2] == b"BC"):
+                (bsize,) = struct.unpack("<H", extra[i+4:i+6])
+            i = i + 4 + slen
+        if (bsize is None):
+            raise ValueError("not a BGZF file: no block size")
+        rest = self._raw.read(bsize + 1 - 12 - xlen)
+        self._rawoffset = self._rawoffset + blocksize + len(extra) + len(rest)
+        (crc, isize) = struct.unpack("<II", rest[-8:])
+        return (rest[:-8], crc, isize)
+
+    def _decompressedBlocks(self):
+        '''
+        generator over (offset, data): the offset in the file and the uncompressed data of the blocks, in file order
+        '''
+        inflight = deque()
+        while (True):
+            offset = self._rawoffset
+            rawblock = self._readRawBlock()
+            if (rawblock is None):
+                break
+            if (self._executor is None):
+                yield (offset, _decompressBlock(*rawblock))
+                continue
+            inflight.append((offset, self._executor.submit(_decompressBlock, *rawblock)))
+            if (len(inflight) >= self._threads * 4):
+                (offset, future) = inflight.popleft()
+                yield (offset, future.result())
+        while (len(inflight) > 0):
+            (offset, future) = inflight.popleft()
+            yield (offset, future.result())
+
+    def read(self, size):
+        '''
+        function returns the next size bytes, less only at the end of the file
+        '''
+        if (self._offset + size <= len(self._data)):
+            #fast path: in the current block
+            data = self._data[self._offset:self._offset+size]
+            self._offset = self._offset + size
+            return data
+        parts = [self._data[self._offset:]]
+        needed = size - len(parts[0])
+        self._data = b""
+        self._offset = 0
+        while (needed > 0):
+            (offset, block) = next(self._blocks, (None, None))
+            if (block is None):
+                break
+            self._blockoffset = offset
+            if (len(block) >= needed):
+                #the block stays current, also when read till its end, so tell() knows its offset
+                parts.append(block[:needed])
+                self._data = block
+                self._offset = needed
+                break
+            parts.append(block)
+            needed = needed - len(block)
+        return b"".join(parts)
+
+    def tell(self):
+        '''
+        function returns the virtual offset (as in a BAM index) of the next byte to read
+        '''
+        return (self._blockoffset << 16) | self._offset
+
+    def seek(self, virtualoffset):
+        '''
+        continue reading at a virtual offset: the offset of a block in the file (upper 48 bits) and the offset in the block (lower 16 bits)
+        '''
+        self._blocks.close()
+        self._rawoffset = virtualoffset >> 16
+        self._raw.seek(self._rawoffset)
+        self._blockoffset = self._rawoffset
+        self._blocks = self._decompressedBlocks()
+        self._data = b""
+        self._offset = 0
+        if (virtualoffset & 0xffff > 0):
+            self.read(virtualoffset & 0xffff)
+
+    def close(self):
+        if (self._executor is not None):
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._raw.close()
+
+
+class bgzfWriter:
+    '''
+    writes data as BGZF blocks, blocks are compressed on a pool of threads and written in order
+    '''
+
+    def __init__(self, raw, level=6, threads=1):
+        '''
+        raw is the binary output, level the zlib compression level (0: no compression)
+        threads the number of compression threads (0: compress in the calling thread)
+        '''
+        self._raw = raw
+        self._level = level
+        self._threads = threads
+        self._executor = None
+        if (threads > 0):
+            self._executor = ThreadPoolExecutor(threads)
+        self._inflight = deque()
+        self._buffer = bytearray()
+
+    def _writeBlock(self, data):
+        if (self._executor is None):
+            self._raw.write(_compressBlock(data, self._level))
+            return
+        self._inflight.append(self._executor.submit(_compressBlock, data, self._level))
+        while (len(self._inflight) >= self._threads * 4):
+            self._raw.write(self._inflight.popleft().result())
+
+    def write(self, data):
+        self._buffer += data
+        if (len(self._buffer) >= BGZF_BLOCK_SIZE):
+            blocks = len(self._buffer) // BGZF_BLOCK_SIZE
+            for b in range(blocks):
+                self._writeBlock(bytes(self._buffer[b*BGZF_BLOCK_SIZE:(b+1)*BGZF_BLOCK_SIZE]))
+            del self._buffer[0:blocks*BGZF_BLOCK_SIZE]
+
+    def flush(self):
+        '''
+        compress the data in the buffer as block, and wait till all blocks are written
+        '''
+        if (len(self._buffer) > 0):
+            self._writeBlock(bytes(self._buffer))
+            self._buffer = bytearray()
+        while (len(self._inflight) > 0):
+            self._raw.write(self._inflight.popleft().result())
+        self._raw.flush()
+
+    def close(self):
+        self.flush()
+        self._raw.write(BGZF_EOF)
+        self._raw.close()
+        if (self._executor is not None):
+            self._executor.shutdown()
+
+
+def _formatAux(data):
+    '''
+    function returns the optional fields of a BAM record as sam fields
+    '''
+    fields = []
+    i = 0
+    while (i < len(data)):
+        tag = data[i:i+2].decode("ascii")
+        valuetype = chr(data[i+2])
+        i = i + 3
+        if (valuetype == "A"):
+            fields.append("{}:A:{}".format(tag, chr(data[i])))
+            i = i + 1
+        elif (valuetype in _AUX_INTEGER_TYPES):
+            valuestruct = struct.Struct(_AUX_INTEGER_TYPES[valuetype])
+            fields.append("{}:i:{}".format(tag, valuestruct.unpack_from(data, i)[0]))
+            i = i + valuestruct.size
+        elif (valuetype == "f"):
+            fields.append("{}:f:{:g}".format(tag, struct.unpack_from("<f", data, i)[0]))
+            i = i + 4
+        elif (valuetype == "Z" or valuetype == "H"):
+            end = data.index(b"\x00", i)
+            fields.append("{}:{}:{}".format(tag, valuetype, data[i:end].decode("ascii")))
+            i = end + 1
+        elif (valuetype == "B"):
+            subtype = chr(data[i])
+            (count,) = struct.unpack_from("<i", data, i+1)
+            i = i + 5
+            values = struct.unpack_from("<{}{}".format(count, _AUX_ARRAY_TYPES[subtype]), data, i)
+            i = i + count * struct.calcsize(_AUX_ARRAY_TYPES[subtype])
+            if (subtype == "f"):
+                values = ["{:g}".format(v) for v in values]
+            fields.append("{}:B:{}".format(tag, ",".join([subtype] + [str(v) for v in values])))
+        else:
+            raise ValueError("unknown type {} of BAM tag {}".format(valuetype, tag))
+    return fields
+
+
+def _encodeAux(field):
+    '''
+    function returns the BAM encoding of an optional sam field (TAG:TYPE:VALUE)
+    '''
+    tag = field[0:2].encode("ascii")
+    valuetype = field[3]
+    value = field[5:]
+    if (valuetype == "A"):
+        return tag + b"A" + value.encode("ascii")
+    if (valuetype == "i"):
+        #the smallest integer type which fits
+        v = int(value)
+        if (v < 0):
+            if (v >= -0x80):
+                return tag + struct.pack("<cb", b"c", v)
+            if (v >= -0x8000):
+                return tag + struct.pack("<ch", b"s", v)
+            return tag + struct.pack("<ci", b"i", v)
+        if (v <= 0xff):
+            return tag + struct.pack("<cB", b"C", v)
+        if (v <= 0xffff):
+            return tag + struct.pack("<cH", b"S", v)
+        return tag + struct.pack("<cI", b"I", v)
+    if (valuetype == "f"):
+        return tag + struct.pack("<cf", b"f", float(value))
+    if (valuetype == "Z" or valuetype == "H"):
+        return tag + valuetype.encode("ascii") + value.encode("ascii") + b"\x00"
+    if (valuetype == "B"):
+        values = value.split(",")
+        subtype = values[0]
+        convert = int
+        if (subtype == "f"):
+            convert = float
+        numbers = [convert(v) for v in values[1:]]
+        return tag + b"B" + subtype.encode("ascii") + struct.pack("<i{}{}".format(len(numbers), _AUX_ARRAY_TYPES[subtype]), len(numbers), *numbers)
+    raise ValueError("unknown type {} of sam tag {}".format(valuetype, field))
+
+
+def reg2bin(beg, end):
+    '''
+    function returns the BAM bin of the 0-based region [beg, end) (as in the sam specification)
+    '''
+    end = end - 1
+    if (beg >> 14 == end >> 14):
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if (beg >> 17 == end >> 17):
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if (beg >> 20 == end >> 20):
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if (beg >> 23 == end >> 23):
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if (beg >> 26 == end >> 26):
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class bamReader:
+    '''
+    reads a BAM file, iterating gives the sam lines: first the header, then one line per record
+    '''
+
+    def __init__(self, raw, threads=1):
+        self._bgzf = bgzfReader(raw, threads)
+        if (self._bgzf.read(4) != BAM_MAGIC):
+            raise ValueError("BGZF input is not a BAM file")
+        (textlength,) = struct.unpack("<i", self._bgzf.read(4))
+        self.header = self._bgzf.read(textlength).rstrip(b"\x00").decode("ascii")
+        (nref,) = struct.unpack("<i", self._bgzf.read(4))
+        self.references = []
+        for r in range(nref):
+            (namelength,) = struct.unpack("<i", self._bgzf.read(4))
+            name = self._bgzf.read(namelength).rstrip(b"\x00").decode("ascii")
+            (reflength,) = struct.unpack("<i", self._bgzf.read(4))
+            self.references.append((name, reflength))
+        #virtual offset of the first record
+        self.recordsOffset = self._bgzf.tell()
+
+    def headerLines(self):
+        '''
+        function returns the header as list of lines, @SQ lines are made from the references if the text has none
+        '''
+        lines = [line for line in self.header.split("\n") if line != ""]
+        if (len(self.references) > 0 and not any(line.startswith("@SQ") for line in lines)):
+            lines = lines + ["@SQ\tSN:{}\tLN:{}".format(name, length) for (name, length) in self.references]
+        return lines
+
+    def readRecord(self):
+        '''
+        function returns the next record as bytes (without the block size), None at the end of the file
+        '''
+        size = self._bgzf.read(4)
+        if (len(size) < 4):
+            return None
+        (blocksize,) = struct.unpack("<i", size)
+        return self._bgzf.read(blocksize)
+
+    def formatRecord(self, record):
+        '''
+        function returns the sam line of a BAM record
+        '''
+        (refid, pos, namelength, mapq, _bin, ncigar, flag, seqlength, nextrefid, nextpos, tlen) = _RECORD_CORE.unpack_from(record, 0)
+        i = _RECORD_CORE.size
+        qname = record[i:i+namelength-1].decode("ascii")
+        i = i + namelength
+        cigar = "*"
+        if (ncigar > 0):
+            cigar = "".join("{}{}".format(c >> 4, CIGAR_OPERATIONS[c & 0xf]) for c in struct.unpack_from("<{}I".format(ncigar), record, i))
+        i = i + 4 * ncigar
+        seq = "*"
+        if (seqlength > 0):
+            seq = record[i:i+(seqlength+1)//2].hex().translate(_HEX_TO_BASE)[:seqlength]
+        i = i + (seqlength + 1) // 2
+        qual = "*"
+        if (seqlength > 0 and record[i] != 0xff):
+            qual = record[i:i+seqlength].translate(_PHRED_TO_ASCII).decode("ascii")
+        i = i + seqlength
+        rname = "*"
+        if (refid >= 0):
+            rname = self.references[refid][0]
+        rnext = "*"
+        if (nextrefid >= 0):
+            if (nextrefid == refid):
+                rnext = "="
+            else:
+                rnext = self.references[nextrefid][0]
+        fields = [qname, str(flag), rname, str(pos + 1), str(mapq), cigar, rnext, str(nextpos + 1), str(tlen), seq, qual]
+        if (i < len(record)):
+            fields.extend(_formatAux(record[i:]))
+        return "\t".join(fields)
+
+    def fetch(self, offset, refid, start=0, end=None):
+        '''
+        generator over the sam lines of the records on reference refid (-1: reads without position) starting in [start, end)
+        reading starts at the virtual offset given, which should be before the first of these records (ex. from the index)
+        the file is sorted on coordinate, so reading stops at the first record after the region
+        '''
+        self._bgzf.seek(offset)
+        while (True):
+            record = self.readRecord()
+            if (record is None):
+                break
+            (recordrefid, pos) = _RECORD_POSITION.unpack_from(record, 0)
+            if (refid == -1):
+                #reads without position are at the end of the file
+                if (recordrefid == -1):
+                    yield self.formatRecord(record)
+                continue
+            if (recordrefid == -1 or recordrefid > refid or (recordrefid == refid and end is not None and pos >= end)):
+                break
+            if (recordrefid == refid and pos >= start):
+                yield self.formatRecord(record)
+
+    def __iter__(self):
+        for line in self.headerLines():
+            yield line
+        while (True):
+            record = self.readRecord()
+            if (record is None):
+                break
+            yield self.formatRecord(record)
+
+    def close(self):
+        self._bgzf.close()
+
+
+class bamWriter:
+    '''
+    writes sam lines (written as text, as to a sam file) as BAM
+    the header is written when the first record is written, the references are taken from the @SQ lines
+    '''
+
+    def __init__(self, raw, level=6, threads=1):
+        self._bgzf = bgzfWriter(raw, level, threads)
+        self._headerlines = []
+        self._referenceids = None
+        self._partial = ""
+
+    def _writeHeader(self):
+        references = []
+        for line in self._headerlines:
+            if (line.startswith("@SQ")):
+                tags = dict(field.split(":", 1) for field in line.split("\t")[1:] if ":" in field)
+                references.append((tags["SN"], int(tags["LN"])))
+        text = "".join(line + "\n" for line in self._headerlines).encode("ascii")
+        data = [BAM_MAGIC, struct.pack("<i", len(text)), text, struct.pack("<i", len(references))]
+        for (name, length) in references:
+            name = name.encode("ascii") + b"\x00"
+            data.append(struct.pack("<i", len(name)) + name + struct.pack("<i", length))
+        self._bgzf.write(b"".join(data))
+        self._referenceids = {name: i for (i, (name, length)) in enumerate(references)}
+
+    def encodeRecord(self, line):
+        '''
+        function returns the BAM record (with block size) of a sam line
+        '''
+        fields = line.split("\t")
+        qname = fields[0].encode("ascii") + b"\x00"
+        flag = int(fields[1])
+        refid = self._referenceids.get(fields[2], -1)
+        pos = int(fields[3]) - 1
+        mapq = int(fields[4])
+        cigar = []
+        reflength = 0
+        if (fields[5] != "*"):
+            length = 0
+            for a in fields[5]:
+                if (a.isdigit()):
+                    length = length * 10 + int(a)
+                else:
+                    cigar.append(length << 4 | CIGAR_OPERATIONS.index(a))
+                    if (a in REFERENCE_OPERATIONS):
+                        reflength = reflength + length
+                    length = 0
+        if (fields[6] == "="):
+            nextrefid = refid
+        else:
+            nextrefid = self._referenceids.get(fields[6], -1)
+        nextpos = int(fields[7]) - 1
+        tlen = int(fields[8])
+        seq = fields[9]
+        seqlength = 0
+        encodedseq = b""
+        if (seq != "*"):
+            seqlength = len(seq)
+            hexseq = seq.translate(_BASE_TO_HEX)
+            if (seqlength % 2 == 1):
+                hexseq = hexseq + "0"
+            encodedseq = bytes.fromhex(hexseq)
+        if (fields[10] == "*"):
+            encodedqual = b"\xff" * seqlength
+        else:
+            encodedqual = fields[10].encode("ascii").translate(_ASCII_TO_PHRED)
+        if (reflength == 0):
+            reflength = 1
+        binnumber = reg2bin(pos, pos + reflength)
+        record = b"".join([_RECORD_CORE.pack(refid, pos, len(qname), mapq, binnumber, len(cigar), flag, seqlength, nextrefid, nextpos, tlen),
+                           qname, struct.pack("<{}I".format(len(cigar)), *cigar), encodedseq, encodedqual]
+                          + [_encodeAux(field) for field in fields[11:]])
+        return struct.pack("<i", len(record)) + record
+
+    def write(self, text):
+        if (isinstance(text, bytes)):
+            text = text.decode("ascii")
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        records = []
+        for line in lines:
+            if (line.startswith("@") and self._referenceids is None):
+                self._headerlines.append(line)
+                continue
+            if (self._referenceids is None):
+                self._writeHeader()
+            records.append(self.encodeRecord(line))
+        if (len(records) > 0):
+            self._bgzf.write(b"".join(records))
+
+    def close(self):
+        if (self._partial != ""):
+            self.write("\n")
+        if (self._referenceids is None):
+            self._writeHeader()
+        self._bgzf.close()
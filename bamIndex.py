@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Reading of the index (.bai) of a coordinate sorted BAM file, and splitting of the genome in regions
+which can be merged separately (one region per worker process).
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import struct
+
+
+BAI_MAGIC = b"BAI\x01"
+#bin with the offsets of the first and last read of a reference, and its number of mapped and unmapped reads
+PSEUDO_BIN = 37450
+#size (as shift) of the windows of the linear index: 16kb
+WINDOW_SHIFT = 14
+
+
+def findIndex(bampath):
+    '''
+    function returns the file name of the index of a BAM file (file.bam.bai or file.bai), None if there is none
+    '''
+    candidates = [bampath + ".bai"]
+    if (bampath.lower().endswith(".bam")):
+        candidates.append(bampath[:-4] + ".bai")
+    for candidate in candidates:
+        if (os.path.exists(candidate)):
+            return candidate
+    return None
+
+
+class bamIndex:
+    '''
+    the index of a BAM file: per reference the virtual offsets of its first and last read, and the linear index
+    the linear index gives per window of 16kb a virtual offset before all reads starting in that window or later
+    '''
+
+    def __init__(self, path):
+        with open(path, "rb") as indexfile:
+            data = indexfile.read()
+        if (data[:4] != BAI_MAGIC):
+            raise ValueError("{} is not a BAM index".format(path))
+        (nref,) = struct.unpack_from("<i", data, 4)
+        i = 8
+        #per reference: offset of the first read and after the last read (None without reads), and the linear index
+        self.begin = []
+        self.end = []
+        self.linear = []
+        for r in range(nref):
+            (nbin,) = struct.unpack_from("<i", data, i)
+            i = i + 4
+            begin = None
+            end = None
+            for b in range(nbin):
+                (binnumber, nchunk) = struct.unpack_from("<Ii", data, i)
+                i = i + 8
+                chunks = struct.unpack_from("<{}Q".format(2 * nchunk), data, i)
+                i = i + 16 * nchunk
+                if (binnumber == PSEUDO_BIN):
+                    #the second chunk holds the read counts, not offsets
+                    chunks = chunks[:2]
+                if (len(chunks) > 0):
+                    if (begin is None or min(chunks[0::2]) < begin):
+                        begin = min(chunks[0::2])
+                    if (end is None or max(chunks[1::2]) > end):
+                        end = max(chunks[1::2])
+            (nintv,) = struct.unpack_from("<i", data, i)
+            i = i + 4
+            intervals = struct.unpack_from("<{}Q".format(nintv), data, i)
+            i = i + 8 * nintv
+            #the offset of a window is also before all reads of later windows, so the maximum till a window is used
+            #(windows without reads have offset 0)
+            linear = []
+            highest = begin or 0
+            for offset in intervals:
+                if (offset > highest):
+                    highest = offset
+                linear.append(highest)
+            self.begin.append(begin)
+            self.end.append(end)
+            self.linear.append(linear)
+
+    def unplacedOffset(self, recordsoffset):
+        '''
+        function returns a virtual offset before the reads without position (at the end of the file)
+        recordsoffset is the offset of the first record, for a file without placed reads
+        '''
+        ends = [end for end in self.end if end is not None]
+        if (len(ends) == 0):
+            return recordsoffset
+        return max(ends)
+
+
+def shardRegions(index, shards, recordsoffset):
+    '''
+    function returns the regions to merge separately, as (refid, start, end, offset) in reference order
+    the region has the reads of reference refid starting in [start, end) (end None: till the end of the reference),
+    and offset is the virtual offset to start reading
+    the references are split at windows of the linear index, in about shards regions of the same compressed size
+    the last region (refid -1) has the reads without position, recordsoffset is the offset of the first record of the file
+    '''
+    total = sum((index.end[r] >> 16) - (index.begin[r] >> 16) for r in range(len(index.begin)) if index.begin[r] is not None)
+    target = max(total // max(shards, 1), 1)
+    regions = []
+    for refid in range(len(index.begin)):
+        if (index.begin[refid] is None):
+            #no reads on this reference
+            continue
+        start = 0
+        offset = index.begin[refid]
+        for window in range(1, len(index.linear[refid])):
+            windowoffset = index.linear[refid][window]
+            if ((windowoffset >> 16) - (offset >> 16) >= target):
+                regions.append((refid, start, window << WINDOW_SHIFT, offset))
+                start = window << WINDOW_SHIFT
+                offset = windowoffset
+        regions.append((refid, start, None, offset))
+    regions.append((-1, 0, None, index.unplacedOffset(recordsoffset)))
+    return regions
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Merging of many overlaps at once with NumPy: the overlaps with the same start and the same cigar (the most common case)
+are put in arrays, and the bases and qualities are chosen for all of them in a few vectorized operations.
+The result is the same as the merging of one overlap in aftermerge. NumPy is optional, without it available() is False.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def available():
+    '''
+    function returns True if NumPy is installed
+    '''
+    return numpy is not None
+
+
+def _toArray(parts):
+    return numpy.frombuffer("".join(parts).encode("latin-1"), dtype=numpy.uint8)
+
+
+def mergeSameCigarBatch(overlaps):
+    '''
+    function returns a list of (sequence, quality), one for each overlap (seq1, seq2, qual1, qual2)
+    of two reads with the same start and the same cigar, so every base is merged with the base on the same position:
+    when the bases match, the quality is the max, otherwise the base with the highest quality is taken with the lowest quality
+    returns None if the overlaps are not in one byte characters
+    '''
+    if (len(overlaps) == 0):
+        return []
+    try:
+        seq1 = _toArray([overlap[0] for overlap in overlaps])
+        seq2 = _toArray([overlap[1] for overlap in overlaps])
+        qual1 = _toArray([overlap[2] for overlap in overlaps])
+        qual2 = _toArray([overlap[3] for overlap in overlaps])
+    except UnicodeEncodeError:
+        return None
+    same = (seq1 == seq2)
+    #the base of the second read only when the bases differ and the second has the highest quality
+    newseq = numpy.where(~same & (qual1 < qual2), seq2, seq1).tobytes().decode("latin-1")
+    newqual = numpy.where(same, numpy.maximum(qual1, qual2), numpy.minimum(qual1, qual2)).tobytes().decode("latin-1")
+    merged = []
+    offset = 0
+    for overlap in overlaps:
+        end = offset + len(overlap[0])
+        merged.append((newseq[offset:end], newqual[offset:end]))
+        offset = end
+    return merged
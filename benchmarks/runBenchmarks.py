@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Benchmarks of aftermerge on simulated data. Times parsing, pairing, overlapHasSameCigar, mergeSequences
+and the complete run, and writes the results as json, to compare them between commits.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKDIR))
+
+import aftermerge
+import samRead
+from simulateSam import simulateSam
+
+
+#the simulated data sets, as settings of simulateSam
+SCENARIOS = {
+    #whole genome sequencing: short overlap of 2x150 reads
+    "wgs": {"readlength": 150, "insertmean": 350, "insertsd": 80},
+    #amplicons: mates overlap for the largest part
+    "amplicon": {"readlength": 150, "insertmean": 180, "insertsd": 20},
+    #long overlaps of 2x300 reads, with more indels and soft clips
+    "miseq": {"readlength": 300, "insertmean": 400, "insertsd": 60, "indel_rate": 0.05, "softclip_rate": 0.1},
+    #coordinate sorted input, mates are far apart in the file
+    "coordinate": {"readlength": 150, "insertmean": 300, "insertsd": 50, "order": "coordinate"},
+}
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def best(function, repeat):
+    '''
+    function returns (seconds, result) of the fastest of repeat calls of function
+    '''
+    fastest = None
+    result = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        if (fastest is None or seconds < fastest):
+            fastest = seconds
+    return (fastest, result)
+
+
+def rates(seconds, reads, size):
+    '''
+    function returns the timing as dict with reads/s and MB/s
+    '''
+    return {"seconds": round(seconds, 6), "reads_per_s": round(reads / seconds, 1), "mb_per_s": round(size / seconds / 1e6, 3)}
+
+
+def benchmarkStages(lines, repeat):
+    '''
+    function returns the timings of the separate steps of aftermerge on the lines of a sam file
+    '''
+    readlines = [line for line in lines if not line.startswith("@")]
+    size = sum(len(line) + 1 for line in lines)
+    stages = {}
+
+    #parsing of all reads
+    (seconds, reads) = best(lambda: [samRead.samRead(line) for line in readlines], repeat)
+    stages["parse"] = rates(seconds, len(readlines), size)
+
+    #parsing and pairing of the mates
+    def pairing():
+        counts = {"total_reads": 0, "mapped_reads": 0, "unmapped_reads": 0}
+        return [item for item in aftermerge.readItems(lines, counts) if isinstance(item, tuple)]
+    (seconds, pairs) = best(pairing, repeat)
+    stages["pairing"] = rates(seconds, len(readlines), size)
+
+    #overlap check of the pairs
+    overlapping = [(read, mate) for (read, mate) in pairs if read.isoverlapping(mate)]
+    (seconds, result) = best(lambda: [read.overlapHasSameCigar(mate) for (read, mate) in overlapping], repeat)
+    stages["overlapHasSameCigar"] = rates(seconds, 2 * len(overlapping), size)
+    stages["overlapHasSameCigar"]["pairs"] = len(overlapping)
+
+    #merging of the overlaps: the arguments of mergeSequences are recorded during one merge of all pairs
+    calls = []
+    mergeSequences = aftermerge.mergeSequences
+    def record(*arguments):
+        calls.append(arguments)
+        return mergeSequences(*arguments)
+    aftermerge.mergeSequences = record
+    try:
+        aftermerge.processBatch(pairs)
+    finally:
+        aftermerge.mergeSequences = mergeSequences
+    (seconds, result) = best(lambda: [mergeSequences(*arguments) for arguments in calls], repeat)
+    stages["mergeSequences"] = rates(seconds, 2 * len(calls), size)
+    stages["mergeSequences"]["pairs"] = len(calls)
+    stages["mergeSequences"]["overlap_bases"] = sum(len(arguments[0]) for arguments in calls)
+    return stages
+
+
+def benchmarkRun(samfile, reads, extraargs, repeat):
+    '''
+    function returns the timing and peak memory of complete runs of aftermerge.py on samfile
+    '''
+    size = os.path.getsize(samfile)
+    command = [sys.executable, os.path.join(os.path.dirname(BENCHMARKDIR), "aftermerge.py")] + extraargs + [samfile, os.devnull]
+    fastest = None
+    peakrss = 0
+    for r in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if (process.returncode != 0):
+            raise RuntimeError("{} failed with exit code {}".format(" ".join(command), process.returncode))
+        if (fastest is None or seconds < fastest):
+            fastest = seconds
+        #ru_maxrss is in kB on linux
+        peakrss = max(peakrss, usage.ru_maxrss)
+    result = rates(fastest, reads, size)
+    result["peak_rss_mb"] = round(peakrss / 1024, 1)
+    result["args"] = extraargs
+    return result
+
+
+def gitCommit():
+    '''
+    function returns the current git commit of aftermerge, None if not available
+    '''
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKDIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    '''
+    print the reads/s of both result files and the speedup, for every scenario and stage
+    '''
+    eprint("{:<12}{:<22}{:>14}{:>14}{:>9}".format("scenario", "stage", "old reads/s", "new reads/s", "speedup"))
+    for (scenario, result) in new["scenarios"].items():
+        if (scenario not in old["scenarios"]):
+            continue
+        oldresult = old["scenarios"][scenario]
+        stages = dict(result["stages"])
+        stages["end_to_end"] = result["end_to_end"]
+        oldstages = dict(oldresult["stages"])
+        oldstages["end_to_end"] = oldresult["end_to_end"]
+        for (stage, timing) in stages.items():
+            if (stage not in oldstages):
+                continue
+            oldrate = oldstages[stage]["reads_per_s"]
+            eprint("{:<12}{:<22}{:>14}{:>14}{:>8.2f}x".format(scenario, stage, oldrate, timing["reads_per_s"], timing["reads_per_s"] / oldrate))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks of aftermerge on simulated paired end data')
+    parser.add_argument('-n', '--pairs', help="Number of simulated pairs per scenario (default 20000)", type=int, default=20000)
+    parser.add_argument('-s', '--seed', help="Seed of the simulation (default 1)", type=int, default=1)
+    parser.add_argument('-r', '--repeat', help="Number of repeats, the fastest is reported (default 3)", type=int, default=3)
+    parser.add_argument('--scenario', help="Scenario to run (default all: {})".format(", ".join(SCENARIOS)), action="append", choices=sorted(SCENARIOS), default=None)
+    parser.add_argument('--aftermerge-args', help="Extra arguments for the complete runs of aftermerge.py, ex.: '--threads 4'", default="", dest="aftermergeargs")
+    parser.add_argument('--compare', help="Result file of an earlier benchmark to compare with", default=None)
+    parser.add_argument('-o', '--output', help="The json result file, - is stdout (default -)", default="-")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = {"commit": gitCommit(), "python": platform.python_version(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "pairs": args.pairs, "seed": args.seed, "repeat": args.repeat, "scenarios": {}}
+    with tempfile.TemporaryDirectory(prefix="aftermerge.bench.") as tmpdir:
+        for scenario in scenarios:
+            eprint("Scenario {}".format(scenario))
+            lines = simulateSam(args.pairs, args.seed, **SCENARIOS[scenario])
+            samfile = os.path.join(tmpdir, scenario + ".sam")
+            with open(samfile, "w") as out:
+                for line in lines:
+                    out.write(line + "\n")
+            reads = sum(1 for line in lines if not line.startswith("@"))
+            results["scenarios"][scenario] = {"settings": SCENARIOS[scenario], "reads": reads, "input_bytes": os.path.getsize(samfile),
+                                              "stages": benchmarkStages(lines, args.repeat),
+                                              "end_to_end": benchmarkRun(samfile, reads, args.aftermergeargs.split(), args.repeat)}
+    output = json.dumps(results, indent=2)
+    if (args.output == "-"):
+        print(output)
+    else:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+    if (args.compare is not None):
+        with open(args.compare) as old:
+            compare(json.load(old), results)
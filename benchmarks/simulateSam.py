@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Generator of synthetic paired end sam files for the benchmarks. With the same seed and settings the output is the same.
+The reads are sampled from a random reference, so the overlapping parts of mates agree (apart from the simulated errors).
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from argparse import ArgumentParser
+import random
+import sys
+
+
+BASES = "ACGT"
+
+
+def _quality(rnd, length):
+    return "".join(chr(33 + rnd.randint(2, 40)) for i in range(length))
+
+
+def _mutate(rnd, seq, mismatchrate):
+    '''
+    function returns the sequence with random mismatches
+    '''
+    if (mismatchrate <= 0):
+        return seq
+    return "".join(rnd.choice(BASES) if rnd.random() < mismatchrate else base for base in seq)
+
+
+def _read(rnd, reference, start, readlength, settings, clipstart):
+    '''
+    function returns (pos, cigar, seq) of a read of readlength bases starting at start (0-based) on the reference
+    clipstart True clips the start of the read (forward read), otherwise the end (reverse read)
+    '''
+    clip = 0
+    if (rnd.random() < settings["softclip_rate"]):
+        clip = rnd.randint(1, max(1, readlength // 10))
+    aligned = readlength - clip
+    runs = [("M", aligned)]
+    seq = reference[start:start+aligned]
+    if (rnd.random() < settings["indel_rate"] and aligned > 20):
+        #an indel in the middle part of the read
+        at = rnd.randint(5, aligned - 15)
+        size = rnd.randint(1, 3)
+        if (rnd.random() < 0.5):
+            runs = [("M", at), ("I", size), ("M", aligned - at - size)]
+            seq = reference[start:start+at] + "".join(rnd.choice(BASES) for i in range(size)) + reference[start+at:start+aligned-size]
+        else:
+            runs = [("M", at), ("D", size), ("M", aligned - at)]
+            seq = reference[start:start+at] + reference[start+at+size:start+aligned+size]
+    seq = _mutate(rnd, seq, settings["mismatch_rate"])
+    clipped = "".join(rnd.choice(BASES) for i in range(clip))
+    if (clip > 0):
+        if (clipstart):
+            runs = [("S", clip)] + runs
+            seq = clipped + seq
+        else:
+            runs = runs + [("S", clip)]
+            seq = seq + clipped
+    cigar = "".join("{}{}".format(length, op) for (op, length) in runs)
+    reflength = sum(length for (op, length) in runs if op in "MD")
+    return (start + 1, cigar, seq, reflength)
+
+
+def simulateSam(pairs, seed=1, readlength=150, insertmean=350, insertsd=50, softclip_rate=0.05,
+                indel_rate=0.02, mismatch_rate=0.005, unmapped_rate=0.01, order="mapper",
+                references=2, referencelength=1000000):
+    '''
+    function returns the lines (without newline) of a simulated paired end sam file
+    insertmean and insertsd set the fragment size distribution, and so the overlap of the mates
+    order is mapper (mates next to each other), name (same, with the queryname header) or coordinate
+    '''
+    rnd = random.Random(seed)
+    settings = {"softclip_rate": softclip_rate, "indel_rate": indel_rate, "mismatch_rate": mismatch_rate}
+    genome = []
+    for r in range(references):
+        genome.append(("chr{}".format(r + 1), "".join(rnd.choice(BASES) for i in range(referencelength))))
+    sortorder = {"mapper": "unsorted", "name": "queryname", "coordinate": "coordinate"}[order]
+    header = ["@HD\tVN:1.6\tSO:{}".format(sortorder)]
+    header.extend("@SQ\tSN:{}\tLN:{}".format(name, len(seq)) for (name, seq) in genome)
+    header.append("@PG\tID:simulateSam\tPN:simulateSam")
+    records = []
+    width = len(str(pairs))
+    for p in range(pairs):
+        qname = "sim{}".format(str(p).zfill(width))
+        (rname, reference) = rnd.choice(genome)
+        fragment = max(readlength, int(rnd.gauss(insertmean, insertsd)))
+        start = rnd.randint(0, len(reference) - fragment - readlength - 10)
+        (pos1, cigar1, seq1, reflength1) = _read(rnd, reference, start, readlength, settings, True)
+        (pos2, cigar2, seq2, reflength2) = _read(rnd, reference, start + fragment - readlength, readlength, settings, False)
+        tlen = pos2 + reflength2 - pos1
+        mapq1 = rnd.randint(0, 60)
+        mapq2 = rnd.randint(0, 60)
+        if (rnd.random() < unmapped_rate):
+            #mate 2 not mapped: placed on the position of mate 1
+            record1 = [qname, 73, rname, pos1, mapq1, cigar1, "=", pos1, 0, seq1, _quality(rnd, len(seq1))]
+            record2 = [qname, 133, rname, pos1, 0, "*", "=", pos1, 0, seq2, _quality(rnd, len(seq2))]
+        else:
+            #first in pair is either the forward or the reverse read
+            (flag1, flag2) = (99, 147)
+            if (rnd.random() < 0.5):
+                (flag1, flag2) = (163, 83)
+            record1 = [qname, flag1, rname, pos1, mapq1, cigar1, "=", pos2, tlen, seq1, _quality(rnd, len(seq1))]
+            record2 = [qname, flag2, rname, pos2, mapq2, cigar2, "=", pos1, -tlen, seq2, _quality(rnd, len(seq2))]
+        record1.append("NM:i:0")
+        record2.append("NM:i:0")
+        if (record1[1] & 0x80):
+            records.append((record2, record1))
+        else:
+            records.append((record1, record2))
+    lines = []
+    if (order == "coordinate"):
+        references = {name: i for (i, (name, seq)) in enumerate(genome)}
+        reads = [record for pair in records for record in pair]
+        reads.sort(key=lambda record: (references[record[2]], record[3]))
+        lines = ["\t".join(str(field) for field in record) for record in reads]
+    else:
+        lines = ["\t".join(str(field) for field in record) for pair in records for record in pair]
+    return header + lines
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Generate a synthetic paired end sam file for the aftermerge benchmarks')
+    parser.add_argument('-n', '--pairs', help="Number of pairs (default 100000)", type=int, default=100000)
+    parser.add_argument('-s', '--seed', help="Seed of the random generator (default 1)", type=int, default=1)
+    parser.add_argument('--read-length', help="Read length (default 150)", type=int, default=150, dest="readlength")
+    parser.add_argument('--insert-mean', help="Mean fragment size (default 350)", type=float, default=350, dest="insertmean")
+    parser.add_argument('--insert-sd', help="Standard deviation of the fragment size (default 50)", type=float, default=50, dest="insertsd")
+    parser.add_argument('--softclip-rate', help="Fraction of reads with a soft clip (default 0.05)", type=float, default=0.05, dest="softclip_rate")
+    parser.add_argument('--indel-rate', help="Fraction of reads with an indel (default 0.02)", type=float, default=0.02, dest="indel_rate")
+    parser.add_argument('--mismatch-rate', help="Mismatch rate per base (default 0.005)", type=float, default=0.005, dest="mismatch_rate")
+    parser.add_argument('--order', help="Order of the reads (default mapper)", choices=["mapper", "name", "coordinate"], default="mapper")
+    parser.add_argument('outfile', nargs='?', help="The output sam file, - is stdout", default="-")
+    args = parser.parse_args()
+    lines = simulateSam(args.pairs, args.seed, args.readlength, args.insertmean, args.insertsd, args.softclip_rate,
+                        args.indel_rate, args.mismatch_rate, order=args.order)
+    outfile = sys.stdout
+    if (args.outfile != "-"):
+        outfile = open(args.outfile, "w")
+    for line in lines:
+        outfile.write(line + "\n")
+    outfile.close()
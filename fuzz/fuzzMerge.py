@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Differential fuzzing of the merging: random pairs with random cigars (soft clips, insertions and deletions, mates starting
+on the boundaries of the cigar runs) are merged by the reference implementation (referenceMerge, the first version of aftermerge)
+and by the engines of the current aftermerge, which have to give the same output line and error line.
+longcigar, shortcigar and overlapHasSameCigar of samRead are compared on the same reads, and mergeSequences also on random overlaps.
+The first difference is shrunk to a minimal input (fewer cigar runs, shorter runs, simpler bases and qualities) and printed.
+A new engine is added to ENGINES.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from argparse import ArgumentParser
+import contextlib
+import io
+import os
+import random
+import sys
+
+FUZZDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(FUZZDIR))
+
+import aftermerge
+import batchConsensus
+import samRead
+import referenceMerge
+
+
+BASES = "ACGT"
+#the letters of the long cigars given to mergeSequences (lower case as in mismatchcigar)
+MCIGAR_LETTERS = "MMMMMMMMIDSsi"
+
+#size of the merge cache of the cached engine, small so overlaps are also evicted
+MERGE_CACHE_SIZE = 16
+
+
+def cachedBatch(pairs):
+    '''
+    function returns the (outline, errorline) of the pairs merged twice with the merge cache on, the second time in reverse order,
+    so the last overlaps merged come from the cache and the first ones are merged again after they were evicted
+    the cache is only on while merging, so the other engines do not use it
+    '''
+    aftermerge.setMergeCacheSize(MERGE_CACHE_SIZE)
+    try:
+        aftermerge.processBatch(pairs)
+        return [result[:2] for result in reversed(aftermerge.processBatch(pairs[::-1]))]
+    finally:
+        aftermerge.setMergeCacheSize(0)
+
+
+#the engines merging pairs: function taking a list of pairs (samread, materead) and returning their (outline, errorline)
+ENGINES = {
+    "scalar": lambda pairs: [result[:2] for result in aftermerge.processBatch(pairs)],
+    "numpy": lambda pairs: [result[:2] for result in aftermerge.processBatch(pairs, consensus="numpy")],
+    "cached": cachedBatch,
+}
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def availableEngines():
+    '''
+    function returns the names of the engines that can run here (numpy needs NumPy)
+    '''
+    return [name for name in ENGINES if name != "numpy" or batchConsensus.available()]
+
+
+def outcome(function, *arguments):
+    '''
+    function returns the result of the function, or the name of the exception it raised
+    what the functions print (ex. unable to resolve) is not compared
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            return function(*arguments)
+        except Exception as e:
+            return "raised {}".format(type(e).__name__)
+
+
+def referenceLength(runs):
+    return sum(length for (op, length) in runs if op in "MD")
+
+
+def normalize(runs):
+    '''
+    function returns the runs without empty runs, and adjacent runs of the same operation joined
+    '''
+    result = []
+    for (op, length) in runs:
+        if (length <= 0):
+            continue
+        if (len(result) > 0 and result[-1][0] == op):
+            result[-1] = (op, result[-1][1] + length)
+        else:
+            result.append((op, length))
+    return result
+
+
+class pairCase:
+    '''
+    a pair of reads on the same reference: a read is a dict with pos, runs (the cigar as (operation, length)), seq and qual
+    the first read is the one seen first in the input (the mate), the second the one seen last
+    '''
+
+    def __init__(self, first, second):
+        self.reads = (first, second)
+
+    def lines(self):
+        '''
+        function returns the sam lines of both reads
+        '''
+        (first, second) = self.reads
+        lines = []
+        for (read, mate, flag, mapq) in ((first, second, 99, 42), (second, first, 147, 30)):
+            cigar = "".join("{}{}".format(length, op) for (op, length) in read["runs"])
+            lines.append("pair\t{}\tchr1\t{}\t{}\t{}\t=\t{}\t0\t{}\t{}".format(flag, read["pos"], mapq, cigar, mate["pos"], read["seq"], read["qual"]))
+        return lines
+
+    def isValid(self):
+        '''
+        function returns True if both reads have a cigar with a match, and a sequence of the length of the cigar
+        '''
+        for read in self.reads:
+            if (not any(op == "M" for (op, length) in read["runs"]) or read["pos"] < 1):
+                return False
+            if (len(read["seq"]) != sum(length for (op, length) in read["runs"] if op in "MIS")):
+                return False
+        return True
+
+    def candidates(self):
+        '''
+        generator over the smaller cases: a run less, a run shorter, the mate closer, simpler bases and qualities
+        '''
+        for index in range(2):
+            read = self.reads[index]
+            #position of every run in the sequence
+            offsets = []
+            offset = 0
+            for (op, length) in read["runs"]:
+                offsets.append(offset)
+                if (op in "MIS"):
+                    offset = offset + length
+            for (runindex, (op, length)) in enumerate(read["runs"]):
+                for newlength in sorted(set((0, length // 2, length - 1))):
+                    runs = normalize(read["runs"][:runindex] + [(op, newlength)] + read["runs"][runindex+1:])
+                    (seq, qual) = (read["seq"], read["qual"])
+                    if (op in "MIS"):
+                        start = offsets[runindex] + newlength
+                        end = offsets[runindex] + length
+                        (seq, qual) = (seq[:start] + seq[end:], qual[:start] + qual[end:])
+                    yield self._replace(index, {"pos": read["pos"], "runs": runs, "seq": seq, "qual": qual})
+        (first, second) = self.reads
+        if (second["pos"] != first["pos"]):
+            step = 1 if second["pos"] < first["pos"] else -1
+            yield self._replace(1, dict(second, pos=second["pos"] + step))
+        if (first["pos"] > 1):
+            #both reads to the left
+            yield pairCase(dict(first, pos=first["pos"] - 1), dict(second, pos=second["pos"] - 1))
+        for index in range(2):
+            read = self.reads[index]
+            for (position, base) in enumerate(read["seq"]):
+                if (base != "A"):
+                    yield self._replace(index, dict(read, seq=read["seq"][:position] + "A" + read["seq"][position+1:]))
+            for (position, quality) in enumerate(read["qual"]):
+                if (quality != "5"):
+                    yield self._replace(index, dict(read, qual=read["qual"][:position] + "5" + read["qual"][position+1:]))
+
+    def _replace(self, index, read):
+        reads = list(self.reads)
+        reads[index] = read
+        return pairCase(*reads)
+
+    def describe(self):
+        return "\n".join(self.lines())
+
+
+class sequencesCase:
+    '''
+    the arguments of mergeSequences: (seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2)
+    '''
+
+    def __init__(self, arguments):
+        self.arguments = tuple(arguments)
+
+    def isValid(self):
+        return True
+
+    def candidates(self):
+        '''
+        generator over the smaller cases: a position less in one of the overlaps, the starts closer, simpler bases and qualities
+        '''
+        (seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2) = self.arguments
+        for position in range(max(len(seq1), len(qual1), len(mcigar1))):
+            yield sequencesCase((seq1[:position] + seq1[position+1:], seq2, qual1[:position] + qual1[position+1:], qual2,
+                                 mcigar1[:position] + mcigar1[position+1:], mcigar2, start1, start2))
+        for position in range(max(len(seq2), len(qual2), len(mcigar2))):
+            yield sequencesCase((seq1, seq2[:position] + seq2[position+1:], qual1, qual2[:position] + qual2[position+1:],
+                                 mcigar1, mcigar2[:position] + mcigar2[position+1:], start1, start2))
+        if (start1 != start2):
+            step = 1 if start2 < start1 else -1
+            yield sequencesCase((seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2 + step))
+        for (index, text, simple) in ((0, seq1, "A"), (1, seq2, "A"), (2, qual1, "5"), (3, qual2, "5"), (4, mcigar1, "M"), (5, mcigar2, "M")):
+            for (position, letter) in enumerate(text):
+                if (letter != simple):
+                    arguments = list(self.arguments)
+                    arguments[index] = text[:position] + simple + text[position+1:]
+                    yield sequencesCase(arguments)
+
+    def describe(self):
+        return "mergeSequences{}".format(self.arguments)
+
+
+def randomRuns(rnd, maxblock):
+    '''
+    function returns a random cigar as runs: blocks of matches, with insertions or deletions between them, and soft clips at the ends
+    '''
+    runs = []
+    if (rnd.random() < 0.25):
+        runs.append(("S", rnd.randint(1, 6)))
+    for block in range(rnd.randint(1, 3)):
+        if (block > 0):
+            runs.append((rnd.choice("ID"), rnd.randint(1, 3)))
+        runs.append(("M", rnd.randint(1, maxblock)))
+    if (rnd.random() < 0.25):
+        runs.append(("S", rnd.randint(1, 6)))
+    return runs
+
+
+def randomRead(rnd, reference, pos, runs, errorrate):
+    '''
+    function returns a read at pos (1-based) with the cigar runs: the matches from the reference (with random errors), the rest random
+    '''
+    seq = []
+    refpos = pos - 1
+    for (op, length) in runs:
+        if (op == "M"):
+            for i in range(length):
+                base = reference[refpos]
+                if (rnd.random() < errorrate):
+                    base = rnd.choice(BASES)
+                seq.append(base)
+                refpos = refpos + 1
+        elif (op == "D"):
+            refpos = refpos + length
+        else:
+            seq.extend(rnd.choice(BASES) for i in range(length))
+    qual = "".join(chr(33 + rnd.randint(2, 40)) for i in range(len(seq)))
+    return {"pos": pos, "runs": runs, "seq": "".join(seq), "qual": qual}
+
+
+def randomPair(rnd, reference, maxblock, errorrate):
+    '''
+    function returns a random pairCase, the mate starts around the first read, often on the boundary of one of its cigar runs
+    '''
+    runs = randomRuns(rnd, maxblock)
+    pos = rnd.randint(1, 50)
+    if (rnd.random() < 0.5):
+        #the boundaries of the runs of the first read on the reference (ex. an insertion at the start of the overlap)
+        boundaries = [0]
+        for (op, length) in runs:
+            boundaries.append(boundaries[-1] + (length if op in "MD" else 0))
+        offset = rnd.choice(boundaries) + rnd.randint(-1, 1)
+    else:
+        offset = rnd.randint(-3, referenceLength(runs) + 2)
+    matepos = max(1, pos + offset)
+    first = randomRead(rnd, reference, pos, runs, errorrate)
+    second = randomRead(rnd, reference, matepos, randomRuns(rnd, maxblock), errorrate)
+    if (rnd.random() < 0.5):
+        (first, second) = (second, first)
+    return pairCase(first, second)
+
+
+def randomSequences(rnd):
+    '''
+    function returns a random sequencesCase: overlaps of about the same length, mostly the same bases
+    '''
+    length = rnd.randint(0, 20)
+    seq1 = "".join(rnd.choice(BASES) for i in range(length))
+    seq2 = "".join(base if rnd.random() < 0.9 else rnd.choice(BASES) for base in seq1)
+    mcigar1 = "".join(rnd.choice(MCIGAR_LETTERS) for i in range(length))
+    mcigar2 = mcigar1
+    if (rnd.random() < 0.5):
+        mcigar2 = "".join(letter if rnd.random() < 0.9 else rnd.choice(MCIGAR_LETTERS) for letter in mcigar1)
+    if (rnd.random() < 0.2):
+        #overlaps of different length (ex. a deletion in one of the windows)
+        seq2 = seq2[:rnd.randint(0, len(seq2))]
+    qual1 = "".join(chr(33 + rnd.randint(2, 40)) for i in range(len(seq1)))
+    qual2 = "".join(chr(33 + rnd.randint(2, 40)) for i in range(len(seq2)))
+    mcigar2 = mcigar2[:len(seq2)]
+    start1 = rnd.randint(1, 10)
+    start2 = start1
+    if (rnd.random() < 0.3):
+        start2 = start1 + rnd.randint(-3, 3)
+    return sequencesCase((seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2))
+
+
+def pairDifferences(case, engines, results=None):
+    '''
+    function returns the differences of a pairCase with the reference, as a list of (check, expected, found)
+    results has the (outline, errorline) per engine when the pair is already merged (in a batch), otherwise it is merged here
+    '''
+    lines = case.lines()
+    referencereads = [referenceMerge.referenceRead(line) for line in lines]
+    reads = [samRead.samRead(line) for line in lines]
+    differences = []
+    for (referenceread, read) in zip(referencereads, reads):
+        expected = referenceMerge.longcigar(referenceread.cigar)
+        found = outcome(read.longcigar)
+        if (found != expected):
+            differences.append(("longcigar", expected, found))
+        expected = referenceMerge.shortcigar(expected)
+        found = outcome(read.shortcigar, referenceMerge.longcigar(referenceread.cigar))
+        if (found != expected):
+            differences.append(("shortcigar", expected, found))
+    for (one, other) in ((0, 1), (1, 0)):
+        expected = outcome(referencereads[one].overlapHasSameCigar, referencereads[other])
+        found = outcome(reads[one].overlapHasSameCigar, reads[other])
+        if (found != expected):
+            differences.append(("overlapHasSameCigar", expected, found))
+    expected = outcome(referenceMerge.mergePair, referencereads[1], referencereads[0])
+    for engine in engines:
+        if (results is not None):
+            found = results[engine]
+        else:
+            found = outcome(lambda: ENGINES[engine]([(reads[1], reads[0])])[0])
+        if (found != expected):
+            differences.append(("merge ({})".format(engine), expected, found))
+    return differences
+
+
+def sequencesDifferences(case, engines=None, results=None):
+    '''
+    function returns the differences of mergeSequences with the reference for a sequencesCase, as a list of (check, expected, found)
+    '''
+    expected = outcome(referenceMerge.mergeSequences, *case.arguments)
+    found = outcome(aftermerge.mergeSequences, *case.arguments)
+    if (found != expected):
+        return [("mergeSequences", expected, found)]
+    return []
+
+
+def shrink(case, differs):
+    '''
+    function returns the smallest case found (by taking the first smaller case that still differs, till none does)
+    differs is a function returning True if a case still has the difference
+    '''
+    while (True):
+        for candidate in case.candidates():
+            if (candidate.isValid() and differs(candidate)):
+                case = candidate
+                break
+        else:
+            return case
+
+
+def mergeBatch(cases, engines):
+    '''
+    function returns per case a dict with the (outline, errorline) of every engine, merging all pairs of the cases at once
+    (so the numpy engine merges the overlaps with the same start and cigar together, as in a real batch)
+    if an engine raises, the pairs are merged one by one by it
+    '''
+    pairs = []
+    for case in cases:
+        (first, second) = [samRead.samRead(line) for line in case.lines()]
+        pairs.append((second, first))
+    results = [{} for case in cases]
+    for engine in engines:
+        merged = outcome(ENGINES[engine], pairs)
+        if (isinstance(merged, str)):
+            merged = [outcome(lambda: ENGINES[engine]([pair])[0]) for pair in pairs]
+        for (result, pairresult) in zip(results, merged):
+            result[engine] = pairresult
+    return results
+
+
+def report(case, differences, label):
+    (check, expected, found) = differences[0]
+    print("Difference in {} ({}), minimal input:".format(check, label))
+    print(case.describe())
+    print("reference: {!r}".format(expected))
+    print("found:     {!r}".format(found))
+
+
+def fuzz(iterations, seed, engines, maxblock=40, errorrate=0.05, batchsize=100, verbose=False):
+    '''
+    function returns the number of differences found (0 or 1: fuzzing stops at the first) in iterations random pairs and overlaps
+    '''
+    rnd = random.Random(seed)
+    reference = "".join(rnd.choice(BASES) for i in range(1000))
+    done = 0
+    while (done < iterations):
+        count = min(batchsize, iterations - done)
+        cases = [randomPair(rnd, reference, maxblock, errorrate) for i in range(count)]
+        for (case, results) in zip(cases, mergeBatch(cases, engines)):
+            differences = pairDifferences(case, engines, results)
+            if (len(differences) > 0):
+                check = differences[0][0]
+                #shrunk with the pairs merged one by one
+                differs = lambda candidate: any(difference[0] == check for difference in pairDifferences(candidate, engines))
+                if (not differs(case)):
+                    report(case, differences, "only when merged in a batch, not shrunk")
+                    return 1
+                case = shrink(case, differs)
+                report(case, [difference for difference in pairDifferences(case, engines) if difference[0] == check], "seed {}".format(seed))
+                return 1
+        for i in range(count):
+            case = randomSequences(rnd)
+            if (len(sequencesDifferences(case)) > 0):
+                case = shrink(case, lambda candidate: len(sequencesDifferences(candidate)) > 0)
+                report(case, sequencesDifferences(case), "seed {}".format(seed))
+                return 1
+        done = done + count
+        if (verbose):
+            eprint("{} pairs and overlaps without differences".format(done))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Differential fuzzing of the merging of aftermerge against the reference implementation')
+    parser.add_argument('-n', '--iterations', help="Number of random pairs (and as many random overlaps) (default 10000)", type=int, default=10000)
+    parser.add_argument('-s', '--seed', help="Seed of the random cases (default random, the seed is printed)", type=int, default=None)
+    parser.add_argument('--engine', help="Engine to compare (default all available: {})".format(", ".join(availableEngines())), action="append", choices=sorted(ENGINES), default=None)
+    parser.add_argument('--max-block', help="Maximum length of a block of matches in the random cigars (default 40)", type=int, default=40, dest="maxblock")
+    parser.add_argument('-v', '--verbose', action="store_true")
+    args = parser.parse_args()
+
+    engines = args.engine or availableEngines()
+    if ("numpy" in engines and not batchConsensus.available()):
+        parser.error("the numpy engine needs NumPy")
+    seed = args.seed
+    if (seed is None):
+        seed = random.randrange(2**32)
+    eprint("Seed {}, engines {}".format(seed, ", ".join(engines)))
+    if (fuzz(args.iterations, seed, engines, args.maxblock, verbose=args.verbose) > 0):
+        sys.exit(1)
+    eprint("No differences in {} pairs and {} overlaps".format(args.iterations, args.iterations))
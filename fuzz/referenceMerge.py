@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+The reference implementation of merging a pair, for the differential fuzzing of fuzzMerge.
+This is the merging of the first version of aftermerge (string based long cigars, recursive mergeSequences),
+kept as it was: the faster implementations in aftermerge and samRead have to give the same results.
+Do not optimize this file.
+Only two things differ from the first version: the loops skipping the leading soft clips compared with 'is',
+which never matched, so they are left out (as in samRead), and the read only parses the fields needed for merging.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+
+
+#mergeSequences recurses once per base
+sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+
+
+def mergeSequences(seq1, seq2, qual1, qual2, mcigar1, mcigar2, start1, start2):
+    '''
+    function returns (sequence, quality) the merged sequence and quality
+    when bases in the merge match, base quality is the max
+    when they do not match, base is base with highest quality, quality is the average
+    '''
+    seq1 = str(seq1)
+    seq2 = str(seq2)
+    qual1 = str(qual1)
+    qual2 = str(qual2)
+    mcigar1 = str(mcigar1)
+    mcigar2 = str(mcigar2)
+    start1 = int(start1)
+    start2 = int(start2)
+    newseq = ""
+    newqual = ""
+    newmcigar = ""
+    if (seq1 == ""):
+        #no seq1 any more
+        return (seq2, qual2, mcigar2)
+    if (seq2 == ""):
+        #no seq2 any more
+        return (seq1, qual1, mcigar1)
+    if (start2 < start1):
+        #seq2 is before seq1
+        (newseq, newqual, newmcigar) = mergeSequences(seq1, seq2[1:], qual1, qual2[1:], mcigar1, mcigar2[1:], start1, start2+1)
+        newseq = seq2[0] + newseq
+        newqual = qual2[0] + newqual
+        newmcigar = mcigar2[0] + newmcigar
+    elif (start2 > start1):
+        #seq1 is before seq2
+        (newseq, newqual, newmcigar) = mergeSequences(seq1[1:], seq2, qual1[1:], qual2, mcigar1[1:], mcigar2, start1+1, start2)
+        newseq = seq1[0] + newseq
+        newqual = qual1[0] + newqual
+        newmcigar = mcigar1[0] + newmcigar
+    else:
+        #same pos
+        if (mcigar1[0] == mcigar2[0]):
+            #same cigar, no problem
+            (newseq, newqual, newmcigar) = mergeSequences(seq1[1:], seq2[1:], qual1[1:], qual2[1:], mcigar1[1:], mcigar2[1:], start1+1, start2+1)
+            if (seq1[0] == seq2[0]):
+                #same base, so take highest quality
+                newseq = seq1[0] + newseq
+                qual = max(qual1[0], qual2[0])
+                newqual = qual + newqual
+                newmcigar = mcigar1[0] + newmcigar
+            else:
+                #not same base, so take base with highest quality, give lowest quality
+                base = seq1[0]
+                if (qual1[0] < qual2[0]):
+                    base = seq2[0]
+                qual = min(qual1[0], qual2[0])
+                newseq = base + newseq
+                newqual = qual + newqual
+                newmcigar = mcigar1[0] + newmcigar
+        else:
+            #not same cigar
+            c1 = str(mcigar1[0])
+            c2 = str(mcigar2[0])
+            if (c1.isupper() and c2.isupper()):
+                #both match or mismatch
+                (newseq, newqual, newmcigar) = mergeSequences(seq1[1:], seq2[1:], qual1[1:], qual2[1:], mcigar1[1:], mcigar2[1:], start1+1, start2+1)
+                base = seq1[0]
+                m = mcigar1[0]
+                if (qual1[0] < qual2[0]):
+                    base = seq2[0]
+                    m = mcigar2[0]
+                qual = chr(int((ord(qual1[0]) + ord(qual2[0])) / 2))
+                newseq = seq1[0] + newseq
+                newqual = qual + newqual
+                newmcigar = m + newmcigar
+            else:
+                #one is insert, deletion or clipped
+                if (c1 == "s"):
+                    #seq1 is softclipped
+                    (newseq, newqual, newmcigar) = mergeSequences("", seq2, "", qual2, "", mcigar2, start1+1, start2+1)
+                elif (c2 == "s"):
+                    #seq2 is softclipped
+                    (newseq, newqual, newmcigar) = mergeSequences(seq1, "", qual1, "", mcigar1, "", start1+1, start2+1)
+                else:
+                    #One is insertion or deletion
+                    print("unable to resolve: {}\t{}".format(c1, c2))
+    return (newseq, newqual, newmcigar)
+
+
+def longcigar(cigar):
+    '''
+    function to change the cigar string to a long version ex.: 5M becomes MMMMM
+    '''
+    cigar = str(cigar)
+    lcigar = ""
+    b = ""
+    c=0
+    while (c<len(cigar)):
+        a = str(cigar[c])
+        if(a.isdigit()):
+            b = "{}{}".format(b, a)
+        else:
+            i=0
+            while(i<int(b)):
+                lcigar = "{}{}".format(lcigar, a)
+                i = i + 1
+            b=""
+        c=c+1
+    return lcigar
+
+
+def shortcigar(cigar):
+    '''
+    function to change the long cigar string to a normal one ex.: MMMMM becomes 5M
+    '''
+    cigar = str(cigar)
+    scigar = ""
+    c = ""
+    l = ""
+    for letter in cigar:
+        if (l == letter):
+            c = c + 1
+        else:
+            scigar = "{}{}{}".format(scigar, c, l)
+            c = 1
+            l = letter
+    scigar = "{}{}{}".format(scigar, c, l)
+    return scigar
+
+
+class referenceRead:
+    '''
+    the fields of a sam line needed for merging, and the cigar functions of the first samRead
+    '''
+
+    def __init__(self, line):
+        self.line = line
+        linearray = line.split("\t")
+        self.qname = linearray[0]
+        self.rname = linearray[2]
+        self.pos = int(linearray[3])
+        self.mapq = int(linearray[4])
+        self.cigar = linearray[5]
+        self.seq = linearray[9]
+        self.qual = linearray[10]
+        self.simpleline = "\t".join(linearray[:11])
+
+    def longcigar(self):
+        return longcigar(self.cigar)
+
+    def getLengthOnReference(self):
+        '''
+        returns the length the sequence on the reference
+        (counting all M and Ds in the cigar string)
+        '''
+        lcigar = str(self.longcigar())
+        return lcigar.count('M') + lcigar.count('D')
+
+    def isoverlapping(self, samread):
+        '''
+        function return True if both reads are overlapping
+        '''
+        if (not self.rname == samread.rname):
+            #different reference
+            return False
+        else:
+            #same reference
+            if(self.pos <= samread.pos):
+                #this is before samread
+                if (self.pos + self.getLengthOnReference() -1 >= samread.pos):
+                    #samread starts in the mapped area of this
+                    return True
+                else:
+                    #samreads start out of this area
+                    return False
+            else:
+                #samread is before this
+                if (samread.pos + samread.getLengthOnReference() -1 >= self.pos):
+                    #this starts in the mapping area of samread
+                    return True
+                else:
+                    #this start out of samreads area
+                    return  False
+
+    def overlapHasSameCigar(self, samread):
+        '''
+        function returns (true/false, start)
+            True if the cigar of the overlap is matching
+            start the start in the first sequence
+        '''
+        if (not self.isoverlapping(samread)):
+            return (False, -1, None, None, None, None)
+        #overlapping reads
+        firstread = self
+        secondread = samread
+        if (secondread.pos > firstread.pos):
+            change = secondread
+            secondread = firstread
+            firstread = change
+        seqstart = firstread.pos - secondread.pos
+        cigarstart = seqstart
+        samlcigar = str(secondread.longcigar())
+        samlcigar = samlcigar.strip("S")
+        changestart = True
+        insertions = 0
+        while(changestart):
+            newinsertions = samlcigar[0:cigarstart].count('I')
+            mcount = samlcigar[0:cigarstart].count('M')
+            if (not mcount == (firstread.pos - secondread.pos)):
+                seqstart = seqstart + 1
+                cigarstart = cigarstart + 1
+            if(newinsertions == insertions):
+                #same number of insertions, so check if next base is not an insertion
+                if (len(samlcigar) > seqstart):
+                    if (samlcigar[seqstart] == "M"):
+                        changestart = False
+                    elif (samlcigar[seqstart] == "I"):
+                        newinsertions = newinsertions + 1
+                        seqstart = seqstart + 1
+                        cigarstart = cigarstart + 1
+                    elif (samlcigar[seqstart] == "D"):
+                        #have a delition
+                        cigarstart = cigarstart + 1
+                        changestart = False
+                else:
+                    changestart = False
+            else:
+                #different number of insertions
+                insertions = newinsertions
+        #(the loop adding the leading soft clip of the second read to cigarstart never matched)
+        length = min((secondread.getLengthOnReference() - cigarstart), firstread.getLengthOnReference())
+        samlcigar = str(secondread.longcigar())[cigarstart:cigarstart+length]
+        matelcigar = str(firstread.longcigar())
+        matecigarstart = 0
+        #(the loop adding the leading soft clip of the first read to matecigarstart never matched)
+        matelcigar = matelcigar[matecigarstart:matecigarstart+length]
+        refstart = secondread.pos + str(secondread.longcigar())[0:cigarstart].count('M') + str(secondread.longcigar())[0:cigarstart].count('D')
+        if (str(samlcigar) == str(matelcigar)):
+            return (True, seqstart, cigarstart, matecigarstart, length, refstart)
+        else:
+            if (length == -1):
+                #not overlapping, but has to be connected
+                return (True, seqstart, cigarstart, matecigarstart, length, refstart)
+            return (False, seqstart, cigarstart, matecigarstart, length, refstart)
+
+    def startOfSeqOnRef(self):
+        '''
+        returns the index of the sequence, which is the first base on the reference
+        '''
+        i = 0
+        longcigar = self.longcigar()
+        while (i < len(longcigar)):
+            if (longcigar[i] != "S"):
+                return i
+            i = i +1
+        return i
+
+
+def mergePair(samread, materead):
+    '''
+    function returns (outline, errorline) for a pair of referenceReads, as the main loop of the first version
+    samread is the mate read last seen in the input, materead the one seen before
+    '''
+    if (not samread.isoverlapping(materead)):
+        #no overlap, so do not fix
+        return (samread.simpleline + "\n" + materead.simpleline, None)
+    #check which read is the first on the reference
+    if (samread.pos > materead.pos):
+        change = samread
+        samread = materead
+        materead = change
+    (sameoverlapcigar, start, cigarstart, matecigarstart, length, refstart) = samread.overlapHasSameCigar(materead)
+    if (not sameoverlapcigar):
+        #different cigar, so overlap is probably an error => add line in error file
+        errorline = "{}\t{}\t{}\t{}".format(samread.rname, refstart, refstart+length, samread.qname)
+        return (samread.line + "\n" + materead.line, errorline)
+    #get the overlapping sequence, quality and cigar for the first read
+    seq1 = samread.seq[start:start+length]
+    qual1 = samread.qual[start:start+length]
+    mcigar1 = samread.longcigar()[cigarstart:cigarstart+length]
+    #get the overlapping sequence, quality and cigar for the second read
+    start2 = materead.startOfSeqOnRef()
+    seq2 = materead.seq[start2:start2+length]
+    qual2 = materead.qual[start2:start2+length]
+    mcigar2 = materead.longcigar()[matecigarstart:matecigarstart+length]
+    #get the new sequence for the overlap
+    (newseq, newqual, newmcigar) = mergeSequences(seq1, seq2, qual1, qual2, mcigar1, mcigar2, refstart, materead.pos)
+    #correct the new sequence, by adding the non overlapping parts
+    newseq = "{}{}{}".format(samread.seq[0:start], newseq, materead.seq[start2+length:])
+    newqual = "{}{}{}".format(samread.qual[0:start], newqual, materead.qual[start2+length:])
+    newmcigar = "{}{}{}".format(samread.longcigar()[0:cigarstart], newmcigar, materead.longcigar()[matecigarstart+length:])
+    #set flag on 0: forward mapped
+    flag = 0
+    #mapping quality is the mean of both mappings
+    mapq = int((samread.mapq + materead.mapq)/2)
+    cigar = shortcigar(newmcigar)
+    outline = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}".format(samread.qname, flag, samread.rname, samread.pos, mapq, cigar, "*", "0", "0", newseq, newqual)
+    return (outline, None)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Index of intervals on the reference (ex. the regions of a blacklist bed file), for a fast check if a region overlaps one of them.
+The intervals are merged and sorted per reference, so a check is one binary search.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from bisect import bisect_left
+
+
+class intervalIndex:
+    '''
+    intervals on the reference, 0-based with the end not included (as in a bed file)
+    '''
+
+    def __init__(self, intervals=()):
+        '''
+        intervals is a list of (reference, start, end)
+        '''
+        #per reference: (starts, ends) of the merged intervals, sorted
+        self._index = {}
+        perreference = {}
+        for (reference, start, end) in intervals:
+            perreference.setdefault(reference, []).append((start, end))
+        for (reference, referenceintervals) in perreference.items():
+            starts = []
+            ends = []
+            for (start, end) in sorted(referenceintervals):
+                if (len(ends) > 0 and start <= ends[-1]):
+                    #overlapping or adjacent to the previous interval
+                    if (end > ends[-1]):
+                        ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._index[reference] = (starts, ends)
+
+    def __len__(self):
+        '''
+        function returns the number of intervals, after merging the overlapping ones
+        '''
+        return sum(len(starts) for (starts, ends) in self._index.values())
+
+    def overlaps(self, reference, start, end):
+        '''
+        function returns True if the region [start, end) on the reference overlaps an interval
+        '''
+        index = self._index.get(reference)
+        if (index is None):
+            return False
+        #the last interval starting before the end of the region, the intervals before it end before it starts
+        i = bisect_left(index[0], end) - 1
+        return (i >= 0 and index[1][i] > start)
+
+
+def readBed(path):
+    '''
+    function returns the intervalIndex of the regions in a bed file
+    header lines (track, browser, #) and empty lines are skipped, only the first 3 columns are used
+    '''
+    intervals = []
+    with open(path) as bedfile:
+        for (number, line) in enumerate(bedfile, 1):
+            if (line.strip() == "" or line.startswith("#") or line.startswith("track") or line.startswith("browser")):
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            try:
+                intervals.append((fields[0], int(fields[1]), int(fields[2])))
+            except (IndexError, ValueError):
+                raise ValueError("{} line {}: not a bed line: {}".format(path, number, line.rstrip()))
+    return intervalIndex(intervals)
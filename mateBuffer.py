@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+The buffer with the reads waiting for their mate. The memory use of the buffer can be capped,
+the oldest reads are then spilled to a temporary database on disk, and joined with their mates at the end.
+Only reads which can overlap their mate have to wait: rnext and pnext of a read tell where its mate is (predictMate),
+a read of which the mate is on another reference or starts after the end of the read is written at once.
+For input in coordinate order, waiting for a mate is given up when the input is past the position of the mate (mateDeadlines).
+The pairing itself (matePairing) is shared by all modes, which only differ in what they keep of a waiting read.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from heapq import heappop, heappush
+import os
+import sqlite3
+import tempfile
+import samRead
+
+
+#estimated memory of a buffered read besides its line (the read object, its fields and the dict entry)
+READ_OVERHEAD = 500
+
+
+#where the mate of a read is, given by predictMate
+#not known, or before the read: wait for the mate
+MATE_UNKNOWN = 0
+#on another reference: cannot overlap, which the mate also knows
+MATE_ELSEWHERE = 1
+#starts after the end of the read: cannot overlap, but the mate does not know this (it only knows the start of this read)
+MATE_AFTER = 2
+#starts in the read: overlapping
+MATE_OVERLAPPING = 3
+
+
+def predictMate(samread):
+    '''
+    function returns where the mate of the read is (MATE_UNKNOWN, MATE_ELSEWHERE, MATE_AFTER or MATE_OVERLAPPING),
+    from the rnext and pnext of the read and the end of the read on the reference
+    '''
+    rnext = samread.rnext
+    if (rnext == "*"):
+        return MATE_UNKNOWN
+    if (rnext != "=" and rnext != samread.rname):
+        return MATE_ELSEWHERE
+    pnext = int(samread.pnext)
+    if (pnext < samread.pos):
+        return MATE_UNKNOWN
+    if (pnext > samread.pos + samread.getLengthOnReference() - 1):
+        return MATE_AFTER
+    return MATE_OVERLAPPING
+
+
+class mateDeadlines:
+    '''
+    the positions after which the mates will not come any more, for input in coordinate order
+    an entry is the name of a read with the position of its mate (on the reference of the input), and something to give back when it expires
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._rname = None
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, pnext, qname, entry):
+        self._count = self._count + 1
+        heappush(self._heap, (pnext, self._count, qname, entry))
+
+    def expired(self, rname, pos):
+        '''
+        function returns the (qname, entry) of which the mate will not come any more, now the input is at pos on reference rname
+        (the input is past the position of the mate, or on another reference)
+        '''
+        heap = self._heap
+        if (rname != self._rname):
+            self._rname = rname
+            expired = [(qname, entry) for (pnext, count, qname, entry) in sorted(heap)]
+            self._heap = []
+            return expired
+        expired = []
+        while (len(heap) > 0 and heap[0][0] < pos):
+            (pnext, count, qname, entry) = heappop(heap)
+            expired.append((qname, entry))
+        return expired
+
+
+#what matePairing.pair decides for a read
+#the read waits for its mate
+PAIRING_WAIT = 0
+#the mate is found: the pair can be merged
+PAIRING_MATE = 1
+#the mate cannot overlap: the read is written at once
+PAIRING_WRITE = 2
+
+
+class matePairing:
+    '''
+    the pairing of the mates, with the reads given in input order
+    buffer keeps the reads waiting for their mate by name: a mateBuffer, or a nameBuffer for reads kept as (qname, ...)
+    counts is a dict with the read counters, updated while pairing (out_of_order, passed_through, gave_up)
+    inputorder name (mates are mostly next to each other) keeps the last read aside as pending,
+    and only puts it in the buffer if the next read is not its mate,
+    coordinate gives up waiting for a mate when the input is past the position of the mate (see giveUp)
+    passed is the set of the names of the reads written at once of which the mate was not seen, and does not know it cannot overlap
+    '''
+
+    def __init__(self, buffer, counts, inputorder="unsorted", passed=None):
+        self.buffer = buffer
+        self.counts = counts
+        counts.setdefault("out_of_order", 0)
+        counts.setdefault("passed_through", 0)
+        counts.setdefault("gave_up", 0)
+        self.namemode = (inputorder == "name")
+        #read waiting for its mate, which is expected to be the next read (name order)
+        self.pending = None
+        if (passed is None):
+            passed = set()
+        self.passed = passed
+        #the positions of the mates, for input in coordinate order
+        self.deadlines = None
+        if (inputorder == "coordinate"):
+            self.deadlines = mateDeadlines()
+
+    def giveUp(self, rname, pos):
+        '''
+        function returns the waiting reads of which the mate is not where it should be, now the input is at pos on reference rname
+        (only for input in coordinate order, and as long as no reads are spilled to disk: the mate can be there, the read then waits till the end)
+        these are removed from the buffer, and should be written before the read at pos
+        '''
+        if (self.deadlines is None):
+            return []
+        givenup = []
+        for (qname, waiting) in self.deadlines.expired(rname, pos):
+            if (waiting is None):
+                self.passed.discard(qname)
+            elif (self.buffer.spilled == 0 and self.buffer.remove(waiting)):
+                givenup.append(waiting)
+        self.counts["gave_up"] = self.counts["gave_up"] + len(givenup)
+        return givenup
+
+    def pair(self, read, qname, matewhere=None, pnext=None):
+        '''
+        function returns (decision, mate) for a read which can overlap its mate: PAIRING_MATE with the waiting mate,
+        PAIRING_WRITE (the read is written at once) or PAIRING_WAIT (the read is kept to wait for its mate) with None
+        read is what is kept of a waiting read, and given back as mate
+        matewhere is where the mate is (as given by predictMate) and pnext the position of the mate, None: taken from read (a samRead) when needed
+        '''
+        pending = self.pending
+        if (self.namemode and pending is not None and self._name(pending) == qname):
+            #the mate is the previous read
+            self.pending = None
+            return (PAIRING_MATE, pending)
+        #remove the mate from the buffer, to spare memory
+        mate = None
+        if (len(self.buffer) > 0):
+            mate = self.buffer.pop(qname)
+        if (mate is not None):
+            return (PAIRING_MATE, mate)
+        if (qname in self.passed):
+            #the mate was written at once, as it cannot overlap
+            self.passed.discard(qname)
+            self.counts["passed_through"] = self.counts["passed_through"] + 1
+            return (PAIRING_WRITE, None)
+        if (matewhere is None):
+            matewhere = predictMate(read)
+        if (matewhere == MATE_ELSEWHERE or matewhere == MATE_AFTER):
+            #the mate cannot overlap, so no need to wait for it
+            if (matewhere == MATE_AFTER):
+                self.passed.add(qname)
+                if (self.deadlines is not None):
+                    self.deadlines.add(self._pnext(read, pnext), qname, None)
+            self.counts["passed_through"] = self.counts["passed_through"] + 1
+            return (PAIRING_WRITE, None)
+        if (self.namemode):
+            #mate of this read not seen yet, keep it aside for the next read
+            if (pending is not None):
+                #the previous read was not followed by its mate
+                self.counts["out_of_order"] = self.counts["out_of_order"] + 1
+                self.buffer.add(pending)
+            self.pending = read
+            return (PAIRING_WAIT, None)
+        #mate of this read not seen yet
+        self.buffer.add(read)
+        if (self.deadlines is not None and matewhere == MATE_OVERLAPPING):
+            self.deadlines.add(self._pnext(read, pnext), qname, read)
+        return (PAIRING_WAIT, None)
+
+    def finish(self):
+        '''
+        put the pending read in the buffer, at the end of the input (the reads left in the buffer are then those without mate)
+        '''
+        if (self.pending is not None):
+            self.buffer.add(self.pending)
+            self.pending = None
+
+    @staticmethod
+    def _name(read):
+        if (isinstance(read, tuple)):
+            return read[0]
+        return read.qname
+
+    @staticmethod
+    def _pnext(read, pnext):
+        if (pnext is None):
+            return int(read.pnext)
+        return pnext
+
+
+class nameBuffer:
+    '''
+    the reads waiting for their mate, kept in memory as tuples starting with the read name (ex. the offsets of the read in the file)
+    it has the methods of mateBuffer used by matePairing, but is never spilled to disk
+    '''
+
+    def __init__(self):
+        self._reads = {}
+        self.peak = 0
+        self.peakmemory = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self._reads)
+
+    def add(self, read):
+        self._reads[read[0]] = read
+        if (len(self._reads) > self.peak):
+            self.peak = len(self._reads)
+
+    def pop(self, qname):
+        return self._reads.pop(qname, None)
+
+    def remove(self, read):
+        '''
+        function returns True if the read was waiting, and removes it from the buffer
+        '''
+        if (self._reads.get(read[0]) is not read):
+            return False
+        del self._reads[read[0]]
+        return True
+
+    def leftovers(self):
+        '''
+        generator over the reads left at the end, in arrival order
+        '''
+        reads = self._reads
+        self._reads = {}
+        for read in reads.values():
+            yield read
+
+
+def estimateReadMemory(samread):
+    '''
+    function returns the estimated number of bytes a buffered read uses
+    (the line, and the fields split from it)
+    '''
+    return 2 * len(samread.line) + READ_OVERHEAD
+
+
+class mateBuffer:
+    '''
+    the reads waiting for their mate, by read name
+    when maxmemory (in bytes) is given, the oldest reads are spilled to disk when the estimated memory exceeds it
+    '''
+
+    def __init__(self, maxmemory=None, tmpdir=None):
+        self._reads = {}
+        self._maxmemory = maxmemory
+        self._tmpdir = tmpdir
+        self._database = None
+        self._databasefile = None
+        #arrival number of the reads, to join the spilled reads in arrival order
+        self._arrival = 0
+        self.memory = 0
+        self.peak = 0
+        self.peakmemory = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self._reads)
+
+    def __contains__(self, qname):
+        return qname in self._reads
+
+    def add(self, samread):
+        '''
+        add a read waiting for its mate
+        '''
+        self._arrival = self._arrival + 1
+        self._reads[samread.qname] = (self._arrival, samread)
+        if (len(self._reads) > self.peak):
+            self.peak = len(self._reads)
+        if (self._maxmemory is not None):
+            self.memory = self.memory + estimateReadMemory(samread)
+            if (self.memory > self.peakmemory):
+                self.peakmemory = self.memory
+            if (self.memory > self._maxmemory):
+                self._spill()
+
+    def pop(self, qname):
+        '''
+        function returns the waiting read with this name, and removes it from the buffer
+        returns None if there is no such read in memory
+        '''
+        entry = self._reads.pop(qname, None)
+        if (entry is None):
+            return None
+        if (self._maxmemory is not None):
+            self.memory = self.memory - estimateReadMemory(entry[1])
+        return entry[1]
+
+    def remove(self, samread):
+        '''
+        function returns True if the read was waiting in memory, and removes it from the buffer
+        '''
+        entry = self._reads.get(samread.qname)
+        if (entry is None or entry[1] is not samread):
+            return False
+        self.pop(samread.qname)
+        return True
+
+    def _openDatabase(self):
+        (handle, self._databasefile) = tempfile.mkstemp(prefix="aftermerge.", suffix=".spill.db", dir=self._tmpdir)
+        os.close(handle)
+        self._database = sqlite3.connect(self._databasefile)
+        self._database.execute("PRAGMA journal_mode = OFF")
+        self._database.execute("PRAGMA synchronous = OFF")
+        self._database.execute("CREATE TABLE reads (qname TEXT, arrival INTEGER, line TEXT)")
+
+    def _spill(self):
+        '''
+        move the oldest reads to disk, till the memory is under 90% of the maximum
+        '''
+        if (self._database is None):
+            self._openDatabase()
+        rows = []
+        target = self._maxmemory * 0.9
+        while (self.memory > target and len(self._reads) > 0):
+            qname = next(iter(self._reads))
+            (arrival, samread) = self._reads.pop(qname)
+            self.memory = self.memory - estimateReadMemory(samread)
+            rows.append((qname, arrival, samread.line))
+        self._database.executemany("INSERT INTO reads VALUES (?, ?, ?)", rows)
+        self.spilled = self.spilled + len(rows)
+
+    def leftovers(self):
+        '''
+        generator over the reads left at the end, after all reads are added
+        yields a samRead for a read without mate, or a tuple (samread, materead) for mates of which one was spilled
+        without spilling, the reads are given in arrival order
+        '''
+        if (self._database is None):
+            for qname in self._reads:
+                yield self._reads[qname][1]
+            self._reads = {}
+            return
+        #join all reads on disk, by name and in arrival order
+        self._database.executemany("INSERT INTO reads VALUES (?, ?, ?)",
+                                   ((qname, arrival, samread.line) for (qname, (arrival, samread)) in self._reads.items()))
+        self._reads = {}
+        self.memory = 0
+        previous = None
+        for (qname, line) in self._database.execute("SELECT qname, line FROM reads ORDER BY qname, arrival"):
+            samread = samRead.samRead(line)
+            if (previous is not None and previous.qname == qname):
+                yield (samread, previous)
+                previous = None
+            else:
+                if (previous is not None):
+                    yield previous
+                previous = samread
+        if (previous is not None):
+            yield previous
+        self.close()
+
+    def close(self):
+        '''
+        remove the database on disk
+        '''
+        if (self._database is not None):
+            self._database.close()
+            self._database = None
+            os.remove(self._databasefile)
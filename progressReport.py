@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Progress of a run, reported every few seconds by a background thread: reads/s, MB/s, the merged and failed pairs so far,
+the reads waiting for their mate, the resident memory and the expected time left (when the size of the input is known).
+As the report comes from its own thread, a run waiting for its input still reports (with 0 reads/s).
+The same numbers can be written to a metrics file in the textfile format of Prometheus (for the node exporter),
+the file is replaced at once, so it is never read half written.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+#the metrics in the metrics file: (name, type, help, key in the values of progressReporter.sample)
+METRICS = (
+    ("aftermerge_reads_total", "counter", "Reads read from the input", "reads"),
+    ("aftermerge_input_bytes_total", "counter", "Bytes read from the input", "bytes"),
+    ("aftermerge_merged_pairs_total", "counter", "Pairs merged", "merged"),
+    ("aftermerge_failed_merges_total", "counter", "Pairs of which the overlap could not be merged", "failed"),
+    ("aftermerge_reads_per_second", "gauge", "Reads per second since the previous report", "readrate"),
+    ("aftermerge_input_bytes_per_second", "gauge", "Bytes read per second since the previous report", "byterate"),
+    ("aftermerge_reads_waiting_for_mate", "gauge", "Reads waiting for their mate", "waiting"),
+    ("aftermerge_resident_memory_bytes", "gauge", "Resident memory of the process", "rss"),
+    ("aftermerge_elapsed_seconds", "gauge", "Time since the start of the run", "elapsed"),
+    ("aftermerge_eta_seconds", "gauge", "Expected time till the end of the run", "eta"),
+    ("aftermerge_done", "gauge", "1 when the run is done", "done"),
+)
+
+
+def residentMemory():
+    '''
+    function returns the resident memory of this process in bytes (from /proc/self/statm), None if not known
+    '''
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class countingRaw(io.RawIOBase):
+    '''
+    unbuffered input file counting the bytes read from raw (an unbuffered binary file) in bytes
+    the count is of the input only, not of the other files and pipes read by the process (ex. the results of the workers)
+    '''
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self._raw.readinto(buffer)
+        if (count is not None):
+            self.bytes = self.bytes + count
+        return count
+
+    @property
+    def name(self):
+        return self._raw.name
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def close(self):
+        if (not self.closed):
+            self._raw.close()
+        super().close()
+
+
+def inputSize(path):
+    '''
+    function returns the size of the input file in bytes, None if not known (ex. a pipe), - is stdin
+    '''
+    try:
+        if (path == "-"):
+            stat = os.fstat(sys.stdin.fileno())
+        else:
+            stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if (stat.st_size == 0):
+        return None
+    return stat.st_size
+
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+class progressReporter:
+    '''
+    reports the progress of a run every interval seconds, to output (None: not reported) and to metricsfile (None: not written)
+    inputsize is the size of the input in bytes, for the expected time left (None: not known)
+    label is the value of the input label of the metrics
+    the bytes read are counted by the countingRaw made by countInput, which the input is read through (no MB/s and time left without)
+    '''
+
+    def __init__(self, interval=10, inputsize=None, metricsfile=None, label="", output=sys.stderr):
+        self.interval = interval
+        self.inputsize = inputsize
+        self.metricsfile = metricsfile
+        self.label = label
+        self.output = output
+        self._input = None
+        self._countbytes = False
+        self._starttime = time.monotonic()
+        self._statistics = None
+        self._previous = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def countInput(self, raw):
+        '''
+        function returns a countingRaw for raw (an unbuffered binary file), of which the bytes read are reported
+        '''
+        self._input = countingRaw(raw)
+        return self._input
+
+    def start(self, statistics, countbytes=True):
+        '''
+        start reporting the progress of a run kept in statistics (a mergeStatistics)
+        countbytes is False when the input is not read by this process (ex. the sharded mode), then there is no MB/s and no time left
+        '''
+        self._statistics = statistics
+        self._countbytes = countbytes and self._input is not None
+        self._previous = (time.monotonic(), 0, 0)
+        self._thread = threading.Thread(target=self._run, name="aftermerge-progress", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while (not self._stop.wait(self.interval)):
+            self.report()
+
+    def stop(self):
+        '''
+        stop reporting, the last report is done with the final numbers
+        '''
+        self._stop.set()
+        if (self._thread is not None):
+            self._thread.join()
+        self.report(done=True)
+
+    def sample(self, done=False):
+        '''
+        function returns a dict with the numbers of the progress now
+        '''
+        now = time.monotonic()
+        statistics = self._statistics
+        reads = statistics.counts["total_reads"]
+        readbytes = None
+        if (self._countbytes):
+            readbytes = self._input.bytes
+        (previoustime, previousreads, previousbytes) = self._previous
+        self._previous = (now, reads, readbytes or 0)
+        elapsed = now - self._starttime
+        interval = max(now - previoustime, 1e-9)
+        waiting = 0
+        if (statistics.buffer is not None):
+            waiting = len(statistics.buffer)
+        values = {"reads": reads, "bytes": readbytes, "merged": statistics.merged, "failed": statistics.failed,
+                  "readrate": (reads - previousreads) / interval, "byterate": None, "waiting": waiting, "rss": residentMemory(),
+                  "elapsed": elapsed, "eta": None, "done": int(done)}
+        if (readbytes is not None):
+            values["byterate"] = (readbytes - previousbytes) / interval
+            if (done):
+                values["eta"] = 0.0
+            elif (self.inputsize is not None and readbytes > 0):
+                #at the average speed of the run so far
+                values["eta"] = max(self.inputsize - readbytes, 0) * elapsed / readbytes
+        return values
+
+    def formatLine(self, values):
+        '''
+        function returns the progress as one line of text
+        '''
+        parts = ["{} reads ({} reads/s".format(values["reads"], round(values["readrate"]))]
+        if (values["byterate"] is not None):
+            parts[0] = parts[0] + ", {} MB/s".format(round(values["byterate"] / (1024 * 1024), 1))
+        parts[0] = parts[0] + ")"
+        parts.append("{} merged".format(values["merged"]))
+        parts.append("{} failed".format(values["failed"]))
+        parts.append("{} waiting for mate".format(values["waiting"]))
+        if (values["rss"] is not None):
+            parts.append("RSS {} MB".format(round(values["rss"] / (1024 * 1024), 1)))
+        parts.append("{} elapsed".format(formatDuration(values["elapsed"])))
+        if (values["eta"] is not None):
+            parts.append("ETA {}".format(formatDuration(values["eta"])))
+        return "Progress: " + ", ".join(parts)
+
+    def formatMetrics(self, values):
+        '''
+        function returns the metrics in the textfile format of Prometheus, the numbers that are not known are left out
+        '''
+        label = self.label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        lines = []
+        for (name, metrictype, description, key) in METRICS:
+            if (values[key] is None):
+                continue
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, metrictype))
+            lines.append('{}{{input="{}"}} {}'.format(name, label, round(values[key], 3)))
+        return "\n".join(lines) + "\n"
+
+    def writeMetrics(self, values):
+        '''
+        write the metrics file: to a temporary file in the same directory, which then replaces the metrics file
+        '''
+        directory = os.path.dirname(os.path.abspath(self.metricsfile))
+        (handle, name) = tempfile.mkstemp(prefix=".aftermerge.", suffix=".prom.tmp", dir=directory)
+        try:
+            with os.fdopen(handle, "w") as metrics:
+                metrics.write(self.formatMetrics(values))
+            os.chmod(name, 0o644)
+            os.replace(name, self.metricsfile)
+        except BaseException:
+            os.remove(name)
+            raise
+
+    def report(self, done=False):
+        '''
+        report the progress now
+        '''
+        if (self._statistics is None):
+            return
+        values = self.sample(done)
+        if (self.output is not None):
+            print(self.formatLine(values), file=self.output)
+        if (self.metricsfile is not None):
+            try:
+                self.writeMetrics(values)
+            except OSError as e:
+                #the run goes on without metrics
+                print("Cannot write the metrics file {}: {}".format(self.metricsfile, e), file=sys.stderr)
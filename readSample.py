@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Sampling of the reads by name, for a quick estimate of the statistics of a large input (--stats-only --sample-fraction).
+A read is in the sample when the crc32 of its name is under the fraction of all crc32 values, so both mates are kept or
+dropped together, and the same fraction of the same file gives the same sample.
+The rates of the sample are given with Wilson score intervals.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+from zlib import crc32
+
+
+#z of a 95% interval
+Z_95 = 1.959963984540054
+
+
+def sampledLines(lines, fraction):
+    '''
+    generator over the header lines and the lines of the reads in the sample (lines in str or bytes)
+    '''
+    threshold = int(fraction * 2**32)
+    #type of the lines, set on the first line
+    binary = None
+    for line in lines:
+        if (binary is None):
+            binary = isinstance(line, bytes)
+            (headerstart, tab) = ("@", "\t")
+            if (binary):
+                (headerstart, tab) = (b"@", b"\t")
+        if (line[:1] == headerstart):
+            yield line
+            continue
+        qname = line[:line.find(tab)]
+        if (not binary):
+            qname = qname.encode("ascii")
+        if (crc32(qname) < threshold):
+            yield line
+
+
+def wilsonInterval(successes, trials, z=Z_95):
+    '''
+    function returns (low, high): the Wilson score interval of the fraction successes/trials, (0.0, 1.0) without trials
+    '''
+    if (trials <= 0):
+        return (0.0, 1.0)
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return (max(0.0, centre - margin), min(1.0, centre + margin))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Profile of a run: the wall and cpu time per stage, the lengths of the overlaps and the causes of failed merges.
+The code only keeps a profile when asked for (--stats-json), otherwise the profile is None and nothing is measured.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import samRead
+
+
+#the stages of a run, waiting is the time the main process waits for the workers
+STAGES = ("parsing", "pairing", "overlap_check", "merging", "output", "waiting")
+#causes of a failed merge
+FAILURE_CAUSES = ("indel", "softclip", "cigar_mismatch")
+
+
+class runProfile:
+    '''
+    the time spent per stage, measured by switching from stage to stage
+    the time between two switches is added to the stage switched from
+    '''
+
+    def __init__(self):
+        self.wall = dict.fromkeys(STAGES, 0.0)
+        self.cpu = dict.fromkeys(STAGES, 0.0)
+        self.overlaplengths = {}
+        self.failures = dict.fromkeys(FAILURE_CAUSES, 0)
+        self._stage = None
+        self._wall = 0.0
+        self._cpu = 0.0
+
+    def switch(self, stage):
+        '''
+        start the given stage, the time since the previous switch goes to the previous stage
+        '''
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        if (self._stage is not None):
+            self.wall[self._stage] = self.wall[self._stage] + wall - self._wall
+            self.cpu[self._stage] = self.cpu[self._stage] + cpu - self._cpu
+        self._stage = stage
+        self._wall = wall
+        self._cpu = cpu
+
+    def stop(self):
+        '''
+        end the current stage
+        '''
+        self.switch(None)
+
+    def addOverlap(self, length):
+        self.overlaplengths[length] = self.overlaplengths.get(length, 0) + 1
+
+    def addFailure(self, cause):
+        self.failures[cause] = self.failures[cause] + 1
+
+    def merge(self, other):
+        '''
+        add the times and counts of another profile (ex. of a worker process)
+        '''
+        for stage in STAGES:
+            self.wall[stage] = self.wall[stage] + other.wall[stage]
+            self.cpu[stage] = self.cpu[stage] + other.cpu[stage]
+        for (length, count) in other.overlaplengths.items():
+            self.overlaplengths[length] = self.overlaplengths.get(length, 0) + count
+        for cause in FAILURE_CAUSES:
+            self.failures[cause] = self.failures[cause] + other.failures[cause]
+
+    def toDict(self):
+        '''
+        function returns the profile as dict, for the json report
+        '''
+        return {
+            "stages": {stage: {"wall_seconds": round(self.wall[stage], 6), "cpu_seconds": round(self.cpu[stage], 6)} for stage in STAGES},
+            "overlap_lengths": {str(length): self.overlaplengths[length] for length in sorted(self.overlaplengths)},
+            "failed_merges": dict(self.failures),
+        }
+
+
+def failureCause(runs, start, materuns, matestart, length):
+    '''
+    function returns the cause of a failed merge, from the cigar windows of the overlap of both reads
+    indel if one of them has an insertion or deletion, softclip if one is soft clipped, otherwise cigar_mismatch
+    '''
+    ops = set(op for (op, oplength) in samRead.cigarWindow(runs, start, start+length))
+    ops.update(op for (op, oplength) in samRead.cigarWindow(materuns, matestart, matestart+length))
+    if ("I" in ops or "D" in ops):
+        return "indel"
+    if ("S" in ops):
+        return "softclip"
+    return "cigar_mismatch"
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Splitting of a sam file on disk in chunks of lines, which can be parsed separately (one chunk per worker at a time).
+The file is memory mapped, and the chunks are byte ranges starting after a newline.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import mmap
+import os
+import stat
+
+
+def canMap(path):
+    '''
+    function returns True if the file can be memory mapped: a regular file which is not empty (not stdin or a pipe)
+    '''
+    if (path == "-"):
+        return False
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    return (stat.S_ISREG(info.st_mode) and info.st_size > 0)
+
+
+def mapFile(path):
+    '''
+    function returns the file memory mapped, read only
+    '''
+    with open(path, "rb") as samfile:
+        return mmap.mmap(samfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def lineEnd(data, offset):
+    '''
+    function returns the offset after the end of the line at offset (after the newline, or the end of data)
+    '''
+    end = data.find(b"\n", offset)
+    if (end < 0):
+        return len(data)
+    return end + 1
+
+
+def headerLines(data):
+    '''
+    function returns (lines, offset): the header lines at the start of the file (without newline) and the offset of the first read
+    '''
+    lines = []
+    offset = 0
+    while (offset < len(data) and data[offset:offset+1] == b"@"):
+        end = lineEnd(data, offset)
+        lines.append(data[offset:end].rstrip())
+        offset = end
+    return (lines, offset)
+
+
+def chunkRanges(data, start, chunksize):
+    '''
+    function returns the chunks of the file from start, as (start, end) of about chunksize bytes
+    every chunk ends after a newline (the last one at the end of the file)
+    '''
+    ranges = []
+    while (start < len(data)):
+        end = min(start + chunksize, len(data))
+        if (end < len(data)):
+            end = lineEnd(data, end - 1)
+        ranges.append((start, end))
+        start = end
+    return ranges
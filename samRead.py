@@ -27,72 +27,258 @@ along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
  
 """
 
+from functools import lru_cache
+from itertools import groupby
 
-class samRead:
-    
-    def __init__(self, line):
+
+#bits of the sam flag
+FLAG_PAIRED = 0x1
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_FIRST = 0x40
+FLAG_SECOND = 0x80
+FLAG_SECONDARY = 0x100
+#bits which make a read no merge candidate: unmapped, mate unmapped or secondary
+_FLAG_NO_CANDIDATE = FLAG_UNMAPPED | FLAG_MATE_UNMAPPED | FLAG_SECONDARY
+
+
+def isMergeCandidate(flag):
+    '''
+    function returns True if a read with this flag can be merged with its mate:
+    first or second read of a pair, both mapped, and not a secondary alignment
+    '''
+    return (flag & (FLAG_FIRST | FLAG_SECOND) != 0 and flag & _FLAG_NO_CANDIDATE == 0)
+
+
+def simpleLine(line, tab="\t"):
+    '''
+    function returns the sam line with only the 11 mandatory fields
+    for a line in bytes, tab is b"\t"
+    '''
+    return tab.join(line.split(tab, 11)[:11])
+
+
+def parseCigar(cigar):
+    '''
+    function returns the cigar string as a list of (operation, length) runs ex.: 5M2S becomes [("M", 5), ("S", 2)]
+    an unavailable cigar (*) has no runs
+    '''
+    runs = []
+    b = 0
+    for a in cigar:
+        if (a.isdigit()):
+            b = b * 10 + int(a)
+        elif (a != "*"):
+            runs.append((a, b))
+            b = 0
+    return runs
+
+
+def runsFromLongcigar(lcigar):
+    '''
+    function returns the runs of a long cigar string ex.: MMMMMSS becomes [("M", 5), ("S", 2)]
+    '''
+    return [(op, len(list(group))) for (op, group) in groupby(lcigar)]
+
+
+def cigarFromRuns(runs):
+    '''
+    function returns the normal cigar string of a list of runs, neighbouring runs of the same operation are joined
+    '''
+    return "".join("{}{}".format(length, op) for (op, length) in normalizeRuns(runs))
+
+
+def normalizeRuns(runs):
+    '''
+    function returns the runs with neighbouring runs of the same operation joined, and empty runs removed
+    two cigars are the same when their normalized runs are the same
+    '''
+    normalized = []
+    for (op, length) in runs:
+        if (length <= 0):
+            continue
+        if (len(normalized) > 0 and normalized[-1][0] == op):
+            normalized[-1] = (op, normalized[-1][1] + length)
+        else:
+            normalized.append((op, length))
+    return normalized
+
+
+def expandRuns(runs):
+    '''
+    function returns the long cigar string of the runs ex.: [("M", 5)] becomes MMMMM
+    '''
+    return "".join(op * length for (op, length) in runs)
+
+
+def runsLength(runs):
+    '''
+    function returns the length of the long cigar string of the runs
+    '''
+    return sum(length for (op, length) in runs)
+
+
+def cigarWindow(runs, start, stop):
+    '''
+    function returns the runs of the long cigar window [start:stop]
+    start and stop follow the python slicing rules (negative values count from the end, None is the end)
+    '''
+    (start, stop, step) = slice(start, stop).indices(runsLength(runs))
+    window = []
+    if (stop <= start):
+        return window
+    runstart = 0
+    for (op, length) in runs:
+        runstop = runstart + length
+        if (runstop > start and runstart < stop):
+            window.append((op, min(runstop, stop) - max(runstart, start)))
+        if (runstop >= stop):
+            break
+        runstart = runstop
+    return window
+
+
+def countInRuns(runs, stop, ops):
+    '''
+    function returns the number of positions with one of the operations ops in the long cigar window [0:stop]
+    '''
+    count = 0
+    runstart = 0
+    for (op, length) in runs:
+        if (runstart >= stop):
+            break
+        if (op in ops):
+            count = count + min(length, stop - runstart)
+        runstart = runstart + length
+    return count
+
+
+def operationAt(runs, index):
+    '''
+    function returns the operation on position index of the long cigar, None if out of the cigar
+    '''
+    runstart = 0
+    for (op, length) in runs:
+        runstart = runstart + length
+        if (index < runstart):
+            return op
+    return None
+
+
+def leadingSoftclip(runs):
+    '''
+    function returns the number of soft clipped positions at the start of the cigar
+    '''
+    clipped = 0
+    for (op, length) in runs:
+        if (op != "S"):
+            break
+        clipped = clipped + length
+    return clipped
+
+
+def trailingSoftclip(runs):
+    '''
+    function returns the number of soft clipped positions at the end of the cigar
+    '''
+    return leadingSoftclip(reversed(runs))
+
+
+class parsedCigar:
+    '''
+    a parsed cigar string, with the values of it needed for the merging
+    these are shared by all reads with the same cigar (see cachedCigar), so they should not be changed
+    '''
+
+    __slots__ = ("runs", "length", "referencelength", "leadingsoftclip", "trailingsoftclip", "unclippedruns", "_expanded")
+
+    def __init__(self, cigar):
+        #the runs are a tuple, so a shared cigar can not be changed by accident
+        self.runs = tuple(parseCigar(cigar))
+        self.length = runsLength(self.runs)
+        self.referencelength = sum(length for (op, length) in self.runs if op == "M" or op == "D")
+        self.leadingsoftclip = leadingSoftclip(self.runs)
+        self.trailingsoftclip = trailingSoftclip(self.runs)
+        #the runs without the soft clipping at both ends
+        unclipped = list(self.runs)
+        while (len(unclipped) > 0 and unclipped[0][0] == "S"):
+            unclipped.pop(0)
+        while (len(unclipped) > 0 and unclipped[-1][0] == "S"):
+            unclipped.pop()
+        self.unclippedruns = tuple(unclipped)
+        self._expanded = None
+
+    @property
+    def expanded(self):
         '''
-        initiate all variables
+        the long cigar string, ex.: 5M becomes MMMMM (only made when asked for)
         '''
-        self._line = line
-        self._linearray = line.split("\t")
-        self._binflag = self._tobin()
-        
-    @property
-    def line(self):
-        return str(self._line)
+        if (self._expanded is None):
+            self._expanded = expandRuns(self.runs)
+        return self._expanded
+
+
+#number of parsed cigars kept: in real data a few cigars are used by most reads
+CIGAR_CACHE_SIZE = 4096
+cachedCigar = lru_cache(maxsize=CIGAR_CACHE_SIZE)(parsedCigar)
+
+
+def setCigarCacheSize(size):
+    '''
+    set the number of parsed cigars kept by cachedCigar (0: no caching), the cache is emptied
+    '''
+    global cachedCigar
+    cachedCigar = lru_cache(maxsize=size)(parsedCigar)
+
+
+def cigarCacheSize():
+    '''
+    function returns the number of parsed cigars kept by cachedCigar
+    '''
+    return cachedCigar.cache_info().maxsize
+
+
+def cigarCacheCounts():
+    '''
+    function returns (hits, misses) of cachedCigar, since its size was set
+    '''
+    info = cachedCigar.cache_info()
+    return (info.hits, info.misses)
+
+
+class samRead:
     
-    @property
-    def qname(self):
-        return str(self._linearray[0])
-        
-    @property
-    def flag(self):
-        return int(self._linearray[1])
-        
-    @property
-    def rname(self):
-        return str(self._linearray[2])
-        
-    @property
-    def pos(self):
-        return int(self._linearray[3])
-        
-    @property
-    def mapq(self):
-        return int(self._linearray[4])
-        
-    @property
-    def cigar(self):
-        return str(self._linearray[5])
-        
-    @property
-    def rnext(self):
-        return str(self._linearray[6])
-        
-    @property
-    def pnext(self):
-        return str(self._linearray[7])
-        
-    @property
-    def tlen(self):
-        return int(self._linearray[8])
+    #no __dict__ per read: many reads are kept in memory while waiting for their mate
+    __slots__ = ("line", "qname", "flag", "rname", "pos", "mapq", "cigar", "rnext", "pnext", "tlen", "seq", "qual", "_tags", "_cigar")
     
-    @property
-    def seq(self):
-        return str(self._linearray[9])
-        
-    @property
-    def qual(self):
-        return str(self._linearray[10])
+    def __init__(self, line):
+        '''
+        initiate all variables, the numeric fields are parsed once
+        the optional fields are kept as one string, and only split when needed
+        '''
+        self.line = line
+        linearray = line.split("\t", 11)
+        self.qname = linearray[0]
+        self.flag = int(linearray[1])
+        self.rname = linearray[2]
+        self.pos = int(linearray[3])
+        self.mapq = int(linearray[4])
+        self.cigar = linearray[5]
+        self.rnext = linearray[6]
+        self.pnext = linearray[7]
+        self.tlen = int(linearray[8])
+        self.seq = linearray[9]
+        self.qual = linearray[10]
+        self._tags = ""
+        if (len(linearray) > 11):
+            self._tags = linearray[11]
+        self._cigar = None
         
     @property
     def editDistance(self):
         editdist = -1
-        if (len(self._linearray) <= 11):
-            return -1
-        for i in range(11, len(self._linearray)):
-            field = str(self._linearray[i])
+        for field in self._tags.split("\t"):
             if (field.startswith("NM:")):
                 fieldArray = field.split(":")
                 editdist = fieldArray[2]
@@ -101,10 +287,7 @@ class samRead:
     @property
     def mismatchPositions(self):
         mispos = None
-        if (len(self._linearray) <= 11):
-            return None
-        for i in range(11, len(self._linearray)):
-            field = str(self._linearray[i])
+        for field in self._tags.split("\t"):
             if (field.startswith("MD:")):
                 fieldArray = field.split(":")
                 mispos = str(fieldArray[2])
@@ -112,29 +295,7 @@ class samRead:
         
     @property
     def simpleline(self):
-        simpleline = "{name}\t{flag}\t{rname}\t{pos}\t{mapq}\t{cigar}\t{rnext}\t{pnext}\t{tlen}\t{seq}\t{qual}".format(
-            name=self.qname, flag=self.flag, rname=self.rname, pos=self.pos, mapq=self.mapq, cigar=self.cigar, 
-            rnext=self.rnext, pnext=self.pnext, tlen=self.tlen, seq=self.seq, qual=self.qual)
-        return str(simpleline)
-            
-        
-    def _tobin(self):
-        '''
-        function to change the flag to a binary coding
-        '''
-        flag = int(self.flag)
-        r = ""
-        while(int(flag) is not 0):
-            if (flag % 2 == 0):
-                r = "{}{}".format("0", r)
-            else:
-                r = "{}{}".format("1",r)
-            flag = int(flag / 2)
-        i=len(r)
-        while(i<9):
-            r= "0{}".format(r)
-            i = i+1
-        return r
+        return simpleLine(self.line)
             
     def ispair(self):
         '''
@@ -152,74 +313,65 @@ class samRead:
         '''
         function return True if read is secondary alignment
         '''
-        binflag = str(self._binflag)
-        return (int(binflag[len(binflag)-9]) == 1)
+        return (self.flag & FLAG_SECONDARY != 0)
             
     def hasMultipleSegments(self):
         '''
         function return True if the read has multiple segments
         '''
-        binflag = str(self._binflag)
-        return (int(binflag[len(binflag)-1]) == 1)
+        return (self.flag & FLAG_PAIRED != 0)
             
     
     def ismapped(self):
         '''
         function return True if this read is mapped
         '''
-        binflag = str(self._binflag)
-        return (int(binflag[len(binflag)-3]) == 0)
+        return (self.flag & FLAG_UNMAPPED == 0)
     
     
     def ismatemapped(self):
         '''
         function returns True if pair read is mapped
         '''
-        binflag = str(self._binflag)
-        return (int(binflag[len(binflag)-4]) == 0)
+        return (self.flag & FLAG_MATE_UNMAPPED == 0)
     
     def isfirst(self):
         '''
         function returns True if this is the first read in the pair
         '''
-        binflag = str(self._binflag)
-        return (int(binflag[len(binflag)-7]) == 1)
+        return (self.flag & FLAG_FIRST != 0)
             
     def issecond(self):
         '''
         function returns True if this is the second read in the pair
         '''
-        binflag = str(self._binflag)
-        return (int(binflag[len(binflag)-8]) == 1)
+        return (self.flag & FLAG_SECOND != 0)
     
     def isreverse(self):
         '''
         function returns True if this read is reverse on the reference genome
         '''
-        binflag = str(self._binflag)
-        return (int(binflag[len(binflag)-5]) == 1)
+        return (self.flag & FLAG_REVERSE != 0)
+    
+    def parsedCigar(self):
+        '''
+        function returns the parsedCigar of the cigar, shared with the other reads with the same cigar
+        '''
+        if (self._cigar is None):
+            self._cigar = cachedCigar(self.cigar)
+        return self._cigar
+
+    def cigarRuns(self):
+        '''
+        function returns the cigar as tuple of (operation, length) runs
+        '''
+        return self.parsedCigar().runs
     
     def longcigar(self):
         '''
         function to change the cigar string to a long version ex.: 5M becomes MMMMM
         '''
-        cigar = str(self.cigar)
-        lcigar = ""
-        b = ""
-        c=0
-        while (c<len(cigar)):
-            a = str(cigar[c])
-            #if(char ~ /^[0-9]$/):
-            if(a.isdigit()):
-                b = "{}{}".format(b, a)
-            else:
-                i=0
-                while(i<int(b)):
-                    lcigar = "{}{}".format(lcigar, a)
-                    i = i + 1
-                b=""
-            c=c+1
-        return lcigar
+        return self.parsedCigar().expanded
         
         
     def _mismatchString(self):
@@ -293,28 +445,24 @@ class samRead:
         '''
         function to change the long cigar string to a normal one ex.: MMMMM becomes 5M
         '''
-        cigar = str(cigar)
-        scigar = ""
-        c = ""
-        l = ""
-        for letter in cigar:
-            if (l == letter):
-                c = c + 1
-            else:
-                scigar = "{}{}{}".format(scigar, c, l)
-                c = 1
-                l = letter
-        scigar = "{}{}{}".format(scigar, c, l)
-        return scigar
+        return cigarFromRuns(runsFromLongcigar(str(cigar)))
         
     def getLengthOnReference(self):
         '''
         returns the length the sequence on the reference
         (counting all M and Ds in the cigar string)
         '''
-        lcigar = str(self.longcigar())
-        return lcigar.count('M') + lcigar.count('D')
+        return self.parsedCigar().referencelength
         
+    def overlapOnReference(self, samread):
+        '''
+        function returns (start, end) of the overlap of both reads on the reference (0-based, end not included, as in a bed file)
+        only for overlapping reads
+        '''
+        start = max(self.pos, samread.pos) - 1
+        end = min(self.pos + self.getLengthOnReference(), samread.pos + samread.getLengthOnReference()) - 1
+        return (start, end)
+
     def isoverlapping(self, samread):
         '''
         function return True if both reads are overlapping
@@ -360,59 +508,49 @@ class samRead:
             change = secondread
             secondread = firstread
             firstread = change
-        seqstart = firstread.pos - secondread.pos
+        distance = firstread.pos - secondread.pos
+        seqstart = distance
         cigarstart = seqstart
-        samlcigar = str(secondread.longcigar())
-        samlcigar = samlcigar.strip("S")
+        secondruns = secondread.cigarRuns()
+        firstruns = firstread.cigarRuns()
+        #the cigar of the second read without the soft clipping at both ends
+        samruns = secondread.parsedCigar().unclippedruns
+        samlength = runsLength(samruns)
         #TODO include I and D into calculations
-        changestart = True
         insertions = 0
-        while(changestart):
-            newinsertions = samlcigar[0:cigarstart].count('I')
-            mcount = samlcigar[0:cigarstart].count('M')
-            if (not mcount == (firstread.pos - secondread.pos)):
+        while(True):
+            newinsertions = countInRuns(samruns, cigarstart, "I")
+            if (not countInRuns(samruns, cigarstart, "M") == distance):
                 seqstart = seqstart + 1
                 cigarstart = cigarstart + 1
-            if(newinsertions == insertions):
-                #same number of insertions, so check if next base is not an insertion
-                if (len(samlcigar) > seqstart):
-                    if (samlcigar[seqstart] == "M"):
-                        changestart = False
-                    elif (samlcigar[seqstart] == "I"):
-                        newinsertions = newinsertions + 1
-                        seqstart = seqstart + 1
-                        cigarstart = cigarstart + 1
-                    elif (samlcigar[seqstart] == "D"):
-                        #have a delition
-                        cigarstart = cigarstart + 1
-                        changestart = False
-                else:
-                    changestart = False
-            else:
+            if (not newinsertions == insertions):
                 #different number of insertions
                 insertions = newinsertions
-                seqstart = seqstart
-                cigarstart = cigarstart
-            
-        isstart=True
-        for letter in str(secondread.longcigar()):
-            if (isstart and letter is "S"):
+                continue
+            #same number of insertions, so check if next base is not an insertion
+            if (samlength <= seqstart):
+                break
+            op = operationAt(samruns, seqstart)
+            if (op == "M"):
+                break
+            elif (op == "I"):
+                seqstart = seqstart + 1
                 cigarstart = cigarstart + 1
-            else:
-                isstart = False
+            elif (op == "D"):
+                #have a delition
+                cigarstart = cigarstart + 1
+                break
+            elif (countInRuns(samruns, cigarstart, "M") == distance):
+                #other operation, on which the start would not move any more
+                break
+        #soft clipping at the start is not skipped in the cigars, as it is not skipped in seqstart:
+        #an overlap next to a soft clip gets a different cigar, and is not merged
         length = min((secondread.getLengthOnReference() - cigarstart), firstread.getLengthOnReference())
-        samlcigar = str(secondread.longcigar())[cigarstart:cigarstart+length]
-        matelcigar = str(firstread.longcigar())
+        samwindow = cigarWindow(secondruns, cigarstart, cigarstart+length)
         matecigarstart = 0
-        isstart=True
-        for letter in matelcigar:
-            if (isstart and letter is "S"):
-                matecigarstart = matecigarstart + 1
-            else:
-                isstart = False
-        matelcigar = matelcigar[matecigarstart:matecigarstart+length]
-        refstart = secondread.pos + str(secondread.longcigar())[0:cigarstart].count('M') + str(secondread.longcigar())[0:cigarstart].count('D')
-        if (str(samlcigar) == str(matelcigar)):
+        matewindow = cigarWindow(firstruns, matecigarstart, matecigarstart+length)
+        refstart = secondread.pos + countInRuns(secondruns, cigarstart, "MD")
+        if (normalizeRuns(samwindow) == normalizeRuns(matewindow)):
             return (True, seqstart, cigarstart, matecigarstart, length, refstart)
         else:
             if (length == -1):
@@ -424,24 +562,13 @@ class samRead:
         '''
         returns the index of the sequence, which is the first base on the reference
         '''
-        i = 0
-        longcigar = self.longcigar()
-        while (i < len(longcigar)):
-            if (longcigar[i] != "S"):
-                return i
-            i = i +1
-        return i
+        return self.parsedCigar().leadingsoftclip
         
     def endOfSeqOnRef(self):
         '''
         returns the index of the sequence, which is the last base on the reference
         '''
-        longcigar = self.longcigar()
-        i = len(longcigar) -1
-        while (i > 0):
-            if (longcigar[i] != "S"):
-                return i
-            i = i -1
-        return i
-        
-        
+        cigar = self.parsedCigar()
+        if (cigar.length == 0):
+            return -1
+        return max(cigar.length - 1 - cigar.trailingsoftclip, 0)
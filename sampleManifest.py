@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+The manifest of the batch mode (--manifest): one sample per line, with the input, output and (optional) error file,
+and the table with the statistics of all samples and their total.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+
+#the columns of the table: (header, key in the rows)
+COLUMNS = (
+    ("Sample", "sample"),
+    ("Total reads", "total_reads"),
+    ("Merged pairs", "merged_pairs"),
+    ("Merged %", "merged_percent"),
+    ("Failed merges pairs", "failed_merges"),
+    ("Failed %", "failed_percent"),
+    ("Blacklisted pairs", "blacklisted_pairs"),
+    ("Peak reads waiting for mate", "peak_reads_waiting_for_mate"),
+    ("Seconds", "seconds"),
+    ("Status", "status"),
+)
+
+
+def readManifest(path):
+    '''
+    function returns the samples of a manifest as a list of dicts with input, output and error (None: no error file)
+    a line has the input, output and error file separated by tabs (or spaces if there are no tabs), the error file can be left out or -
+    empty lines and lines starting with # are skipped
+    '''
+    samples = []
+    outputs = set()
+    with open(path) as manifest:
+        for (number, line) in enumerate(manifest, 1):
+            line = line.rstrip("\r\n")
+            if (line.strip() == "" or line.startswith("#")):
+                continue
+            fields = line.split("\t")
+            if (len(fields) == 1):
+                fields = line.split()
+            if (len(fields) not in (2, 3) or "" in fields):
+                raise ValueError("{} line {}: expected the input, output and error file: {}".format(path, number, line))
+            if ("-" in fields[:2]):
+                raise ValueError("{} line {}: stdin and stdout cannot be used in a manifest".format(path, number))
+            error = None
+            if (len(fields) == 3 and fields[2] != "-"):
+                error = fields[2]
+            for name in [fields[1], error]:
+                if (name is None):
+                    continue
+                if (os.path.abspath(name) in outputs):
+                    raise ValueError("{} line {}: {} is written by another sample".format(path, number, name))
+                outputs.add(os.path.abspath(name))
+            samples.append({"input": fields[0], "output": fields[1], "error": error})
+    return samples
+
+
+def tableRow(sample, statistics, seconds, status="ok"):
+    '''
+    function returns the row of the table for a sample (or the total) with its mergeStatistics
+    the percentages are of the reads, as in the statistics of a single run
+    '''
+    total = statistics.counts["total_reads"]
+    row = {"sample": sample, "total_reads": total, "merged_pairs": statistics.merged, "failed_merges": statistics.failed,
+           "blacklisted_pairs": statistics.blacklisted, "peak_reads_waiting_for_mate": statistics.peakwaiting,
+           "seconds": round(seconds, 2), "status": status, "merged_percent": 0.0, "failed_percent": 0.0}
+    if (total > 0):
+        row["merged_percent"] = round(statistics.merged * 2 / total * 100, 2)
+        row["failed_percent"] = round(statistics.failed * 2 / total * 100, 2)
+    return row
+
+
+def formatTable(rows, blacklist=False):
+    '''
+    function returns the rows as a tab separated table with a header line
+    blacklist False leaves out the column of the blacklisted pairs
+    '''
+    columns = [(header, key) for (header, key) in COLUMNS if blacklist or key != "blacklisted_pairs"]
+    lines = ["\t".join(header for (header, key) in columns)]
+    for row in rows:
+        lines.append("\t".join(str(row[key]) for (header, key) in columns))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Output in coordinate order for an input sorted on coordinate.
+A pair is written when its second mate is read, so a merged read (at the position of the first mate) comes after
+the reads between both mates. The records are held ordered on (reference, position), and written once
+the input has moved more than the reorder window past them. The records are held in a heap, so a write only takes
+the records below the window from it (instead of sorting all held records at every write). The references are in the order of the @SQ
+header lines, reads without reference (*) come last (as in a sorted input): at the first of them all held records are written,
+and from then on the reads without reference are written as they come, so they are not held in memory
+(reads without reference before the first read with reference are written as they come too).
+Records which come after the records around them are written already (ex. the first mate of a pair of which the mates
+are further apart than the window) cannot be put in order, they are written at once and counted.
+Only an input sorted on coordinate can be put in order this way, so an input of which the header does not say so is refused
+(before anything is written), unless the input order is given.
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import heapq
+
+
+def headerIsSorted(lines, binary=False):
+    '''
+    function returns True if the @HD line of the header lines says the input is sorted on coordinate
+    binary is True for lines in bytes
+    '''
+    (tab, hd, coordinate) = ("\t", "@HD", "SO:coordinate")
+    if (binary):
+        (tab, hd, coordinate) = (b"\t", b"@HD", b"SO:coordinate")
+    for line in lines:
+        if (line.startswith(hd + tab)):
+            return coordinate in line.rstrip().split(tab)[1:]
+    return False
+
+
+def sortedHeader(lines, binary=False):
+    '''
+    function returns the header lines with SO:coordinate in the @HD line (an @HD line is added if there is none)
+    binary is True for lines in bytes
+    '''
+    (tab, hd, so, coordinate, version) = ("\t", "@HD", "SO:", "SO:coordinate", "VN:1.6")
+    if (binary):
+        (tab, hd, so, coordinate, version) = (b"\t", b"@HD", b"SO:", b"SO:coordinate", b"VN:1.6")
+    result = []
+    found = False
+    for line in lines:
+        if (not found and line.startswith(hd + tab)):
+            found = True
+            line = tab.join([field for field in line.split(tab) if not field.startswith(so)] + [coordinate])
+        result.append(line)
+    if (not found):
+        result.insert(0, tab.join([hd, version, coordinate]))
+    return result
+
+
+class reorderWriter:
+    '''
+    file like object putting the sam lines written to it in coordinate order, before writing them to outfile
+    window is the number of bases the input can be past a record before it is written
+    inputorder is the order of the input, auto takes it from the header: at the first record a ValueError is raised (and nothing is written)
+    if the header does not say the input is sorted on coordinate (refused is then True)
+    written data can hold several lines, and does not have to end on a line end
+    late is the number of records that came after later records were written (so written out of order),
+    peak the highest number of records held
+    '''
+
+    def __init__(self, outfile, window=10000, inputorder="auto"):
+        self._outfile = outfile
+        self.window = window
+        self.inputorder = inputorder
+        self._newline = None
+        self._partial = None
+        self._header = []
+        self._inheader = True
+        #index of each reference, in order of the @SQ lines (and after them the other references in order of appearance)
+        self._references = {}
+        #the records held, as a heap: (reference, position, count, line)
+        #count keeps the input order of records on the same position
+        self._held = []
+        #True after the first record without reference, all records before it are written
+        self._unplaced = False
+        self._count = 0
+        #highest key seen (the position of the input), and the key of the last record written, (-1,) is before all keys
+        self._watermark = (-1,)
+        self._written = (-1,)
+        #lines to write at the end of the current write
+        self._lines = []
+        self.late = 0
+        self.peak = 0
+        self.refused = False
+
+    def _types(self, data):
+        if (isinstance(data, bytes)):
+            self._newline = b"\n"
+            (self._tab, self._at, self._sq, self._sn, self._star) = (b"\t", b"@", b"@SQ", b"SN:", b"*")
+        else:
+            self._newline = "\n"
+            (self._tab, self._at, self._sq, self._sn, self._star) = ("\t", "@", "@SQ", "SN:", "*")
+        self._partial = self._newline[:0]
+
+    def _writeHeader(self):
+        self._inheader = False
+        for line in self._header:
+            if (line.startswith(self._sq + self._tab)):
+                for field in line.split(self._tab):
+                    if (field.startswith(self._sn)):
+                        self._references.setdefault(field[3:], len(self._references))
+        self._lines.extend(sortedHeader(self._header, isinstance(self._newline, bytes)))
+        self._header = []
+
+    def _addLines(self, lines):
+        '''
+        add the lines to the held records, the late records and header lines between the records go to the lines to write
+        '''
+        held = self._held
+        references = self._references
+        (tab, at, star) = (self._tab, self._at, self._star)
+        for line in lines:
+            if (line[:1] == at):
+                if (self._inheader):
+                    self._header.append(line)
+                else:
+                    #header line between the records, written as is
+                    self._lines.append(line)
+                continue
+            if (self._inheader):
+                if (self.inputorder == "auto" and not headerIsSorted(self._header, isinstance(line, bytes))):
+                    self.refused = True
+                    raise ValueError("the input is not sorted on coordinate (no SO:coordinate in its @HD header line), so the output cannot be sorted")
+                self._writeHeader()
+            fields = line.split(tab, 4)
+            if (fields[2] == star):
+                #reads without reference before all records with reference are written as they come as well
+                if (not self._unplaced and self._watermark != (-1,)):
+                    #the reads without reference come last, so all held records can be written (before it)
+                    self._unplaced = True
+                    if (len(held) > self.peak):
+                        self.peak = len(held)
+                    self._flush(None)
+                    #a record with reference after it can only be written late
+                    self._written = (float("inf"),)
+                self._lines.append(line)
+                continue
+            reference = references.get(fields[2])
+            if (reference is None):
+                reference = len(references)
+                references[fields[2]] = reference
+            key = (reference, int(fields[3]))
+            if (key < self._written):
+                #records after it are written already
+                self.late = self.late + 1
+                self._lines.append(line)
+                continue
+            self._count = self._count + 1
+            heapq.heappush(held, key + (self._count, line))
+            if (key > self._watermark):
+                self._watermark = key
+        if (len(held) > self.peak):
+            self.peak = len(held)
+
+    def _flush(self, until):
+        '''
+        write the held records with a key below until (None: all)
+        '''
+        held = self._held
+        lines = self._lines
+        record = None
+        while (len(held) > 0 and (until is None or held[0] < until)):
+            record = heapq.heappop(held)
+            lines.append(record[3])
+        if (record is not None):
+            self._written = record[:2]
+        if (len(self._lines) > 0):
+            self._outfile.write(self._newline.join(self._lines) + self._newline)
+            self._lines = []
+
+    def write(self, data):
+        if (self._newline is None):
+            self._types(data)
+        lines = (self._partial + data).split(self._newline)
+        #the part after the last line end waits for the rest of its line
+        self._partial = lines.pop()
+        self._addLines(lines)
+        watermark = self._watermark
+        if (len(watermark) == 2):
+            self._flush((watermark[0], watermark[1] - self.window))
+        else:
+            self._flush((-1,))
+
+    def close(self):
+        '''
+        write all held records, and close outfile
+        '''
+        if (self._newline is not None):
+            if (len(self._partial) > 0):
+                self._addLines([self._partial])
+            if (self._inheader):
+                self._writeHeader()
+            self._flush(None)
+        self._outfile.close()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Koen Herten
+
+This is aftermerge v1. A script for merging paired reads after mapping, based on the locations on the reference genome.
+
+Tests of aftermerge, run with python -m pytest tests (or python -m unittest discover tests).
+
+Copyright 2017, Koen Herten, All rights reserved
+
+This file is part of aftermerge.
+
+aftermerge is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+aftermerge is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with aftermerge.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+PACKAGEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGEDIR)
+sys.path.insert(0, os.path.join(PACKAGEDIR, "benchmarks"))
+sys.path.insert(0, os.path.join(PACKAGEDIR, "fuzz"))
+
+import aftermerge
+import bamFile
+import bamIndex
+import fuzzMerge
+import simulateSam
+import sortedOutput
+
+
+HEADER = ["@HD\tVN:1.0\tSO:unsorted", "@SQ\tSN:chr1\tLN:1000"]
+
+
+def runAftermerge(arguments):
+    '''
+    function returns the CompletedProcess of running aftermerge.py with the arguments
+    '''
+    return subprocess.run([sys.executable, os.path.join(PACKAGEDIR, "aftermerge.py")] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+class emptyInputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def check(self, lines, arguments=()):
+        with open(self.path("input.sam"), "w") as infile:
+            infile.write("".join(line + "\n" for line in lines))
+        result = runAftermerge(list(arguments) + ["--stats-json", self.path("stats.json"), self.path("input.sam"), self.path("output.sam")])
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Total reads\t0 (0.0%)", result.stderr)
+        with open(self.path("stats.json")) as statsfile:
+            self.assertEqual(json.load(statsfile)["total_reads"], 0)
+
+    def testHeaderOnly(self):
+        self.check(HEADER)
+
+    def testNoLines(self):
+        self.check([])
+
+    def testSampledWithoutReads(self):
+        self.check(HEADER, ["--stats-only", "--sample-fraction", "0.5"])
+
+
+#a pair that is merged, a pair of which the overlap has a different cigar (failed), a pair that does not overlap and a read without mate
+PAIRS = [
+    "merged\t99\tchr1\t100\t60\t10M\t=\t105\t15\tACGTACGTAC\tIIIIIIIIII",
+    "merged\t147\tchr1\t105\t60\t10M\t=\t100\t-15\tCGTACGTACG\tIIIIIIIIII",
+    "failed\t99\tchr1\t200\t60\t10M\t=\t205\t15\tACGTACGTAC\tIIIIIIIIII",
+    "failed\t147\tchr1\t205\t60\t2M1D8M\t=\t200\t-16\tCGTACGTACG\tIIIIIIIIII",
+    "apart\t99\tchr1\t300\t60\t10M\t=\t500\t210\tACGTACGTAC\tIIIIIIIIII",
+    "apart\t147\tchr1\t500\t60\t10M\t=\t300\t-210\tACGTACGTAC\tIIIIIIIIII",
+    "single\t99\tchr1\t600\t60\t10M\t=\t603\t13\tACGTACGTAC\tIIIIIIIIII",
+]
+
+
+class mergeRecordsTest(unittest.TestCase):
+
+    def merge(self, records):
+        statistics = aftermerge.mergeStatistics()
+        lines = list(aftermerge.mergeRecords(records, statistics))
+        self.assertEqual((statistics.merged, statistics.failed), (1, 1))
+        return lines
+
+    def testStrInput(self):
+        lines = self.merge(HEADER + PAIRS)
+        self.assertTrue(all(isinstance(line, str) for line in lines))
+
+    def testBytesInput(self):
+        expected = [line.encode("ascii") for line in self.merge(HEADER + PAIRS)]
+        lines = self.merge([line.encode("ascii") for line in HEADER + PAIRS])
+        self.assertTrue(all(isinstance(line, bytes) for line in lines))
+        self.assertEqual(lines, expected)
+
+    def testBytesInputWithoutHeader(self):
+        lines = self.merge([line.encode("ascii") for line in PAIRS])
+        self.assertTrue(all(isinstance(line, bytes) for line in lines))
+
+    def testStatisticsOfSeveralInputs(self):
+        statistics = aftermerge.mergeStatistics(collectfailures=True)
+        first = list(aftermerge.mergeRecords(HEADER + PAIRS, statistics))
+        second = list(aftermerge.mergeRecords(HEADER + PAIRS, statistics))
+        self.assertEqual(first, second)
+        self.assertEqual(statistics.counts["total_reads"], 2 * len(PAIRS))
+        self.assertEqual((statistics.merged, statistics.failed, len(statistics.failures)), (2, 2, 2))
+
+
+class reorderWriterTest(unittest.TestCase):
+
+    def testUnplacedStreamed(self):
+        output = io.StringIO()
+        writer = sortedOutput.reorderWriter(output, 1000, "coordinate")
+        writer.write("\n".join(HEADER + [PAIRS[2], PAIRS[0], PAIRS[1]]) + "\n")
+        #only the header is written, the records are held in the window
+        self.assertEqual(len(output.getvalue().splitlines()), len(HEADER))
+        unplaced = ["unplaced{}\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII".format(number) for number in range(2)]
+        for line in unplaced:
+            writer.write(line + "\n")
+            #the held records are written at the first read without reference, which are then written as they come
+            self.assertEqual(output.getvalue().splitlines()[-1], line)
+            self.assertEqual(len(writer._held), 0)
+        self.assertEqual(output.getvalue().splitlines()[len(HEADER):], [PAIRS[0], PAIRS[1], PAIRS[2]] + unplaced)
+        self.assertEqual(writer.late, 0)
+        writer.write(PAIRS[4] + "\n")
+        self.assertEqual(output.getvalue().splitlines()[-1], PAIRS[4])
+        self.assertEqual(writer.late, 1)
+
+
+def writeIndex(bampath):
+    '''
+    write the index (.bai) of a BAM file sorted on coordinate, with only what bamIndex reads:
+    per reference the offsets of its first and after its last read (in the pseudo bin) and the linear index (by start of the reads)
+    '''
+    reader = bamFile.bamReader(open(bampath, "rb"))
+    begin = [None] * len(reader.references)
+    end = [None] * len(reader.references)
+    linear = [[] for reference in reader.references]
+    unplaced = 0
+    while (True):
+        offset = reader._bgzf.tell()
+        record = reader.readRecord()
+        if (record is None):
+            break
+        (refid, pos) = struct.unpack_from("<ii", record)
+        if (refid < 0):
+            unplaced = unplaced + 1
+            continue
+        if (begin[refid] is None):
+            begin[refid] = offset
+        end[refid] = reader._bgzf.tell()
+        window = pos >> bamIndex.WINDOW_SHIFT
+        while (len(linear[refid]) <= window):
+            linear[refid].append(offset)
+    reader.close()
+    data = [bamIndex.BAI_MAGIC, struct.pack("<i", len(begin))]
+    for refid in range(len(begin)):
+        if (begin[refid] is None):
+            data.append(struct.pack("<i", 0))
+        else:
+            data.append(struct.pack("<iIiQQQQ", 1, bamIndex.PSEUDO_BIN, 2, begin[refid], end[refid], 0, 0))
+        data.append(struct.pack("<i{}Q".format(len(linear[refid])), len(linear[refid]), *linear[refid]))
+    data.append(struct.pack("<Q", unplaced))
+    with open(bampath + ".bai", "wb") as indexfile:
+        indexfile.write(b"".join(data))
+
+
+class simulatedTest(unittest.TestCase):
+    '''
+    tests on a simulated sam file (from benchmarks/simulateSam.py), comparing the output of aftermerge with different options
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def simulate(self, name, pairs=2000, order="mapper"):
+        with open(self.path(name), "w") as samfile:
+            for line in simulateSam.simulateSam(pairs, seed=3, order=order, referencelength=100000):
+                samfile.write(line + "\n")
+        return self.path(name)
+
+    def merge(self, name, infile, arguments=()):
+        '''
+        function returns the output and error file of running aftermerge with the arguments on infile (as bytes)
+        '''
+        (outpath, errorpath) = (self.path(name + ".sam"), self.path(name + ".bed"))
+        result = runAftermerge(list(arguments) + ["-error", errorpath, infile, outpath])
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with open(outpath, "rb") as outfile, open(errorpath, "rb") as errorfile:
+            return (outfile.read(), errorfile.read())
+
+    def testThreadsIdentical(self):
+        infile = self.simulate("input.sam")
+        single = self.merge("single", infile, ["-t", "1", "--batch-size", "100"])
+        threaded = self.merge("threaded", infile, ["-t", "2", "--batch-size", "100"])
+        self.assertGreater(single[0].count(b"\n"), 3000)
+        self.assertEqual(single, threaded)
+
+    def assertSameLines(self, first, second):
+        '''
+        the outputs (output and error file) have the same lines, in any order
+        '''
+        for (firstdata, seconddata) in zip(first, second):
+            self.assertEqual(sorted(firstdata.splitlines()), sorted(seconddata.splitlines()))
+
+    def testMmapThreads(self):
+        infile = self.simulate("input.sam")
+        #chunks of about 50kb, so the input is split over the workers
+        mapped = self.merge("mapped", infile, ["--mmap", "-t", "2", "--chunk-size", "0.05"])
+        self.assertSameLines(self.merge("default", infile), mapped)
+
+    def testTinyBufferMemory(self):
+        infile = self.simulate("input.sam", order="coordinate")
+        spilled = self.merge("spilled", infile, ["--max-buffer-memory", "0.001", "--stats-json", self.path("stats.json")])
+        with open(self.path("stats.json")) as statsfile:
+            self.assertGreater(json.load(statsfile)["reads_spilled_to_disk"], 0)
+        self.assertSameLines(self.merge("default", infile), spilled)
+
+    def testSharded(self):
+        samfile = self.simulate("input.sam", order="coordinate")
+        infile = self.path("input.bam")
+        writer = bamFile.bamWriter(open(infile, "wb"))
+        with open(samfile) as lines:
+            for line in lines:
+                writer.write(line)
+        writer.close()
+        writeIndex(infile)
+        sharded = self.merge("sharded", infile, ["--sharded", "-t", "2", "--shards", "8"])
+        default = self.merge("default", infile)
+        self.assertGreater(default[1].count(b"\n"), 0)
+        self.assertSameLines(default, sharded)
+
+
+class fuzzTest(unittest.TestCase):
+
+    def testFixedSeed(self):
+        #a short run of fuzz/fuzzMerge.py: the merge engines against the reference merge, 0 is no differences
+        self.assertEqual(fuzzMerge.fuzz(500, 1, fuzzMerge.availableEngines()), 0)
+
+
+class manifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def testFailedSample(self):
+        #a sam line with too few fields fails the sample, after some of its output is written
+        samples = {"good": HEADER + PAIRS, "bad": HEADER + PAIRS + ["broken\t99\tchr1"]}
+        with open(self.path("manifest.txt"), "w") as manifest:
+            for (name, lines) in sorted(samples.items()):
+                with open(self.path(name + ".sam"), "w") as infile:
+                    infile.write("".join(line + "\n" for line in lines))
+                manifest.write("\t".join(self.path(name + suffix) for suffix in (".sam", ".out.sam", ".bed")) + "\n")
+        for threads in ("1", "2"):
+            result = runAftermerge(["--manifest", self.path("manifest.txt"), "--stats-json", self.path("stats.json"), "-t", threads])
+            self.assertEqual(result.returncode, 1, result.stderr)
+            self.assertTrue(os.path.exists(self.path("good.out.sam")))
+            self.assertFalse(os.path.exists(self.path("bad.out.sam")))
+            self.assertFalse(os.path.exists(self.path("bad.bed")))
+            with open(self.path("stats.json")) as statsfile:
+                stats = json.load(statsfile)
+            self.assertEqual(stats["total"]["total_reads"], len(PAIRS))
+            self.assertEqual(stats["total"]["merged_pairs"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()